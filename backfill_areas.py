@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Script to assign administrative area codes to existing assessments
+
+Reads the boundaries from FICHEIRO_AREAS (or --ficheiro) and runs the
+point-in-polygon test in a pool of worker processes, one batch of rows at a
+time. Only rows whose code changes are written; each write bumps the row
+version and is recorded in the change sequence so caches and in-memory
+indexes pick it up, and the area rollup is rebuilt at the end.
+"""
+import argparse
+import os
+import sys
+from collections import deque
+from datetime import datetime
+from multiprocessing import Pool
+
+# Add the project root to the path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from migrate_db import create_app
+from src.models.user import db
+from src.models.assessment import AvaliacaoDesastre
+from src.models.change_log import AlteracaoAvaliacao
+from src.models.rollup import reconstruir_rollup_areas
+from src.services.areas import FICHEIRO_AREAS, PROPRIEDADE_CODIGO_AREA, carregar_areas, hierarquia_area
+
+_indice = None
+
+
+def _iniciar_trabalhador(caminho, propriedade):
+    """Load the boundaries once per worker process"""
+    global _indice
+    _indice = carregar_areas(caminho, propriedade)
+
+
+def _atribuir(lote):
+    """Return (id, new code) for the rows of the batch whose code changes"""
+    ids, latitudes, longitudes, atuais = lote
+    indices = _indice.localizar_lote(latitudes, longitudes)
+    alteracoes = []
+    for avaliacao_id, indice, atual in zip(ids, indices.tolist(), atuais):
+        codigo = _indice.codigos[indice] if indice >= 0 else None
+        if codigo != atual:
+            alteracoes.append((avaliacao_id, codigo))
+    return alteracoes
+
+
+def _lotes(tamanho, todas):
+    """Batches of (ids, latitudes, longitudes, current codes) in id order"""
+    ultimo_id = 0
+    while True:
+        query = db.session.query(
+            AvaliacaoDesastre.id, AvaliacaoDesastre.latitude_gps,
+            AvaliacaoDesastre.longitude_gps, AvaliacaoDesastre.codigo_area
+        ).filter(AvaliacaoDesastre.id > ultimo_id)
+        if not todas:
+            query = query.filter(
+                AvaliacaoDesastre.codigo_area.is_(None),
+                AvaliacaoDesastre.latitude_gps.isnot(None),
+                AvaliacaoDesastre.longitude_gps.isnot(None)
+            )
+        linhas = query.order_by(AvaliacaoDesastre.id).limit(tamanho).all()
+        if not linhas:
+            return
+        ultimo_id = linhas[-1][0]
+        ids, latitudes, longitudes, atuais = zip(*linhas)
+        yield (
+            list(ids),
+            [float('nan') if v is None else v for v in latitudes],
+            [float('nan') if v is None else v for v in longitudes],
+            list(atuais)
+        )
+
+
+def _parametros(avaliacao_id, codigo):
+    hierarquia = hierarquia_area(codigo)
+    return {
+        'b_id': avaliacao_id,
+        'b_codigo': codigo,
+        'b_regiao': hierarquia['codigo_regiao'],
+        'b_municipio': hierarquia['codigo_municipio']
+    }
+
+
+def _gravar(alteracoes):
+    tabela = AvaliacaoDesastre.__table__
+    db.session.execute(
+        tabela.update()
+        .where(tabela.c.id == db.bindparam('b_id'))
+        .values(
+            codigo_area=db.bindparam('b_codigo'),
+            codigo_regiao=db.bindparam('b_regiao'),
+            codigo_municipio=db.bindparam('b_municipio'),
+            versao=tabela.c.versao + 1
+        ),
+        [_parametros(i, codigo) for i, codigo in alteracoes]
+    )
+    agora = datetime.utcnow()
+    db.session.execute(
+        AlteracaoAvaliacao.__table__.insert(),
+        [{'avaliacao_id': i, 'operacao': 'U', 'data': agora} for i, _ in alteracoes]
+    )
+    db.session.commit()
+
+
+def backfill_areas(caminho, propriedade, processos, tamanho_lote, todas):
+    app = create_app()
+
+    with app.app_context():
+        totais = [0, 0]     # processed, updated
+
+        def concluir(pendentes):
+            n, resultado = pendentes.popleft()
+            alteracoes = resultado.get()
+            if alteracoes:
+                _gravar(alteracoes)
+            totais[0] += n
+            totais[1] += len(alteracoes)
+
+        with Pool(processos, initializer=_iniciar_trabalhador, initargs=(caminho, propriedade)) as pool:
+            # Read in this process (the session belongs to the app context) and keep
+            # at most two batches per worker in flight
+            pendentes = deque()
+            for lote in _lotes(tamanho_lote, todas):
+                pendentes.append((len(lote[0]), pool.apply_async(_atribuir, (lote,))))
+                if len(pendentes) >= processos * 2:
+                    concluir(pendentes)
+                    print(f"Processed {totais[0]} assessments, updated {totais[1]}")
+            while pendentes:
+                concluir(pendentes)
+
+        # The raw UPDATEs bypass the ORM events that maintain the area rollup
+        if totais[1]:
+            reconstruir_rollup_areas()
+        return tuple(totais)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ficheiro', default=FICHEIRO_AREAS, help='GeoJSON file with the area boundaries')
+    parser.add_argument('--propriedade', default=PROPRIEDADE_CODIGO_AREA, help='Feature property holding the area code')
+    parser.add_argument('--processos', type=int, default=os.cpu_count(), help='Worker processes')
+    parser.add_argument('--lote', type=int, default=20000, help='Rows per batch')
+    parser.add_argument('--todas', action='store_true', help='Recompute every row, not only rows without a code')
+    args = parser.parse_args()
+
+    if not args.ficheiro:
+        parser.error('set FICHEIRO_AREAS or pass --ficheiro')
+
+    processadas, atualizadas = backfill_areas(args.ficheiro, args.propriedade, args.processos, args.lote, args.todas)
+    print(f"Processed {processadas} assessments, updated {atualizadas}")
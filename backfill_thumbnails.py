@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Script to generate the missing thumbnails and perceptual hashes of stored evidence images
+
+Thumbnails and the perceptual hash are normally generated in the background
+right after an upload; images stored before they existed, or whose
+generation failed (worker crash, server restart before the pool finished),
+have no miniaturas_prova or hashes_perceptuais rows. This script finds those
+objects and generates what is missing in a pool of worker processes, one
+batch at a time: thumbnails and hash for images without thumbnails, only the
+hash for images that already have them. Images that still fail are reported
+and left for the next run, so it can be re-run safely, e.g. from cron.
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# Add the project root to the path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from migrate_db import create_app
+from src.models.user import db
+from src.models.evidence import HashPerceptual, MiniaturaProva, ObjetoProva, registar_miniaturas
+from src.services.processos import contexto_pool
+from src.services.thumbnails import (
+    PROCESSOS_MINIATURAS, TIPOS_COM_MINIATURA, calcular_hash, disponivel, gerar_miniaturas
+)
+
+
+def _gerar(chave_sha256):
+    """Run in a worker; return (sha256, (thumbnails, hash) or the error message)"""
+    chave, sha256 = chave_sha256
+    try:
+        return sha256, gerar_miniaturas(chave, sha256)
+    except Exception as e:
+        return sha256, str(e)
+
+
+def _hash(chave_sha256):
+    """Run in a worker; return (sha256, ([], hash) or the error message)"""
+    chave, sha256 = chave_sha256
+    try:
+        return sha256, ([], calcular_hash(chave))
+    except Exception as e:
+        return sha256, str(e)
+
+
+def _lotes(tamanho, em_falta):
+    """Batches of (key, sha256) of referenced images without rows in em_falta, in sha256 order"""
+    ultimo = ''
+    while True:
+        linhas = db.session.query(ObjetoProva.caminho, ObjetoProva.sha256).filter(
+            ObjetoProva.sha256 > ultimo,
+            ObjetoProva.tipo.in_(TIPOS_COM_MINIATURA),
+            ObjetoProva.referencias > 0,
+            ~db.session.query(em_falta.sha256).filter(em_falta.sha256 == ObjetoProva.sha256).exists()
+        ).order_by(ObjetoProva.sha256).limit(tamanho).all()
+        if not linhas:
+            return
+        ultimo = linhas[-1][1]
+        yield [tuple(linha) for linha in linhas]
+
+
+def backfill_thumbnails(processos, tamanho_lote):
+    app = create_app()
+
+    with app.app_context():
+        totais = [0, 0, 0]     # thumbnails generated, hashes only, failed
+        with ProcessPoolExecutor(max_workers=processos, mp_context=contexto_pool()) as executor:
+            # Images without thumbnails first (their hash comes with them), then the rest without a hash
+            for indice, funcao, em_falta in ((0, _gerar, MiniaturaProva), (1, _hash, HashPerceptual)):
+                for lote in _lotes(tamanho_lote, em_falta):
+                    for sha256, resultado in executor.map(funcao, lote):
+                        if isinstance(resultado, str):
+                            print(f"Failed {sha256}: {resultado}")
+                            totais[2] += 1
+                            continue
+                        registar_miniaturas(sha256, *resultado)
+                        totais[indice] += 1
+                    print(f"Thumbnails {totais[0]}, hashes {totais[1]}, failed {totais[2]}")
+        return tuple(totais)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processos', type=int, default=PROCESSOS_MINIATURAS, help='Worker processes')
+    parser.add_argument('--lote', type=int, default=200, help='Images per batch')
+    args = parser.parse_args()
+
+    if not disponivel():
+        parser.error('Pillow is not installed')
+
+    geradas, hashes, falhadas = backfill_thumbnails(args.processos, args.lote)
+    print(f"Generated thumbnails for {geradas} images and hashes for {hashes} more; "
+          f"{falhadas} failed and are left for the next run")
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Script to delete evidence that is no longer referenced
+
+Runs one full pass of the same collector the app can run in the background
+(INTERVALO_RECOLHA_PROVAS): objects whose reference count dropped to zero
+(deleted assessments) lose their row, thumbnails and files; files in the store
+without a matching row (failed uploads, unconfirmed direct uploads, orphaned
+thumbnails, .parcial temporaries) are deleted once older than the grace
+period; abandoned resumable uploads are discarded. Work is done in batches at
+a limited rate, so it can run from cron next to a live server.
+"""
+import argparse
+import os
+import sys
+
+# Add the project root to the path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from migrate_db import create_app
+from src.routes.assessment_swagger import garantir_pasta_parciais
+from src.services.recolha import CARENCIA_RECOLHA_PROVAS, LOTE_RECOLHA_PROVAS, TAXA_RECOLHA_PROVAS, RecolhaProvas
+
+
+def collect_evidence_garbage(carencia, lote, taxa, simular):
+    app = create_app()
+
+    with app.app_context():
+        recolha = RecolhaProvas(pasta_parciais=garantir_pasta_parciais(), carencia=carencia,
+                                lote=lote, taxa=taxa, simular=simular)
+        return recolha.executar()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--carencia', type=int, default=CARENCIA_RECOLHA_PROVAS,
+                        help='Seconds an unreferenced file or object must age before it is deleted')
+    parser.add_argument('--lote', type=int, default=LOTE_RECOLHA_PROVAS, help='Entries per batch')
+    parser.add_argument('--taxa', type=float, default=TAXA_RECOLHA_PROVAS,
+                        help='Storage operations per second (0 for no limit)')
+    parser.add_argument('--simular', action='store_true', help='Only report what would be deleted')
+    args = parser.parse_args()
+
+    totais = collect_evidence_garbage(args.carencia, args.lote, args.taxa, args.simular)
+    accao = 'Would delete' if args.simular else 'Deleted'
+    print(f"{accao} {totais['objetos']} objects, {totais['ficheiros']} orphaned files and "
+          f"{totais['parciais']} abandoned uploads; {totais['bytes'] / 1024 / 1024:.1f} MB reclaimed")
+    if totais['desconhecidos']:
+        print(f"Left {totais['desconhecidos']} files that do not follow the store layout")
@@ -4,20 +4,41 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from flask import Flask, send_from_directory
+from werkzeug.security import safe_join
 from flask_cors import CORS
 from flask_restx import Api
 from src.models.user import db
 from src.models.assessment import AvaliacaoDesastre
-from src.routes.assessment_swagger import api as api_avaliacoes
+from src.models.migracoes import aplicar_migracoes
+from src.models.rollup import inicializar_rollups
+from src.models.change_log import AlteracaoAvaliacao
+from src.models.evidence import ObjetoProva, ProvaAvaliacao, MiniaturaProva, HashPerceptual
+from src.routes.assessment_swagger import PASTA_UPLOAD, garantir_pasta_parciais, api as api_avaliacoes
 from src.routes.auth import api as api_autenticacao
 from src.routes.auth import api as api_autenticacao
+from src.services.compression import LIMITE_PEDIDO_BYTES, DescompressaoPedidos
+from src.services.serialization import MIMETYPE_MSGPACK, saida_msgpack
+from src.services.recolha import iniciar_recolha
+from src.services.recompressao import avisar_se_indisponivel as avisar_recompressao
+from src.services.armazenamento import PASTA_PROVAS
 
-app = Flask(__name__, static_folder=os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static'))
+# Ficheiros do frontend, servidos por servir(). A rota /static do Flask fica desligada:
+# serviria também tudo o que estiver em static/, provas incluídas
+PASTA_ESTATICA = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static')
+# Provas (antigas em static/uploads/evidence e o armazém local): só pela API, com autenticação
+PASTAS_PROTEGIDAS = [os.path.realpath(os.path.join(PASTA_ESTATICA, PASTA_UPLOAD)), os.path.realpath(PASTA_PROVAS)]
+
+app = Flask(__name__, static_folder=None)
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
+# Limite do corpo dos pedidos; só as rotas de carregamento de provas aceitam mais
+app.config['MAX_CONTENT_LENGTH'] = LIMITE_PEDIDO_BYTES
 
 # Activar CORS para todas as rotas
 CORS(app)
 
+# Aceitar corpos de pedido comprimidos (Content-Encoding: gzip/deflate/zstd)
+app.wsgi_app = DescompressaoPedidos(app.wsgi_app)
+
 # Inicializar API Flask-RESTX com documentação Swagger
 api = Api(
     app,
@@ -37,6 +58,9 @@ api = Api(
     }
 )
 
+# Suportar Accept: application/msgpack em todas as respostas
+api.representation(MIMETYPE_MSGPACK)(saida_msgpack)
+
 # Adicionar namespaces
 api.add_namespace(api_avaliacoes, path='/avaliacoes')
 api.add_namespace(api_autenticacao, path='/autenticacao')
@@ -49,15 +73,27 @@ db.init_app(app)
 
 with app.app_context():
     db.create_all()
+    aplicar_migracoes(PASTA_ESTATICA)
+    inicializar_rollups()
+
+# Recolha em segundo plano das provas sem referências (desligada se INTERVALO_RECOLHA_PROVAS=0)
+iniciar_recolha(app, garantir_pasta_parciais())
+avisar_recompressao(app)
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def servir(path):
-    pasta_estatica = app.static_folder
-    if pasta_estatica is None:
-            return "Pasta estática não configurada", 404
+    # Caminho normalizado ('uploads//evidence', './uploads', ...); None se sair da pasta
+    caminho = safe_join(PASTA_ESTATICA, path)
+    if caminho is None:
+        return "Não encontrado", 404
+    # As provas só são servidas pela API, com autenticação
+    caminho_real = os.path.realpath(caminho)
+    if any(os.path.commonpath([caminho_real, pasta]) == pasta for pasta in PASTAS_PROTEGIDAS):
+        return "Não encontrado", 404
 
-    if path != "" and os.path.exists(os.path.join(pasta_estatica, path)):
+    pasta_estatica = PASTA_ESTATICA
+    if path != "" and os.path.isfile(caminho):
         return send_from_directory(pasta_estatica, path)
     else:
         caminho_index = os.path.join(pasta_estatica, 'index.html')
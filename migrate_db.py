@@ -10,6 +10,9 @@ sys.path.insert(0, os.path.dirname(__file__))
 
 from src.models.user import db, Usuario, TipoUtilizador
 from src.models.assessment import AvaliacaoDesastre
+from src.models.rollup import RollupHorario, RollupArea
+from src.models.change_log import AlteracaoAvaliacao
+from src.models.evidence import ObjetoProva, ProvaAvaliacao, MiniaturaProva, HashPerceptual
 from flask import Flask
 
 def create_app():
@@ -89,7 +92,6 @@ def migrate_database():
         sample_assessment.nivel_danos = "parcial"
         sample_assessment.perdas = '["moveis", "eletrodomesticos"]'
         sample_assessment.outras_perdas = "Televisão e micro-ondas"
-        sample_assessment.ficheiros_prova = '["foto1.jpg", "foto2.jpg"]'
         sample_assessment.necessidade_urgente = "abrigo_temporario"
         sample_assessment.outra_necessidade = "Necessidade de reparação do telhado"
         
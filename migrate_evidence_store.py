@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Script to move existing evidence into the content-addressed store and provas_avaliacao
+
+Reads the legacy ficheiros_prova JSON column of each assessment. Every file it
+lists (under static/) is hashed, stored under its SHA-256 in the configured
+backend (ARMAZENAMENTO_PROVAS) and recorded as
+one provas_avaliacao row; identical files collapse into a single object. Old
+per-assessment files ({assessment_id}_{filename}) are removed once their batch
+is committed, the legacy column is cleared so the script can be re-run, and the
+reference counts are recomputed at the end.
+
+The application runs the same migration at startup; this script lets an
+operator run it ahead of a deploy, with progress output and a batch size.
+"""
+import argparse
+import os
+import sys
+
+# Add the project root to the path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from migrate_db import create_app
+from src.models.user import db
+from src.models.migracoes import aplicar_migracoes, migrar_provas_antigas
+
+
+def migrate_evidence_store(tamanho_lote):
+    app = create_app()
+
+    with app.app_context():
+        db.create_all()
+        aplicar_migracoes()
+        estatico = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+        return migrar_provas_antigas(
+            estatico, tamanho_lote,
+            relatar=lambda ultimo_id, totais: print(f"Up to assessment {ultimo_id}: {totais}")
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lote', type=int, default=1000, help='Assessments per batch')
+    args = parser.parse_args()
+
+    totais = migrate_evidence_store(args.lote)
+    print(f"Migrated {totais['migrated']} files, {totais['missing']} missing, {totais['skipped']} with unknown content")
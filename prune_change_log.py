@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Script to delete old entries from the assessment change sequence
+
+The sequence (alteracoes_avaliacoes) lets in-memory structures such as the
+columnar snapshot catch up with writes; entries older than the retention
+period are only needed by consumers that lag that far behind, and those
+reload everything instead. The latest entry is always kept so the sequence
+number never goes back. Run it from cron; with INTERVALO_RECOLHA_PROVAS set
+the app's background collector also runs it once per pass.
+"""
+import argparse
+import os
+import sys
+
+# Add the project root to the path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from migrate_db import create_app
+from src.models.change_log import RETENCAO_ALTERACOES_DIAS, podar_alteracoes
+
+
+def prune_change_log(dias):
+    app = create_app()
+
+    with app.app_context():
+        return podar_alteracoes(dias)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--dias', type=int, default=RETENCAO_ALTERACOES_DIAS,
+                        help='Days of changes to keep')
+    args = parser.parse_args()
+
+    apagadas = prune_change_log(args.dias)
+    print(f"Deleted {apagadas} change entries older than {args.dias} days")
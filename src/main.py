@@ -8,6 +8,7 @@ from flask_cors import CORS
 from models.user import db
 from routes.assessment import assessment_bp
 from routes.user import usuario_bp
+from services.compression import DescompressaoPedidos
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
@@ -15,6 +16,9 @@ app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
 # Enable CORS for all routes
 CORS(app)
 
+# Accept compressed request bodies (Content-Encoding: gzip/deflate/zstd)
+app.wsgi_app = DescompressaoPedidos(app.wsgi_app)
+
 # Database configuration
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database', 'app.db')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
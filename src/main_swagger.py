@@ -4,18 +4,39 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from flask import Flask, send_from_directory
+from werkzeug.security import safe_join
 from flask_cors import CORS
 from flask_restx import Api
 from src.models.user import db
 from src.models.assessment import AvaliacaoDesastre
-from src.routes.assessment_swagger import api as assessment_api
+from src.models.migracoes import aplicar_migracoes
+from src.models.rollup import inicializar_rollups
+from src.models.change_log import AlteracaoAvaliacao
+from src.models.evidence import ObjetoProva, ProvaAvaliacao, MiniaturaProva, HashPerceptual
+from src.routes.assessment_swagger import PASTA_UPLOAD, garantir_pasta_parciais, api as assessment_api
+from src.services.compression import LIMITE_PEDIDO_BYTES, DescompressaoPedidos
+from src.services.serialization import MIMETYPE_MSGPACK, saida_msgpack
+from src.services.recolha import iniciar_recolha
+from src.services.recompressao import avisar_se_indisponivel as avisar_recompressao
+from src.services.armazenamento import PASTA_PROVAS
 
-app = Flask(__name__, static_folder=os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static'))
+# Frontend files, served by servir() below. Flask's own /static route is off:
+# it would also serve anything stored under static/, evidence included
+PASTA_ESTATICA = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static')
+# Evidence (legacy files under static/uploads/evidence and the local store) is only served by the API
+PASTAS_PROTEGIDAS = [os.path.realpath(os.path.join(PASTA_ESTATICA, PASTA_UPLOAD)), os.path.realpath(PASTA_PROVAS)]
+
+app = Flask(__name__, static_folder=None)
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
+# Limite do corpo dos pedidos; só as rotas de carregamento de provas aceitam mais
+app.config['MAX_CONTENT_LENGTH'] = LIMITE_PEDIDO_BYTES
 
 # Enable CORS for all routes
 CORS(app)
 
+# Accept compressed request bodies (Content-Encoding: gzip/deflate/zstd)
+app.wsgi_app = DescompressaoPedidos(app.wsgi_app)
+
 # Initialize Flask-RESTX API with Swagger documentation
 api = Api(
     app,
@@ -26,6 +47,9 @@ api = Api(
     prefix='/api'
 )
 
+# Support Accept: application/msgpack on every response
+api.representation(MIMETYPE_MSGPACK)(saida_msgpack)
+
 # Add namespaces
 api.add_namespace(assessment_api, path='/avaliacoes')
 
@@ -36,6 +60,12 @@ db.init_app(app)
 
 with app.app_context():
     db.create_all()
+    aplicar_migracoes(PASTA_ESTATICA)
+    inicializar_rollups()
+
+# Background collection of unreferenced evidence (off when INTERVALO_RECOLHA_PROVAS=0)
+iniciar_recolha(app, garantir_pasta_parciais())
+avisar_recompressao(app)
 
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -44,11 +74,17 @@ def servir(path):
     if path.startswith('api/') or path.startswith('docs'):
         return None  # Deixar outras rotas lidar com isto
     
-    pasta_estatica = app.static_folder
-    if pasta_estatica is None:
-        return "Pasta estática não configurada", 404
+    # Caminho normalizado ('uploads//evidence', './uploads', ...); None se sair da pasta
+    caminho = safe_join(PASTA_ESTATICA, path)
+    if caminho is None:
+        return "Não encontrado", 404
+    # As provas só são servidas pela API, com autenticação
+    caminho_real = os.path.realpath(caminho)
+    if any(os.path.commonpath([caminho_real, pasta]) == pasta for pasta in PASTAS_PROTEGIDAS):
+        return "Não encontrado", 404
 
-    if path != "" and os.path.exists(os.path.join(pasta_estatica, path)):
+    pasta_estatica = PASTA_ESTATICA
+    if path != "" and os.path.isfile(caminho):
         return send_from_directory(pasta_estatica, path)
     else:
         caminho_index = os.path.join(pasta_estatica, 'index.html')
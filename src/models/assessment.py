@@ -1,9 +1,18 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
 from datetime import datetime
 import json
 
 # Import db from user module
 from .user import db
+from src.services.areas import indice_areas, hierarquia_area, validar_codigo_area
+
+# Valores permitidos para os campos de escolha
+GRUPOS_VULNERAVEIS = ['bebe_crianca', 'idoso', 'pessoa_deficiencia', 'doente_cronico']
+TIPOS_ESTRUTURA = ['habitacao', 'comercio', 'agricultura', 'outro']
+NIVEIS_DANOS = ['parcial', 'grave', 'total']
+TIPOS_PERDAS = ['alimentos', 'roupas_calcado', 'moveis', 'eletrodomesticos', 'documentos_pessoais', 'animais_domesticos', 'outros']
+NECESSIDADES_URGENTES = ['agua_potavel', 'alimentacao', 'abrigo_temporario', 'roupas_cobertores', 'medicamentos', 'outros']
 
 class AvaliacaoDesastre(db.Model):
     __tablename__ = 'avaliacoes_desastre'
@@ -31,9 +40,6 @@ class AvaliacaoDesastre(db.Model):
     perdas = db.Column(db.Text)                                  # JSON string: tipos de perdas
     outras_perdas = db.Column(db.Text)                            # Especificação de outras perdas
     
-    # Provas
-    ficheiros_prova = db.Column(db.Text)                          # JSON string: caminhos dos ficheiros (até 3)
-    
     # Necessidade Urgente
     necessidade_urgente = db.Column(db.String(50), nullable=False)       # ['agua_potavel', 'alimentacao', 'abrigo_temporario', 'roupas_cobertores', 'medicamentos', 'outros']
     outra_necessidade = db.Column(db.Text)                       # Especificação de outra necessidade
@@ -42,6 +48,32 @@ class AvaliacaoDesastre(db.Model):
     data_criacao = db.Column(db.DateTime, default=datetime.utcnow)
     data_atualizacao = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    # Máscaras de bits derivadas dos campos JSON (bit i = i-ésima opção), para estatísticas em massa
+    mascara_grupos = db.Column(db.Integer, nullable=False, default=0)
+    mascara_perdas = db.Column(db.Integer, nullable=False, default=0)
+
+    # Hierarquia administrativa: código da área (freguesia), enviado pelo cliente ou
+    # derivado das coordenadas, e os códigos de região e município derivados dele
+    codigo_area = db.Column(db.String(50))
+    codigo_regiao = db.Column(db.String(50))
+    codigo_municipio = db.Column(db.String(50))
+
+    # Versão da linha, incrementada a cada UPDATE (usada para validar caches)
+    versao = db.Column(db.Integer, nullable=False)
+
+    __mapper_args__ = {'version_id_col': versao}
+
+    __table_args__ = (
+        # Índice de cobertura para as estatísticas agrupadas (evita ler a tabela)
+        db.Index('ix_avaliacoes_categorias', 'nivel_danos', 'tipo_estrutura', 'necessidade_urgente', 'membros_agregado'),
+        db.Index('ix_avaliacoes_mascaras', 'mascara_grupos', 'mascara_perdas'),
+        db.Index('ix_avaliacoes_data_criacao', 'data_criacao'),
+        db.Index('ix_avaliacoes_coordenadas', 'latitude_gps', 'longitude_gps'),
+        db.Index('ix_avaliacoes_codigo_area', 'codigo_area'),
+        db.Index('ix_avaliacoes_codigo_regiao', 'codigo_regiao'),
+        db.Index('ix_avaliacoes_codigo_municipio', 'codigo_municipio'),
+    )
+
     def __repr__(self):
         return f'<AvaliacaoDesastre {self.id} - {self.nome_responsavel}>'
 
@@ -61,9 +93,11 @@ class AvaliacaoDesastre(db.Model):
             'nivel_danos': self.nivel_danos,
             'perdas': json.loads(self.perdas) if self.perdas else [],
             'outras_perdas': self.outras_perdas,
-            'ficheiros_prova': json.loads(self.ficheiros_prova) if self.ficheiros_prova else [],
             'necessidade_urgente': self.necessidade_urgente,
             'outra_necessidade': self.outra_necessidade,
+            'codigo_area': self.codigo_area,
+            'codigo_regiao': self.codigo_regiao,
+            'codigo_municipio': self.codigo_municipio,
             'data_criacao': self.data_criacao.isoformat() if self.data_criacao else None,
             'data_atualizacao': self.data_atualizacao.isoformat() if self.data_atualizacao else None
         }
@@ -85,7 +119,57 @@ class AvaliacaoDesastre(db.Model):
         assessment.nivel_danos = data.get('nivel_danos')
         assessment.perdas = json.dumps(data.get('perdas', []))
         assessment.outras_perdas = data.get('outras_perdas')
-        assessment.ficheiros_prova = json.dumps(data.get('ficheiros_prova', []))
         assessment.necessidade_urgente = data.get('necessidade_urgente')
         assessment.outra_necessidade = data.get('outra_necessidade')
+        assessment.codigo_area = validar_codigo_area(data.get('codigo_area'))
         return assessment
+
+def calcular_mascara(valores_json, opcoes):
+    """Converter uma lista JSON de opções numa máscara de bits
+
+    Valores que não sejam JSON válido (linhas antigas) dão uma máscara vazia.
+    """
+    try:
+        valores = json.loads(valores_json) if valores_json else None
+    except ValueError:
+        return 0
+    if not isinstance(valores, list):
+        return 0
+    mascara = 0
+    for valor in valores:
+        if valor in opcoes:
+            mascara |= 1 << opcoes.index(valor)
+    return mascara
+
+def expandir_mascara(mascara, opcoes):
+    """Converter uma máscara de bits de volta na lista de opções"""
+    return [opcao for i, opcao in enumerate(opcoes) if mascara & (1 << i)]
+
+@event.listens_for(AvaliacaoDesastre, 'before_insert')
+@event.listens_for(AvaliacaoDesastre, 'before_update')
+def atualizar_mascaras(mapper, connection, avaliacao):
+    """Manter as máscaras sincronizadas com grupos_vulneraveis e perdas"""
+    avaliacao.mascara_grupos = calcular_mascara(avaliacao.grupos_vulneraveis, GRUPOS_VULNERAVEIS)
+    avaliacao.mascara_perdas = calcular_mascara(avaliacao.perdas, TIPOS_PERDAS)
+
+@event.listens_for(AvaliacaoDesastre, 'before_insert')
+@event.listens_for(AvaliacaoDesastre, 'before_update')
+def atribuir_area(mapper, connection, avaliacao):
+    """Atribuir o código de área e a hierarquia
+
+    Um código enviado pelo cliente prevalece; caso contrário, com FICHEIRO_AREAS
+    configurado, o código é derivado das coordenadas quando estas mudam.
+    """
+    estado = inspect(avaliacao)
+    indice = indice_areas()
+    if estado.persistent:
+        enviado = estado.attrs.codigo_area.history.has_changes()
+        coordenadas_alteradas = (estado.attrs.latitude_gps.history.has_changes()
+                                 or estado.attrs.longitude_gps.history.has_changes())
+    else:
+        enviado = avaliacao.codigo_area is not None
+        coordenadas_alteradas = True
+    if indice is not None and not enviado and coordenadas_alteradas:
+        avaliacao.codigo_area = indice.localizar(avaliacao.latitude_gps, avaliacao.longitude_gps)
+    for coluna, codigo in hierarquia_area(avaliacao.codigo_area).items():
+        setattr(avaliacao, coluna, codigo)
@@ -0,0 +1,73 @@
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from .user import db
+from .assessment import AvaliacaoDesastre
+
+# Dias de alterações mantidos; consumidores mais atrasados do que isto recarregam tudo
+RETENCAO_ALTERACOES_DIAS = int(os.environ.get('RETENCAO_ALTERACOES_DIAS', 7))
+
+class AlteracaoAvaliacao(db.Model):
+    """Sequência de alterações às avaliações, usada para atualizar estruturas em memória"""
+    __tablename__ = 'alteracoes_avaliacoes'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = db.Column(db.Integer, primary_key=True)                        # Ordem global das alterações
+    avaliacao_id = db.Column(db.Integer, nullable=False, index=True)
+    operacao = db.Column(db.String(1), nullable=False)                   # 'I', 'U' ou 'D'
+    data = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<AlteracaoAvaliacao {self.seq} {self.operacao} {self.avaliacao_id}>'
+
+def _registar(connection, avaliacao, operacao):
+    connection.execute(AlteracaoAvaliacao.__table__.insert().values(
+        avaliacao_id=avaliacao.id, operacao=operacao, data=datetime.utcnow()
+    ))
+
+@event.listens_for(AvaliacaoDesastre, 'after_insert')
+def _registar_insercao(mapper, connection, avaliacao):
+    _registar(connection, avaliacao, 'I')
+
+@event.listens_for(AvaliacaoDesastre, 'after_update')
+def _registar_atualizacao(mapper, connection, avaliacao):
+    _registar(connection, avaliacao, 'U')
+
+@event.listens_for(AvaliacaoDesastre, 'after_delete')
+def _registar_eliminacao(mapper, connection, avaliacao):
+    _registar(connection, avaliacao, 'D')
+
+def ultima_alteracao():
+    return db.session.query(db.func.max(AlteracaoAvaliacao.seq)).scalar() or 0
+
+def alteracoes_desde(seq):
+    """IDs alterados depois de seq e a nova posição na sequência
+
+    Devolve None quando as alterações seguintes a seq já foram podadas; nesse
+    caso o consumidor tem de recarregar tudo.
+    """
+    primeira = db.session.query(db.func.min(AlteracaoAvaliacao.seq)).scalar()
+    if primeira is not None and primeira > seq + 1 and seq > 0:
+        return None
+    linhas = db.session.query(AlteracaoAvaliacao.seq, AlteracaoAvaliacao.avaliacao_id).filter(
+        AlteracaoAvaliacao.seq > seq
+    ).order_by(AlteracaoAvaliacao.seq).all()
+    if not linhas:
+        return set(), seq
+    return {avaliacao_id for _, avaliacao_id in linhas}, linhas[-1][0]
+
+def podar_alteracoes(dias=RETENCAO_ALTERACOES_DIAS):
+    """Apagar alterações antigas, mantendo sempre a última (guarda o número da sequência)
+
+    Tarefa de manutenção (prune_change_log.py ou a thread de recolha), nunca
+    dentro de um pedido; devolve o número de linhas apagadas.
+    """
+    limite = datetime.utcnow() - timedelta(days=dias)
+    ultima = ultima_alteracao()
+    apagadas = AlteracaoAvaliacao.query.filter(
+        AlteracaoAvaliacao.data < limite, AlteracaoAvaliacao.seq < ultima
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return apagadas
@@ -0,0 +1,250 @@
+import re
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .user import db
+from .assessment import AvaliacaoDesastre
+
+# Chave de um objeto do armazém ('.../ab/<sha256>.<ext>'), usada na migração de ficheiros_prova e na recolha
+PADRAO_OBJETO = re.compile(r'(?:^|/)[0-9a-f]{2}/([0-9a-f]{64})\.[a-z0-9]+$')
+
+# Contagem de referências de um objeto cujos ficheiros a recolha está a apagar (a linha sai depois)
+REFERENCIAS_EM_RECOLHA = -1
+
+# Chave de uma versão reduzida ('miniaturas/ab/<sha256>_<tamanho>.<ext>')
+PADRAO_MINIATURA = re.compile(r'(?:^|/)[0-9a-f]{2}/([0-9a-f]{64})_[0-9]+\.[a-z0-9]+$')
+
+class ObjetoProva(db.Model):
+    """Ficheiro de prova no armazém endereçado pelo conteúdo (um por SHA-256)"""
+    __tablename__ = 'objetos_prova'
+
+    sha256 = db.Column(db.String(64), primary_key=True)
+    caminho = db.Column(db.String(200), nullable=False)                 # Relativo à pasta de provas
+    tipo = db.Column(db.String(50), nullable=False)                     # Tipo MIME detetado pelo conteúdo
+    tamanho = db.Column(db.BigInteger, nullable=False)
+    # Com RECOMPRIMIR_PROVAS: sha256 continua a ser o do ficheiro recebido e estes descrevem o guardado
+    sha256_conteudo = db.Column(db.String(64))
+    tamanho_original = db.Column(db.BigInteger)
+    referencias = db.Column(db.Integer, nullable=False, default=0)      # Provas que apontam para o objeto
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    miniaturas = db.relationship('MiniaturaProva', lazy='selectin', order_by='MiniaturaProva.tamanho')
+
+    def __repr__(self):
+        return f'<ObjetoProva {self.sha256[:12]} {self.referencias}>'
+
+    @property
+    def etag(self):
+        """Hash dos bytes servidos (difere de sha256 se a imagem foi recomprimida)"""
+        return self.sha256_conteudo or self.sha256
+
+class MiniaturaProva(db.Model):
+    """Versão reduzida de uma imagem do armazém (gerada em segundo plano)"""
+    __tablename__ = 'miniaturas_prova'
+
+    sha256 = db.Column(db.String(64), db.ForeignKey('objetos_prova.sha256'), primary_key=True)
+    tamanho = db.Column(db.Integer, primary_key=True)                   # Lado maior pedido (píxeis)
+    tipo = db.Column(db.String(50), primary_key=True)                   # image/webp ou image/jpeg
+    caminho = db.Column(db.String(200), nullable=False)                 # Relativo à pasta de provas
+    largura = db.Column(db.Integer, nullable=False)
+    altura = db.Column(db.Integer, nullable=False)
+    bytes = db.Column(db.Integer, nullable=False)
+
+    def to_dict(self, pasta):
+        return {
+            'tamanho': self.tamanho,
+            'tipo': self.tipo,
+            'caminho': f'{pasta}/{self.caminho}',
+            'largura': self.largura,
+            'altura': self.altura,
+            'bytes': self.bytes
+        }
+
+class ProvaAvaliacao(db.Model):
+    """Ficheiro de prova associado a uma avaliação (uma linha por carregamento)"""
+    __tablename__ = 'provas_avaliacao'
+
+    id = db.Column(db.Integer, primary_key=True)
+    avaliacao_id = db.Column(db.Integer, db.ForeignKey('avaliacoes_desastre.id', ondelete='CASCADE'), nullable=False)
+    sha256 = db.Column(db.String(64), db.ForeignKey('objetos_prova.sha256'), nullable=False)
+    tipo = db.Column(db.String(50), nullable=False)
+    tamanho = db.Column(db.BigInteger, nullable=False)
+    largura = db.Column(db.Integer)                                     # Só imagens
+    altura = db.Column(db.Integer)
+    nome_original = db.Column(db.String(255))
+    data_criacao = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    objeto = db.relationship(ObjetoProva, lazy='joined')
+
+    __table_args__ = (
+        # O mesmo conteúdo só conta uma vez por avaliação
+        db.UniqueConstraint('avaliacao_id', 'sha256', name='uq_provas_avaliacao_sha256'),
+        # Listagem paginada das provas de uma avaliação, por ordem de carregamento
+        db.Index('ix_provas_avaliacao_avaliacao_id', 'avaliacao_id', 'id'),
+        # Provas de um objeto em todas as avaliações (semelhantes, recolha)
+        db.Index('ix_provas_avaliacao_sha256', 'sha256'),
+    )
+
+    def __repr__(self):
+        return f'<ProvaAvaliacao {self.id} {self.avaliacao_id} {self.sha256[:12]}>'
+
+    def to_dict(self, pasta):
+        return {
+            'id': self.id,
+            'avaliacao_id': self.avaliacao_id,
+            'caminho': f'{pasta}/{self.objeto.caminho}',
+            'sha256': self.sha256,
+            'tipo': self.tipo,
+            'tamanho': self.tamanho,
+            'tamanho_original': self.objeto.tamanho_original,
+            'largura': self.largura,
+            'altura': self.altura,
+            'nome_original': self.nome_original,
+            'miniaturas': [miniatura.to_dict(pasta) for miniatura in self.objeto.miniaturas],
+            'data_criacao': self.data_criacao.isoformat() if self.data_criacao else None
+        }
+
+    def escolher_miniatura(self, tamanho, tipos):
+        """A menor versão com pelo menos tamanho píxeis (ou a maior), no primeiro tipo aceite"""
+        for tipo in tipos:
+            candidatas = [m for m in self.objeto.miniaturas if m.tipo == tipo]
+            if candidatas:
+                maiores = [m for m in candidatas if max(m.largura, m.altura) >= tamanho]
+                return min(maiores, key=lambda m: m.tamanho) if maiores else candidatas[-1]
+        return None
+
+class HashPerceptual(db.Model):
+    """Hash perceptual (pHash de 64 bits) de uma imagem do armazém, calculado com as miniaturas"""
+    __tablename__ = 'hashes_perceptuais'
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    seq = db.Column(db.Integer, primary_key=True)                        # O índice em memória lê só as linhas novas
+    sha256 = db.Column(db.String(64), db.ForeignKey('objetos_prova.sha256'), nullable=False, unique=True)
+    valor = db.Column(db.String(16), nullable=False)                     # Hexadecimal
+
+    def __repr__(self):
+        return f'<HashPerceptual {self.sha256[:12]} {self.valor}>'
+
+class ObjetoRecolhido(Exception):
+    """O objeto foi (ou está a ser) apagado pela recolha enquanto era carregado de novo"""
+
+def registar_objetos(gravados):
+    """Criar (se ainda não existirem) as linhas dos objetos acabados de guardar
+
+    Devolve os sha256 das linhas criadas agora.
+    """
+    agora = datetime.utcnow()
+    criados = set()
+    for f in gravados:
+        resultado = db.session.execute(
+            sqlite_insert(ObjetoProva.__table__).values(
+                sha256=f['sha256'], caminho=f['nome'], tipo=f['tipo'],
+                tamanho=f['tamanho'], sha256_conteudo=f.get('sha256_conteudo'),
+                tamanho_original=f.get('tamanho_original'), referencias=0, data_criacao=agora
+            ).on_conflict_do_nothing()
+        )
+        if resultado.rowcount:
+            criados.add(f['sha256'])
+    return criados
+
+def verificar_objetos(gravados, criados, armazenamento=None):
+    """ObjetoRecolhido se algum objeto estiver marcado pela recolha ou, tendo a linha
+    sido criada agora para um ficheiro que já existia (novo=False), o ficheiro já
+    não estiver no armazenamento. Corre depois dos INSERT, com a escrita bloqueada."""
+    objetos = ObjetoProva.__table__
+    referencias = dict(db.session.execute(
+        db.select(objetos.c.sha256, objetos.c.referencias)
+        .where(objetos.c.sha256.in_([f['sha256'] for f in gravados]))
+    ).all())
+    for f in gravados:
+        if referencias.get(f['sha256'], 0) == REFERENCIAS_EM_RECOLHA:
+            raise ObjetoRecolhido(f['sha256'])
+        if (armazenamento is not None and f['sha256'] in criados and not f.get('novo', True)
+                and armazenamento.tamanho(f['nome']) is None):
+            raise ObjetoRecolhido(f['sha256'])
+
+def descrever_objeto_existente(sha256, nome_original):
+    """Descrição (no formato dos carregamentos) de um objeto já no armazém, ou None"""
+    objeto = db.session.get(ObjetoProva, sha256)
+    if objeto is None:
+        return None
+    # As dimensões estão nas provas; qualquer prova do mesmo conteúdo serve
+    prova = ProvaAvaliacao.query.filter_by(sha256=sha256).first()
+    return {
+        'nome': objeto.caminho,
+        'nome_original': nome_original,
+        'tamanho': objeto.tamanho,
+        'tamanho_original': objeto.tamanho_original,
+        'sha256': sha256,
+        'tipo': objeto.tipo,
+        'largura': prova.largura if prova else None,
+        'altura': prova.altura if prova else None,
+        'novo': False
+    }
+
+def registar_provas(avaliacao_id, gravados, armazenamento=None):
+    """Associar os objetos guardados à avaliação: um INSERT por ficheiro, sem ler nem
+    reescrever a linha da avaliação. Devolve as provas, pela ordem de gravados.
+
+    Com armazenamento, confirma que os ficheiros reutilizados ainda existem
+    (ver verificar_objetos); sem ele só recusa objetos marcados pela recolha.
+    """
+    criados = registar_objetos(gravados)
+    verificar_objetos(gravados, criados, armazenamento)
+    tabela = ProvaAvaliacao.__table__
+    objetos = ObjetoProva.__table__
+    agora = datetime.utcnow()
+    for f in gravados:
+        resultado = db.session.execute(
+            sqlite_insert(tabela).values(
+                avaliacao_id=avaliacao_id, sha256=f['sha256'], tipo=f['tipo'], tamanho=f['tamanho'],
+                largura=f.get('largura'), altura=f.get('altura'),
+                nome_original=f.get('nome_original'), data_criacao=agora
+            ).on_conflict_do_nothing(index_elements=['avaliacao_id', 'sha256'])
+        )
+        if resultado.rowcount:
+            db.session.execute(
+                objetos.update().where(objetos.c.sha256 == f['sha256'])
+                .values(referencias=objetos.c.referencias + 1)
+            )
+    provas = {p.sha256: p for p in ProvaAvaliacao.query.filter(
+        ProvaAvaliacao.avaliacao_id == avaliacao_id,
+        ProvaAvaliacao.sha256.in_([f['sha256'] for f in gravados])
+    )}
+    return [provas[f['sha256']] for f in gravados]
+
+def registar_miniaturas(sha256, miniaturas, hash_perceptual=None):
+    """Gravar as versões reduzidas e o hash perceptual gerados para um objeto"""
+    if miniaturas:
+        db.session.execute(
+            sqlite_insert(MiniaturaProva.__table__).on_conflict_do_nothing(),
+            [dict(m, sha256=sha256) for m in miniaturas]
+        )
+    if hash_perceptual is not None:
+        db.session.execute(
+            sqlite_insert(HashPerceptual.__table__).values(sha256=sha256, valor=hash_perceptual)
+            .on_conflict_do_nothing(index_elements=['sha256'])
+        )
+    db.session.commit()
+
+@event.listens_for(AvaliacaoDesastre, 'after_delete')
+def _eliminar_provas(mapper, connection, avaliacao):
+    """Apagar as provas da avaliação e libertar as referências aos objetos"""
+    tabela = ProvaAvaliacao.__table__
+    objetos = ObjetoProva.__table__
+    connection.execute(
+        objetos.update().where(objetos.c.sha256.in_(
+            db.select(tabela.c.sha256).where(tabela.c.avaliacao_id == avaliacao.id)
+        )).values(referencias=objetos.c.referencias - 1)
+    )
+    connection.execute(tabela.delete().where(tabela.c.avaliacao_id == avaliacao.id))
+
+def reconstruir_referencias():
+    """Recalcular todas as contagens a partir de provas_avaliacao"""
+    tabela = ProvaAvaliacao.__table__
+    objetos = ObjetoProva.__table__
+    contagem = db.select(db.func.count()).where(tabela.c.sha256 == objetos.c.sha256).scalar_subquery()
+    db.session.execute(objetos.update().values(referencias=contagem))
+    db.session.commit()
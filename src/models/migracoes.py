@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+from sqlalchemy import inspect, text
+
+from .user import db
+from .assessment import AvaliacaoDesastre, GRUPOS_VULNERAVEIS, TIPOS_PERDAS, calcular_mascara
+from .evidence import registar_provas, reconstruir_referencias
+from src.services.areas import hierarquia_area, indice_areas
+from src.services.armazenamento import armazenamento_provas
+from src.services.evidence import BYTES_ASSINATURA, PASTA_UPLOAD, detetar_tipo, guardar_objeto
+
+# Colunas acrescentadas a tabelas que já existiam: (tabela, coluna, definição SQL)
+# O create_all só cria tabelas em falta; estas colunas são adicionadas com ALTER TABLE
+COLUNAS_ADICIONADAS = [
+    ('avaliacoes_desastre', 'versao', 'INTEGER NOT NULL DEFAULT 1'),
+    ('avaliacoes_desastre', 'mascara_grupos', 'INTEGER NOT NULL DEFAULT 0'),
+    ('avaliacoes_desastre', 'mascara_perdas', 'INTEGER NOT NULL DEFAULT 0'),
+    ('avaliacoes_desastre', 'codigo_area', 'VARCHAR(50)'),
+    ('avaliacoes_desastre', 'codigo_regiao', 'VARCHAR(50)'),
+    ('avaliacoes_desastre', 'codigo_municipio', 'VARCHAR(50)'),
+    ('objetos_prova', 'sha256_conteudo', 'VARCHAR(64)'),
+    ('objetos_prova', 'tamanho_original', 'BIGINT'),
+]
+
+# Linhas lidas e atualizadas de cada vez nos preenchimentos
+LOTE_MIGRACAO = 1000
+
+
+def _lotes(*colunas):
+    """Lotes de (id, ...) das avaliações, por ordem de id"""
+    tabela = AvaliacaoDesastre.__table__
+    ultimo_id = 0
+    while True:
+        linhas = db.session.execute(
+            db.select(tabela.c.id, *colunas).where(tabela.c.id > ultimo_id)
+            .order_by(tabela.c.id).limit(LOTE_MIGRACAO)
+        ).all()
+        if not linhas:
+            return
+        ultimo_id = linhas[-1][0]
+        yield linhas
+
+
+def _atualizar(valores):
+    """UPDATE por id sem passar pelos eventos do ORM (não muda a versão nem o registo de alterações)"""
+    if valores:
+        tabela = AvaliacaoDesastre.__table__
+        db.session.execute(
+            tabela.update().where(tabela.c.id == db.bindparam('b_id')),
+            valores
+        )
+
+
+def preencher_mascaras():
+    tabela = AvaliacaoDesastre.__table__
+    for linhas in _lotes(tabela.c.grupos_vulneraveis, tabela.c.perdas):
+        _atualizar([{
+            'b_id': avaliacao_id,
+            'mascara_grupos': calcular_mascara(grupos, GRUPOS_VULNERAVEIS),
+            'mascara_perdas': calcular_mascara(perdas, TIPOS_PERDAS)
+        } for avaliacao_id, grupos, perdas in linhas])
+
+
+def preencher_areas(localizar):
+    """Códigos de área (das coordenadas, se localizar e houver FICHEIRO_AREAS) e a hierarquia"""
+    tabela = AvaliacaoDesastre.__table__
+    indice = indice_areas() if localizar else None
+    for linhas in _lotes(tabela.c.latitude_gps, tabela.c.longitude_gps, tabela.c.codigo_area):
+        codigos = [codigo for _, _, _, codigo in linhas]
+        if indice is not None:
+            pendentes = [i for i, linha in enumerate(linhas)
+                         if linha[3] is None and linha[1] is not None and linha[2] is not None]
+            if pendentes:
+                encontrados = indice.localizar_lote([linhas[i][1] for i in pendentes],
+                                                    [linhas[i][2] for i in pendentes])
+                for i, encontrado in zip(pendentes, encontrados.tolist()):
+                    if encontrado >= 0:
+                        codigos[i] = indice.codigos[encontrado]
+        _atualizar([
+            {'b_id': linha[0], 'codigo_area': codigo, **hierarquia_area(codigo)}
+            for linha, codigo in zip(linhas, codigos) if codigo is not None
+        ])
+
+
+def _guardar_prova_antiga(armazenamento, caminho):
+    """Entrada do armazém para um ficheiro antigo (já lá guardado ou não); None se o conteúdo for desconhecido"""
+    with open(caminho, 'rb') as ficheiro:
+        tipo = detetar_tipo(ficheiro.read(BYTES_ASSINATURA))
+        if tipo is None:
+            return None
+        ficheiro.seek(0)
+        verificacao = hashlib.sha256()
+        for bloco in iter(lambda: ficheiro.read(1024 * 1024), b''):
+            verificacao.update(bloco)
+    # O armazém consome uma segunda ligação ao ficheiro; só é copiado entre sistemas de ficheiros
+    temporario = os.path.join(armazenamento.pasta_temporaria, f'.{uuid.uuid4().hex}.parcial')
+    try:
+        os.link(caminho, temporario)
+    except OSError:
+        shutil.copyfile(caminho, temporario)
+    nome_original = os.path.basename(caminho).split('_', 1)[-1]
+    return guardar_objeto(armazenamento, temporario, verificacao.hexdigest(), tipo,
+                          os.path.getsize(caminho), nome_original)
+
+
+def migrar_provas_antigas(pasta_estatica, lote=LOTE_MIGRACAO, relatar=None):
+    """Passar as provas da coluna antiga ficheiros_prova para o armazém e provas_avaliacao
+
+    Cada ficheiro listado (dentro de pasta_estatica) é guardado pelo seu SHA-256 e
+    registado como uma prova; ficheiros iguais ficam num só objeto. Os ficheiros
+    antigos ({avaliacao_id}_{nome}) são apagados depois de o lote ser confirmado e a
+    coluna fica a NULL, por isso pode ser repetida. No fim recalcula as referências.
+    Devolve as contagens {'migrated', 'missing', 'skipped'}.
+    """
+    totais = {'migrated': 0, 'missing': 0, 'skipped': 0}
+    colunas = {coluna['name'] for coluna in inspect(db.engine).get_columns('avaliacoes_desastre')}
+    if 'ficheiros_prova' not in colunas:
+        return totais
+
+    armazenamento = armazenamento_provas()
+    ultimo_id = 0
+    while True:
+        linhas = db.session.execute(text(
+            "SELECT id, ficheiros_prova FROM avaliacoes_desastre "
+            "WHERE id > :ultimo AND ficheiros_prova IS NOT NULL ORDER BY id LIMIT :lote"
+        ), {'ultimo': ultimo_id, 'lote': lote}).all()
+        if not linhas:
+            break
+        ultimo_id = linhas[-1][0]
+
+        antigos = []
+        for avaliacao_id, ficheiros in linhas:
+            try:
+                caminhos = json.loads(ficheiros) if ficheiros else []
+            except ValueError:
+                # JSON antigo ilegível: os ficheiros que listava não são recuperáveis
+                totais['missing'] += 1
+                continue
+            for caminho in caminhos if isinstance(caminhos, list) else []:
+                origem = os.path.join(pasta_estatica, caminho) if isinstance(caminho, str) else None
+                if origem is None or not caminho.startswith(f'{PASTA_UPLOAD}/') or not os.path.isfile(origem):
+                    totais['missing'] += 1
+                    continue
+                gravado = _guardar_prova_antiga(armazenamento, origem)
+                if gravado is None:
+                    totais['skipped'] += 1
+                    continue
+                registar_provas(avaliacao_id, [gravado], armazenamento)
+                # A não ser que o ficheiro seja o próprio objeto (armazém local dentro de static/)
+                if armazenamento.diretos or \
+                        os.path.realpath(origem) != os.path.realpath(armazenamento.caminho(gravado['nome'])):
+                    antigos.append(origem)
+                totais['migrated'] += 1
+
+        db.session.execute(text(
+            "UPDATE avaliacoes_desastre SET ficheiros_prova = NULL WHERE id IN :ids"
+        ).bindparams(db.bindparam('ids', expanding=True)), {'ids': [linha[0] for linha in linhas]})
+        db.session.commit()
+
+        for caminho in antigos:
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+        if relatar is not None:
+            relatar(ultimo_id, totais)
+
+    reconstruir_referencias()
+    return totais
+
+
+def aplicar_migracoes(pasta_estatica=None):
+    """Trazer uma base de dados anterior para o esquema atual sem perder dados
+
+    Corre a seguir ao create_all, no arranque: acrescenta as colunas em falta com
+    os seus valores por omissão, cria os índices em falta e preenche as colunas
+    derivadas (máscaras e códigos de área) das linhas existentes. Com pasta_estatica,
+    passa também para o armazém as provas que ainda estejam na coluna ficheiros_prova.
+    Idempotente: numa base de dados já atualizada não faz nada.
+    """
+    inspetor = inspect(db.engine)
+    tabelas = set(inspetor.get_table_names())
+    existentes = {tabela: {coluna['name'] for coluna in inspetor.get_columns(tabela)} for tabela in tabelas}
+
+    adicionadas = set()
+    for tabela, coluna, definicao in COLUNAS_ADICIONADAS:
+        if tabela in tabelas and coluna not in existentes[tabela]:
+            db.session.execute(text(f'ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}'))
+            adicionadas.add((tabela, coluna))
+    db.session.commit()
+
+    for tabela in db.metadata.sorted_tables:
+        for indice in tabela.indexes:
+            indice.create(db.engine, checkfirst=True)
+
+    if ('avaliacoes_desastre', 'mascara_grupos') in adicionadas or \
+            ('avaliacoes_desastre', 'mascara_perdas') in adicionadas:
+        preencher_mascaras()
+    if ('avaliacoes_desastre', 'codigo_area') in adicionadas:
+        preencher_areas(localizar=True)
+    elif ('avaliacoes_desastre', 'codigo_municipio') in adicionadas:
+        preencher_areas(localizar=False)
+    db.session.commit()
+
+    if pasta_estatica is not None and 'ficheiros_prova' in existentes.get('avaliacoes_desastre', ()):
+        migrar_provas_antigas(pasta_estatica)
+    return sorted(adicionadas)
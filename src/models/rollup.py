@@ -0,0 +1,193 @@
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .user import db
+from .assessment import AvaliacaoDesastre
+from src.services.areas import NIVEIS_AREA
+
+class RollupHorario(db.Model):
+    """Contagens de avaliações por hora de criação, mantidas incrementalmente a cada escrita"""
+    __tablename__ = 'rollup_avaliacoes_hora'
+
+    hora = db.Column(db.DateTime, primary_key=True)                     # Início da hora (data_criacao truncada)
+    nivel_danos = db.Column(db.String(20), primary_key=True)
+    tipo_estrutura = db.Column(db.String(50), primary_key=True)
+    necessidade_urgente = db.Column(db.String(50), primary_key=True)
+    contagem = db.Column(db.Integer, nullable=False, default=0)         # Agregados familiares
+    pessoas = db.Column(db.Integer, nullable=False, default=0)          # Soma de membros_agregado
+
+    def __repr__(self):
+        return f'<RollupHorario {self.hora} {self.nivel_danos} {self.contagem}>'
+
+class RollupArea(db.Model):
+    """Contagens por área administrativa (cada nível da hierarquia) e necessidade urgente"""
+    __tablename__ = 'rollup_avaliacoes_area'
+
+    nivel = db.Column(db.String(20), primary_key=True)                  # region, municipality ou parish
+    codigo = db.Column(db.String(50), primary_key=True)
+    necessidade_urgente = db.Column(db.String(50), primary_key=True)
+    codigo_pai = db.Column(db.String(50), index=True)                   # Área do nível acima
+    contagem = db.Column(db.Integer, nullable=False, default=0)         # Agregados familiares
+    pessoas = db.Column(db.Integer, nullable=False, default=0)          # Soma de membros_agregado
+
+    def __repr__(self):
+        return f'<RollupArea {self.nivel} {self.codigo} {self.contagem}>'
+
+def truncar_hora(data):
+    return data.replace(minute=0, second=0, microsecond=0) if data is not None else None
+
+def _valor(avaliacao, campo, anterior=False):
+    """Valor do campo (antes do UPDATE se anterior=True)"""
+    if anterior:
+        historico = inspect(avaliacao).attrs[campo].history
+        if historico.deleted:
+            return historico.deleted[0]
+    return getattr(avaliacao, campo)
+
+def _chave_rollup(avaliacao, anterior=False):
+    """Chave e pessoas da avaliação (valores antes do UPDATE se anterior=True)"""
+    chave = (
+        truncar_hora(_valor(avaliacao, 'data_criacao', anterior)),
+        _valor(avaliacao, 'nivel_danos', anterior),
+        _valor(avaliacao, 'tipo_estrutura', anterior),
+        _valor(avaliacao, 'necessidade_urgente', anterior)
+    )
+    return chave, _valor(avaliacao, 'membros_agregado', anterior) or 0
+
+def _chaves_area(avaliacao, anterior=False):
+    """Chaves (nivel, codigo, necessidade, codigo_pai) da avaliação em cada nível com código"""
+    necessidade = _valor(avaliacao, 'necessidade_urgente', anterior)
+    chaves = []
+    pai = None
+    for nivel, coluna in NIVEIS_AREA.items():
+        codigo = _valor(avaliacao, coluna, anterior)
+        if codigo is None:
+            break
+        chaves.append((nivel, codigo, necessidade, pai))
+        pai = codigo
+    return chaves
+
+def _ajustar_rollup(connection, chave, contagem, pessoas):
+    tabela = RollupHorario.__table__
+    hora, nivel_danos, tipo_estrutura, necessidade_urgente = chave
+    # Sem data de criação a avaliação não entra no rollup (tal como na reconstrução)
+    if hora is None:
+        return
+    instrucao = sqlite_insert(tabela).values(
+        hora=hora, nivel_danos=nivel_danos, tipo_estrutura=tipo_estrutura,
+        necessidade_urgente=necessidade_urgente, contagem=contagem, pessoas=pessoas
+    )
+    instrucao = instrucao.on_conflict_do_update(
+        index_elements=[tabela.c.hora, tabela.c.nivel_danos, tabela.c.tipo_estrutura, tabela.c.necessidade_urgente],
+        set_={
+            'contagem': tabela.c.contagem + instrucao.excluded.contagem,
+            'pessoas': tabela.c.pessoas + instrucao.excluded.pessoas
+        }
+    )
+    connection.execute(instrucao)
+
+def _ajustar_rollup_area(connection, chave, contagem, pessoas):
+    tabela = RollupArea.__table__
+    nivel, codigo, necessidade_urgente, codigo_pai = chave
+    instrucao = sqlite_insert(tabela).values(
+        nivel=nivel, codigo=codigo, necessidade_urgente=necessidade_urgente,
+        codigo_pai=codigo_pai, contagem=contagem, pessoas=pessoas
+    )
+    instrucao = instrucao.on_conflict_do_update(
+        index_elements=[tabela.c.nivel, tabela.c.codigo, tabela.c.necessidade_urgente],
+        set_={
+            'contagem': tabela.c.contagem + instrucao.excluded.contagem,
+            'pessoas': tabela.c.pessoas + instrucao.excluded.pessoas
+        }
+    )
+    connection.execute(instrucao)
+
+# Os rollups são atualizados na mesma transação que a escrita da avaliação
+
+@event.listens_for(AvaliacaoDesastre, 'after_insert')
+def _rollup_apos_inserir(mapper, connection, avaliacao):
+    chave, pessoas = _chave_rollup(avaliacao)
+    _ajustar_rollup(connection, chave, 1, pessoas)
+    for chave in _chaves_area(avaliacao):
+        _ajustar_rollup_area(connection, chave, 1, pessoas)
+
+@event.listens_for(AvaliacaoDesastre, 'after_update')
+def _rollup_apos_atualizar(mapper, connection, avaliacao):
+    chave_anterior, pessoas_anteriores = _chave_rollup(avaliacao, anterior=True)
+    chave, pessoas = _chave_rollup(avaliacao)
+    if chave != chave_anterior or pessoas != pessoas_anteriores:
+        _ajustar_rollup(connection, chave_anterior, -1, -pessoas_anteriores)
+        _ajustar_rollup(connection, chave, 1, pessoas)
+
+    chaves_anteriores = _chaves_area(avaliacao, anterior=True)
+    chaves = _chaves_area(avaliacao)
+    if chaves != chaves_anteriores or pessoas != pessoas_anteriores:
+        for chave in chaves_anteriores:
+            _ajustar_rollup_area(connection, chave, -1, -pessoas_anteriores)
+        for chave in chaves:
+            _ajustar_rollup_area(connection, chave, 1, pessoas)
+
+@event.listens_for(AvaliacaoDesastre, 'after_delete')
+def _rollup_apos_eliminar(mapper, connection, avaliacao):
+    chave, pessoas = _chave_rollup(avaliacao, anterior=True)
+    _ajustar_rollup(connection, chave, -1, -pessoas)
+    for chave in _chaves_area(avaliacao, anterior=True):
+        _ajustar_rollup_area(connection, chave, -1, -pessoas)
+
+def reconstruir_rollup_horario():
+    """Recalcular o rollup horário a partir de todas as avaliações"""
+    hora = db.func.strftime('%Y-%m-%d %H:00:00.000000', AvaliacaoDesastre.data_criacao)
+    origem = db.session.query(
+        hora,
+        AvaliacaoDesastre.nivel_danos,
+        AvaliacaoDesastre.tipo_estrutura,
+        AvaliacaoDesastre.necessidade_urgente,
+        db.func.count(AvaliacaoDesastre.id),
+        db.func.coalesce(db.func.sum(AvaliacaoDesastre.membros_agregado), 0)
+    ).filter(AvaliacaoDesastre.data_criacao.isnot(None)).group_by(
+        hora,
+        AvaliacaoDesastre.nivel_danos,
+        AvaliacaoDesastre.tipo_estrutura,
+        AvaliacaoDesastre.necessidade_urgente
+    )
+    tabela = RollupHorario.__table__
+    db.session.execute(tabela.delete())
+    db.session.execute(tabela.insert().from_select(
+        ['hora', 'nivel_danos', 'tipo_estrutura', 'necessidade_urgente', 'contagem', 'pessoas'],
+        origem
+    ))
+    db.session.commit()
+
+def reconstruir_rollup_areas():
+    """Recalcular o rollup por área a partir de todas as avaliações"""
+    tabela = RollupArea.__table__
+    db.session.execute(tabela.delete())
+    pai = None
+    for nivel, coluna in NIVEIS_AREA.items():
+        codigo = getattr(AvaliacaoDesastre, coluna)
+        codigo_pai = db.literal(None) if pai is None else pai
+        origem = db.session.query(
+            db.literal(nivel),
+            codigo,
+            AvaliacaoDesastre.necessidade_urgente,
+            codigo_pai,
+            db.func.count(AvaliacaoDesastre.id),
+            db.func.coalesce(db.func.sum(AvaliacaoDesastre.membros_agregado), 0)
+        ).filter(codigo.isnot(None)).group_by(codigo, AvaliacaoDesastre.necessidade_urgente)
+        db.session.execute(tabela.insert().from_select(
+            ['nivel', 'codigo', 'necessidade_urgente', 'codigo_pai', 'contagem', 'pessoas'],
+            origem
+        ))
+        pai = codigo
+    db.session.commit()
+
+def inicializar_rollups():
+    """Preencher os rollups vazios quando já existem avaliações (ex.: base de dados anterior)"""
+    if AvaliacaoDesastre.query.first() is None:
+        return
+    if RollupHorario.query.first() is None:
+        reconstruir_rollup_horario()
+    if RollupArea.query.first() is None and AvaliacaoDesastre.query.filter(
+        AvaliacaoDesastre.codigo_area.isnot(None)
+    ).first() is not None:
+        reconstruir_rollup_areas()
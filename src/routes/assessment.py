@@ -50,7 +50,7 @@ def update_assessment(id):
         for attr in ['nome_responsavel', 'numero_documento', 'contacto_telefonico', 'membros_agregado',
                      'grupos_vulneraveis', 'endereco_completo', 'ponto_referencia', 'latitude_gps', 
                      'longitude_gps', 'tipo_estrutura', 'nivel_danos', 'perdas', 'outras_perdas',
-                     'ficheiros_prova', 'necessidade_urgente', 'outra_necessidade']:
+                     'necessidade_urgente', 'outra_necessidade']:
             if hasattr(updated_avaliacao, attr):
                 setattr(avaliacao, attr, getattr(updated_avaliacao, attr))
         
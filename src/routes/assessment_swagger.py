@@ -1,26 +1,134 @@
-from flask import request
+from flask import current_app, request, url_for
 from flask_restx import Namespace, Resource, fields
 from src.models.user import db
-from src.models.assessment import AvaliacaoDesastre
+from src.models.evidence import (
+    HashPerceptual, ObjetoRecolhido, ProvaAvaliacao, descrever_objeto_existente, registar_miniaturas, registar_provas
+)
+from src.models.assessment import (
+    AvaliacaoDesastre, GRUPOS_VULNERAVEIS, TIPOS_ESTRUTURA, NIVEIS_DANOS, TIPOS_PERDAS, NECESSIDADES_URGENTES
+)
 from src.routes.auth import token_obrigatorio
+from src.services.serialization import ler_payload
+from src.services.cache import cache_avaliacoes
+from src.services.coalescing import coalescer, pedidos_partilhados
+from src.services.filters import extrair_filtros, aplicar_filtros
+from src.services.statistics import (
+    DIMENSOES_CUBO, MEDIDAS_CUBO, BUCKETS_TEMPORAIS, ler_lista, calcular_cubo, calcular_estatisticas,
+    calcular_multivalor, calcular_serie_temporal, calcular_agregados,
+    PESOS_GRELHA, calcular_grelha, calcular_areas
+)
+from src.services.areas import NIVEIS_AREA
+from src.services.sketches import sketches_avaliacoes
+from src.services.spatial import indice_clusters, indice_vizinhos
+from src.services.thumbnails import TAMANHOS_MINIATURA, disponivel as miniaturas_disponiveis, gerador_miniaturas
+from src.services.recompressao import disponivel as recompressao_disponivel, recompressor_provas
+from src.services.semelhanca import MAX_DISTANCIA_SEMELHANCA, disponivel as semelhanca_disponivel, indice_semelhanca
+from src.services.armazenamento import armazenamento_provas
+from src.services.evidence import (
+    LIMITE_PEDIDO_PROVAS_BYTES, PASTA_UPLOAD, TIPOS_PROVA, VERSAO_TUS, ErroProva, CarregamentoRetomavel,
+    confirmar_carregamento_direto, ler_metadados_tus, receber_ficheiros, validar_carregamento_direto
+)
+import json
 import os
-from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException
 
 # Criar namespace para avaliações de desastres
 api = Namespace('avaliacoes', description='Operações de Avaliação de Desastres')
 
 # Configuração para carregamento de ficheiros
-PASTA_UPLOAD = 'uploads/evidence'
-EXTENSOES_PERMITIDAS = {'png', 'jpg', 'jpeg', 'gif', 'mp4', 'mov', 'avi'}
+EXTENSOES_PERMITIDAS = set(TIPOS_PROVA)
 
-def ficheiro_permitido(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in EXTENSOES_PERMITIDAS
+# Pasta dos carregamentos retomáveis em curso. Com vários nós tem de ser partilhada
+# (NFS ou semelhante, com flock) para que HEAD e PATCH funcionem em qualquer nó; com
+# a pasta local de cada nó o balanceador tem de encaminhar cada carregamento sempre
+# para o mesmo nó (sticky routing pelo URL do carregamento)
+PASTA_CARREGAMENTOS_PARCIAIS = os.environ.get('PASTA_CARREGAMENTOS_PARCIAIS') or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'uploads_parciais'
+)
 
-def garantir_pasta_upload():
-    """Garantir que a pasta de upload existe"""
-    caminho_upload = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'static', PASTA_UPLOAD)
-    os.makedirs(caminho_upload, exist_ok=True)
-    return caminho_upload
+def garantir_pasta_parciais():
+    """Pasta dos carregamentos retomáveis em curso (fora de static: não é servida)"""
+    caminho = PASTA_CARREGAMENTOS_PARCIAIS
+    os.makedirs(caminho, exist_ok=True)
+    return caminho
+
+def verificar_avaliacao(assessment_id):
+    """404 se a avaliação não existir (lê só o ID: as provas não tocam na linha da avaliação)"""
+    if db.session.query(AvaliacaoDesastre.id).filter_by(id=assessment_id).scalar() is None:
+        api.abort(404, 'Avaliação não encontrada')
+
+def agendar_miniaturas(gravados):
+    """Pedir em segundo plano as miniaturas dos objetos acabados de guardar"""
+    app = current_app._get_current_object()
+
+    def concluido(sha256, resultado):
+        if isinstance(resultado, BaseException):
+            app.logger.warning('Falha ao gerar miniaturas de %s: %s', sha256, resultado)
+            return
+        miniaturas, hash_imagem = resultado
+        with app.app_context():
+            registar_miniaturas(sha256, miniaturas, hash_imagem)
+
+    for ficheiro in gravados:
+        # Um objeto já existente já tem (ou está a gerar) as suas miniaturas
+        if ficheiro['novo']:
+            gerador_miniaturas.agendar(ficheiro['nome'], ficheiro['sha256'], ficheiro['tipo'], concluido)
+
+def recomprimir_gravados(gravados):
+    """Trocar as imagens novas pela versão recomprimida (RECOMPRIMIR_PROVAS)
+
+    A troca é feita antes de registar, por isso o URL de uma prova serve sempre os
+    mesmos bytes; o original recebido fica em chave_original até ao commit.
+    """
+    if not recompressao_disponivel():
+        return
+    pendentes = []
+    for ficheiro in gravados:
+        if not ficheiro['novo']:
+            continue
+        # O mesmo original já foi recomprimido antes: reaproveitar a versão guardada
+        existente = descrever_objeto_existente(ficheiro['sha256'], ficheiro['nome_original'])
+        if existente is not None and existente['tamanho_original'] is not None:
+            ficheiro.update(existente, chave_original=ficheiro['nome'])
+        else:
+            pendentes.append(ficheiro)
+    for ficheiro, resultado in zip(pendentes, recompressor_provas.recomprimir(pendentes)):
+        if isinstance(resultado, BaseException):
+            current_app.logger.warning('Falha ao recomprimir %s: %s', ficheiro['sha256'], resultado)
+        elif resultado is not None:
+            ficheiro.update(resultado, chave_original=ficheiro['nome'])
+
+def registar_gravados(assessment_id, gravados):
+    """Recomprimir, associar à avaliação e pedir as miniaturas dos ficheiros guardados
+
+    Devolve (provas, bytes poupados pela recompressão).
+    """
+    recomprimir_gravados(gravados)
+    armazenamento = armazenamento_provas()
+    try:
+        provas = registar_provas(assessment_id, gravados, armazenamento)
+    except ObjetoRecolhido:
+        db.session.rollback()
+        raise ErroProva('Um dos ficheiros estava a ser removido do armazém; envie-o novamente', 409)
+    db.session.commit()
+
+    # Os originais só saem se o objeto registado for mesmo a versão recomprimida
+    poupados = 0
+    for ficheiro, prova in zip(gravados, provas):
+        if 'chave_original' in ficheiro and prova.objeto.caminho == ficheiro['nome']:
+            armazenamento.remover(ficheiro['chave_original'])
+            poupados += ficheiro['tamanho_original'] - ficheiro['tamanho']
+    agendar_miniaturas(gravados)
+    return provas, poupados
+
+def descrever_prova(prova):
+    """Prova serializada com os URLs autenticados do original e das miniaturas"""
+    dados = prova.to_dict(PASTA_UPLOAD)
+    dados['url'] = url_for('avaliacoes_ficheiro_prova', assessment_id=prova.avaliacao_id, evidence_id=prova.id)
+    for miniatura in dados['miniaturas']:
+        miniatura['url'] = url_for('avaliacoes_recurso_miniatura_prova', assessment_id=prova.avaliacao_id,
+                                   evidence_id=prova.id, size=miniatura['tamanho'])
+    return dados
 
 # Definir modelos para documentação Swagger com campos em português
 assessment_model = api.model('AvaliacaoDesastre', {
@@ -30,22 +138,24 @@ assessment_model = api.model('AvaliacaoDesastre', {
     'contacto_telefonico': fields.String(required=True, description='Contacto Telefónico'),
     'membros_agregado': fields.Integer(required=True, description='N.º de Pessoas no Agregado Familiar'),
     'grupos_vulneraveis': fields.List(fields.String, description='Grupos Vulneráveis', 
-                                   enum=['bebe_crianca', 'idoso', 'pessoa_deficiencia', 'doente_cronico']),
+                                   enum=GRUPOS_VULNERAVEIS),
     'endereco_completo': fields.String(required=True, description='Endereço Completo'),
     'ponto_referencia': fields.String(description='Ponto de Referência'),
     'latitude_gps': fields.Float(description='Latitude GPS'),
     'longitude_gps': fields.Float(description='Longitude GPS'),
     'tipo_estrutura': fields.String(required=True, description='Tipo de Estrutura Afetada',
-                                  enum=['habitacao', 'comercio', 'agricultura', 'outro']),
+                                  enum=TIPOS_ESTRUTURA),
     'nivel_danos': fields.String(required=True, description='Nível de Danos',
-                                enum=['parcial', 'grave', 'total']),
+                                enum=NIVEIS_DANOS),
     'perdas': fields.List(fields.String, description='Perdas',
-                         enum=['alimentos', 'roupas_calcado', 'moveis', 'eletrodomesticos', 'documentos_pessoais', 'animais_domesticos', 'outros']),
+                         enum=TIPOS_PERDAS),
     'outras_perdas': fields.String(description='Especificação de Outras Perdas'),
-    'ficheiros_prova': fields.List(fields.String, description='Ficheiros de prova'),
     'necessidade_urgente': fields.String(required=True, description='Necessidade Urgente',
-                               enum=['agua_potavel', 'alimentacao', 'abrigo_temporario', 'roupas_cobertores', 'medicamentos', 'outros']),
+                               enum=NECESSIDADES_URGENTES),
     'outra_necessidade': fields.String(description='Especificação de Outra Necessidade Urgente'),
+    'codigo_area': fields.String(description='Código da área administrativa (freguesia); derivado das coordenadas se omitido'),
+    'codigo_regiao': fields.String(readonly=True, description='Código da região (derivado de codigo_area)'),
+    'codigo_municipio': fields.String(readonly=True, description='Código do município (derivado de codigo_area)'),
     'data_criacao': fields.DateTime(readonly=True, description='Data de Criação'),
     'data_atualizacao': fields.DateTime(readonly=True, description='Data da Última Atualização')
 })
@@ -56,21 +166,22 @@ entrada_avaliacao = api.model('EntradaAvaliacao', {
     'contacto_telefonico': fields.String(required=True, description='Contacto Telefónico'),
     'membros_agregado': fields.Integer(required=True, description='N.º de Pessoas no Agregado Familiar'),
     'grupos_vulneraveis': fields.List(fields.String, description='Grupos Vulneráveis', 
-                                   enum=['bebe_crianca', 'idoso', 'pessoa_deficiencia', 'doente_cronico']),
+                                   enum=GRUPOS_VULNERAVEIS),
     'endereco_completo': fields.String(required=True, description='Endereço Completo'),
     'ponto_referencia': fields.String(description='Ponto de Referência'),
     'latitude_gps': fields.Float(description='Latitude GPS'),
     'longitude_gps': fields.Float(description='Longitude GPS'),
     'tipo_estrutura': fields.String(required=True, description='Tipo de Estrutura Afetada',
-                                  enum=['habitacao', 'comercio', 'agricultura', 'outro']),
+                                  enum=TIPOS_ESTRUTURA),
     'nivel_danos': fields.String(required=True, description='Nível de Danos',
-                                enum=['parcial', 'grave', 'total']),
+                                enum=NIVEIS_DANOS),
     'perdas': fields.List(fields.String, description='Perdas',
-                         enum=['alimentos', 'roupas_calcado', 'moveis', 'eletrodomesticos', 'documentos_pessoais', 'animais_domesticos', 'outros']),
+                         enum=TIPOS_PERDAS),
     'outras_perdas': fields.String(description='Especificação de Outras Perdas'),
     'necessidade_urgente': fields.String(required=True, description='Necessidade Urgente',
-                               enum=['agua_potavel', 'alimentacao', 'abrigo_temporario', 'roupas_cobertores', 'medicamentos', 'outros']),
-    'outra_necessidade': fields.String(description='Especificação de Outra Necessidade Urgente')
+                               enum=NECESSIDADES_URGENTES),
+    'outra_necessidade': fields.String(description='Especificação de Outra Necessidade Urgente'),
+    'codigo_area': fields.String(description='Código da área administrativa (freguesia); derivado das coordenadas se omitido')
 })
 
 modelo_estatisticas = api.model('Estatisticas', {
@@ -80,6 +191,110 @@ modelo_estatisticas = api.model('Estatisticas', {
     'estatisticas_necessidade_urgente': fields.Raw(description='Estatísticas por necessidade urgente')
 })
 
+modelo_cubo = api.model('CuboEstatisticas', {
+    'dimensoes': fields.List(fields.String, description='Dimensões pedidas, pela ordem dos eixos'),
+    'eixos': fields.Raw(description='Valores de cada eixo'),
+    'forma': fields.List(fields.Integer, description='Tamanho de cada eixo'),
+    'medidas': fields.Raw(description='Por medida, lista plana row-major com o produto dos eixos')
+})
+
+modelo_multivalor = api.model('EstatisticasMultivalor', {
+    'total_avaliacoes': fields.Integer(description='Total de avaliações consideradas'),
+    'grupos_vulneraveis': fields.Raw(description='Contagens por grupo vulnerável e matriz de co-ocorrência'),
+    'perdas': fields.Raw(description='Contagens por tipo de perda e matriz de co-ocorrência')
+})
+
+modelo_serie_temporal = api.model('SerieTemporal', {
+    'bucket': fields.String(description='Tamanho do intervalo (hour ou day)'),
+    'por': fields.String(description='Dimensão que separa as séries'),
+    'intervalos': fields.List(fields.String, description='Início de cada intervalo (ISO 8601)'),
+    'series': fields.Raw(description='Por valor da dimensão, listas contagem e pessoas alinhadas com os intervalos')
+})
+
+modelo_agregados = api.model('EstatisticasAgregados', {
+    'aproximado': fields.Boolean(description='Se os valores vêm dos sketches (aproximados)'),
+    'total_avaliacoes': fields.Integer(description='Total de avaliações consideradas'),
+    'agregados_distintos': fields.Integer(description='Agregados distintos (por numero_documento)'),
+    'enderecos_distintos': fields.Integer(description='Endereços distintos'),
+    'percentis_membros': fields.Raw(description='Percentis do N.º de pessoas no agregado'),
+    'erro': fields.Raw(description='Limites de erro dos valores aproximados')
+})
+
+modelo_grelha = api.model('GrelhaDensidade', {
+    'origem': fields.List(fields.Float, description='Canto sudoeste da grelha [lon, lat]'),
+    'passo': fields.List(fields.Float, description='Tamanho das células em graus [lon, lat]'),
+    'forma': fields.List(fields.Integer, description='[linhas, colunas] (linha 0 no sul)'),
+    'peso': fields.String(description='Valor somado por célula'),
+    'total': fields.Integer(description='Soma de todas as células'),
+    'indices': fields.List(fields.Integer, description='Índices planos (linha * colunas + coluna) das células não vazias'),
+    'valores': fields.List(fields.Integer, description='Valor de cada célula, alinhado com indices')
+})
+
+modelo_vizinho = api.inherit('AvaliacaoVizinha', assessment_model, {
+    'distancia_m': fields.Float(description='Distância ao ponto pedido, em metros')
+})
+
+modelo_miniatura = api.model('MiniaturaProva', {
+    'tamanho': fields.Integer(description='Lado maior pedido, em píxeis'),
+    'tipo': fields.String(description='image/webp ou image/jpeg'),
+    'caminho': fields.String(description='Caminho do ficheiro'),
+    'largura': fields.Integer(description='Largura em píxeis'),
+    'altura': fields.Integer(description='Altura em píxeis'),
+    'bytes': fields.Integer(description='Tamanho do ficheiro em bytes'),
+    'url': fields.String(description='URL da miniatura (autenticado)')
+})
+
+modelo_prova = api.model('ProvaAvaliacao', {
+    'id': fields.Integer(readonly=True, description='ID da prova'),
+    'avaliacao_id': fields.Integer(description='ID da avaliação'),
+    'caminho': fields.String(description='Caminho do ficheiro no armazém de provas'),
+    'url': fields.String(description='URL de download do ficheiro (autenticado, aceita Range)'),
+    'sha256': fields.String(description='SHA-256 do ficheiro recebido (antes de uma eventual recompressão)'),
+    'tipo': fields.String(description='Tipo MIME detetado pelo conteúdo'),
+    'tamanho': fields.Integer(description='Tamanho em bytes'),
+    'tamanho_original': fields.Integer(description='Tamanho do ficheiro recebido, se a imagem foi recomprimida'),
+    'largura': fields.Integer(description='Largura em píxeis (só imagens)'),
+    'altura': fields.Integer(description='Altura em píxeis (só imagens)'),
+    'nome_original': fields.String(description='Nome do ficheiro enviado'),
+    'miniaturas': fields.List(fields.Nested(modelo_miniatura), description='Versões reduzidas (só imagens, geradas em segundo plano)'),
+    'data_criacao': fields.DateTime(description='Data do carregamento')
+})
+
+modelo_prova_semelhante = api.inherit('ProvaSemelhante', modelo_prova, {
+    'distancia': fields.Integer(description='Distância de Hamming entre os hashes perceptuais (0 = mesma imagem)')
+})
+
+modelo_area = api.model('EstatisticasArea', {
+    'codigo': fields.String(description='Código da área'),
+    'codigo_pai': fields.String(description='Código da área do nível acima'),
+    'contagem': fields.Integer(description='Agregados familiares'),
+    'pessoas': fields.Integer(description='Pessoas afetadas'),
+    'necessidades': fields.Raw(description='Agregados por necessidade urgente')
+})
+
+modelo_areas = api.model('EstatisticasAreas', {
+    'nivel': fields.String(description='Nível da hierarquia'),
+    'pai': fields.String(description='Área do nível acima usada no filtro'),
+    'areas': fields.List(fields.Nested(modelo_area))
+})
+
+modelo_cluster = api.model('Cluster', {
+    'contagem': fields.Integer(description='Avaliações no cluster'),
+    'latitude': fields.Float(description='Latitude do centróide'),
+    'longitude': fields.Float(description='Longitude do centróide'),
+    'nivel_danos_dominante': fields.String(description='Nível de danos mais frequente'),
+    'id': fields.Integer(description='ID da avaliação (só em pontos individuais)')
+})
+
+modelo_cache = api.model('EstatisticasCache', {
+    'backend': fields.String(description='Backend da cache'),
+    'entradas': fields.Integer(description='Entradas em cache neste processo'),
+    'acertos': fields.Integer(description='Leituras servidas pela cache'),
+    'falhas': fields.Integer(description='Leituras que foram à base de dados'),
+    'invalidacoes': fields.Integer(description='Entradas invalidadas por escritas'),
+    'taxa_acerto': fields.Float(description='Acertos / leituras')
+})
+
 modelo_opcoes = api.model('Opcoes', {
     'grupos_vulneraveis': fields.List(fields.String, description='Opções de grupos vulneráveis disponíveis'),
     'tipos_estrutura': fields.List(fields.String, description='Opções de tipos de estrutura disponíveis'),
@@ -88,34 +303,38 @@ modelo_opcoes = api.model('Opcoes', {
     'necessidades_urgentes': fields.List(fields.String, description='Opções de necessidades urgentes disponíveis')
 })
 
+# Filtros comuns à listagem e às estatísticas
+PARAMETROS_FILTRO = {
+    'damage_level': {'description': 'Filtrar por nível de danos (vários separados por vírgula)', 'enum': NIVEIS_DANOS},
+    'structure_type': {'description': 'Filtrar por tipo de estrutura (vários separados por vírgula)', 'enum': TIPOS_ESTRUTURA},
+    'urgent_need': {'description': 'Filtrar por necessidade urgente (vários separados por vírgula)', 'enum': NECESSIDADES_URGENTES},
+    'area': {'description': 'Filtrar por código de área administrativa (vários separados por vírgula)'},
+    'region': {'description': 'Filtrar por código de região (vários separados por vírgula)'},
+    'municipality': {'description': 'Filtrar por código de município (vários separados por vírgula)'},
+    'date_from': {'description': 'Data de criação a partir de (ISO 8601)'},
+    'date_to': {'description': 'Data de criação até (ISO 8601, inclusiva quando só a data é indicada)'},
+    'bbox': {'description': 'Caixa geográfica: min_lon,min_lat,max_lon,max_lat'}
+}
+
 @api.route('')
 class ListaAvaliacoes(Resource):
     @api.doc('listar_avaliacoes')
     @api.param('page', 'Número da página', type='integer', default=1)
     @api.param('per_page', 'Itens por página', type='integer', default=10)
-    @api.param('damage_level', 'Filtrar por nível de danos', enum=['parcial', 'grave', 'total'])
-    @api.param('structure_type', 'Filtrar por tipo de estrutura', enum=['habitacao', 'comercio', 'agricultura', 'outro'])
-    @api.param('urgent_need', 'Filtrar por necessidade urgente', enum=['agua_potavel', 'alimentacao', 'abrigo_temporario', 'roupas_cobertores', 'medicamentos', 'outros'])
+    @api.doc(params=PARAMETROS_FILTRO)
+    @api.param('layout', 'Com Accept: application/msgpack, enviar as chaves uma só vez e as linhas como listas', enum=['columnar'])
     @api.marshal_with(assessment_model, as_list=True)
     @api.doc(security='Bearer')
     @token_obrigatorio
+    @coalescer
     def get(self):
         """Listar todas as avaliações de desastre"""
         try:
             pagina = request.args.get('page', 1, type=int)
             por_pagina = request.args.get('per_page', 10, type=int)
-            nivel_danos = request.args.get('damage_level')
-            tipo_estrutura = request.args.get('structure_type')
-            necessidade_urgente = request.args.get('urgent_need')
-
-            query = AvaliacaoDesastre.query
+            filtros = extrair_filtros(request.args)
 
-            if nivel_danos:
-                query = query.filter(AvaliacaoDesastre.nivel_danos == nivel_danos)
-            if tipo_estrutura:
-                query = query.filter(AvaliacaoDesastre.tipo_estrutura == tipo_estrutura)
-            if necessidade_urgente:
-                query = query.filter(AvaliacaoDesastre.necessidade_urgente == necessidade_urgente)
+            query = aplicar_filtros(AvaliacaoDesastre.query, filtros)
 
             avaliacoes = query.paginate(
                 page=pagina, per_page=por_pagina, error_out=False
@@ -123,8 +342,10 @@ class ListaAvaliacoes(Resource):
 
             return [avaliacao.to_dict() for avaliacao in avaliacoes.items]
 
+        except ValueError as e:
+            api.abort(400, str(e))
         except Exception as e:
-            return {'error': f'Erro interno do servidor: {str(e)}'}, 500
+            api.abort(500, f'Erro interno do servidor: {str(e)}')
 
     @api.doc('criar_avaliacao')
     @api.expect(entrada_avaliacao)
@@ -134,7 +355,7 @@ class ListaAvaliacoes(Resource):
     def post(self):
         """Criar uma nova avaliação de desastre"""
         try:
-            data = api.payload
+            data = ler_payload(api)
             if not data:
                 return {'error': 'Dados não fornecidos'}, 400
 
@@ -159,9 +380,17 @@ class ListaAvaliacoes(Resource):
             avaliacao = AvaliacaoDesastre.from_dict(data)
             db.session.add(avaliacao)
             db.session.commit()
+            pedidos_partilhados.limpar()
 
             return avaliacao.to_dict(), 201
 
+        except ValueError as e:
+            db.session.rollback()
+            api.abort(400, str(e))
+        except HTTPException:
+            # Ex.: 413 quando o corpo excede MAX_CONTENT_LENGTH
+            db.session.rollback()
+            raise
         except Exception as e:
             db.session.rollback()
             return {'error': f'Erro ao criar avaliação: {str(e)}'}, 500
@@ -175,10 +404,22 @@ class RecursoAvaliacao(Resource):
     def get(self, assessment_id):
         """Obter uma avaliação específica pelo ID"""
         try:
+            # Ler apenas a versão da linha para validar a entrada em cache
+            versao = db.session.query(AvaliacaoDesastre.versao).filter_by(id=assessment_id).scalar()
+            if versao is None:
+                cache_avaliacoes.invalidar(assessment_id)
+                return {'error': 'Avaliação não encontrada'}, 404
+
+            corpo = cache_avaliacoes.obter(assessment_id, versao)
+            if corpo is not None:
+                return json.loads(corpo)
+
             avaliacao = AvaliacaoDesastre.query.get(assessment_id)
             if not avaliacao:
                 return {'error': 'Avaliação não encontrada'}, 404
-            return avaliacao.to_dict()
+            dados = avaliacao.to_dict()
+            cache_avaliacoes.guardar(assessment_id, avaliacao.versao, json.dumps(dados))
+            return dados
         except Exception as e:
             return {'error': f'Erro ao obter avaliação: {str(e)}'}, 500
 
@@ -194,19 +435,30 @@ class RecursoAvaliacao(Resource):
             if not avaliacao:
                 return {'error': 'Avaliação não encontrada'}, 404
                 
-            data = api.payload
+            data = ler_payload(api)
             if not data:
                 return {'error': 'Dados não fornecidos'}, 400
 
             # Atualizar a avaliação com os novos dados
+            # Só os campos editáveis pelo cliente: versão, máscaras, hierarquia de áreas
+            # e datas são mantidas pelo servidor
             avaliacao_atualizada = AvaliacaoDesastre.from_dict(data)
             for campo in data.keys():
-                if hasattr(avaliacao, campo):
+                if campo in entrada_avaliacao:
                     setattr(avaliacao, campo, getattr(avaliacao_atualizada, campo))
 
             db.session.commit()
+            cache_avaliacoes.invalidar(assessment_id)
+            pedidos_partilhados.limpar()
             return avaliacao.to_dict()
 
+        except ValueError as e:
+            db.session.rollback()
+            api.abort(400, str(e))
+        except HTTPException:
+            # Ex.: 413 quando o corpo excede MAX_CONTENT_LENGTH
+            db.session.rollback()
+            raise
         except Exception as e:
             db.session.rollback()
             return {'error': f'Erro ao atualizar avaliação: {str(e)}'}, 500
@@ -223,6 +475,8 @@ class RecursoAvaliacao(Resource):
                 
             db.session.delete(avaliacao)
             db.session.commit()
+            cache_avaliacoes.invalidar(assessment_id)
+            pedidos_partilhados.limpar()
             return {'message': 'Avaliação eliminada com sucesso'}, 200
         except Exception as e:
             db.session.rollback()
@@ -230,95 +484,554 @@ class RecursoAvaliacao(Resource):
 
 @api.route('/<int:assessment_id>/evidence')
 class CarregarProvas(Resource):
+    @api.doc('listar_provas')
+    @api.param('page', 'Número da página', type='integer', default=1)
+    @api.param('per_page', 'Itens por página', type='integer', default=10)
+    @api.marshal_with(modelo_prova, as_list=True)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def get(self, assessment_id):
+        """Listar as provas de uma avaliação, por ordem de carregamento"""
+        verificar_avaliacao(assessment_id)
+        pagina = request.args.get('page', 1, type=int)
+        por_pagina = request.args.get('per_page', 10, type=int)
+
+        provas = ProvaAvaliacao.query.filter_by(avaliacao_id=assessment_id).order_by(ProvaAvaliacao.id).paginate(
+            page=pagina, per_page=por_pagina, error_out=False
+        )
+        return [descrever_prova(prova) for prova in provas.items]
+
     @api.doc('carregar_provas')
     @api.doc(security='Bearer')
     @token_obrigatorio
     def post(self, assessment_id):
-        """Carregar ficheiros de prova para uma avaliação"""
+        """Carregar ficheiros de prova para uma avaliação (lidos e gravados por blocos)"""
         try:
-            avaliacao = AvaliacaoDesastre.query.get_or_404(assessment_id)
+            verificar_avaliacao(assessment_id)
 
-            if 'files' not in request.files:
+            if request.mimetype != 'multipart/form-data':
                 api.abort(400, 'Nenhum ficheiro fornecido')
 
-            ficheiros = request.files.getlist('files')
-            if not ficheiros or ficheiros[0].filename == '':
-                api.abort(400, 'Nenhum ficheiro selecionado')
-
-            # Limitar a 3 ficheiros
-            if len(ficheiros) > 3:
-                api.abort(400, 'Máximo de 3 ficheiros permitidos')
-
-            caminhos_salvos = []
-            pasta_upload = garantir_pasta_upload()
-
-            for ficheiro in ficheiros:
-                if ficheiro and ficheiro_permitido(ficheiro.filename):
-                    nome_ficheiro = secure_filename(ficheiro.filename)
-                    # Adicionar ID da avaliação ao nome do ficheiro para evitar conflitos
-                    nome_unico = f"{assessment_id}_{nome_ficheiro}"
-                    caminho_ficheiro = os.path.join(pasta_upload, nome_unico)
-                    ficheiro.save(caminho_ficheiro)
-                    caminhos_salvos.append(f"{PASTA_UPLOAD}/{nome_unico}")
-                else:
-                    api.abort(400, f'Tipo de ficheiro não permitido: {ficheiro.filename}')
-
-            # Atualizar a avaliação com os caminhos dos ficheiros
-            import json
-            ficheiros_existentes = json.loads(avaliacao.ficheiros_prova) if avaliacao.ficheiros_prova else []
-            ficheiros_existentes.extend(caminhos_salvos)
-            avaliacao.ficheiros_prova = json.dumps(ficheiros_existentes)
+            # O corpo é lido diretamente do stream: nada passa pelo parser do Werkzeug.
+            # O limite global (MAX_CONTENT_LENGTH) é pequeno; só aqui sobe para o das provas
+            request.max_content_length = LIMITE_PEDIDO_PROVAS_BYTES
+            gravados = receber_ficheiros(
+                request.stream,
+                request.mimetype_params.get('boundary'),
+                armazenamento_provas(),
+                tamanho_pedido=request.content_length
+            )
 
-            db.session.commit()
+            # Uma linha por ficheiro em provas_avaliacao
+            provas, poupados = registar_gravados(assessment_id, gravados)
+            caminhos_salvos = [f"{PASTA_UPLOAD}/{ficheiro['nome']}" for ficheiro in gravados]
 
             return {
                 'message': f'{len(caminhos_salvos)} ficheiro(s) carregado(s) com sucesso',
-                'files': caminhos_salvos
+                'files': caminhos_salvos,
+                'bytes_poupados': poupados,
+                'detalhes': [
+                    dict(descrever_prova(prova), duplicado=not f['novo'])
+                    for prova, f in zip(provas, gravados)
+                ]
             }, 201
 
+        except ErroProva as e:
+            db.session.rollback()
+            api.abort(e.codigo, str(e))
+        except HTTPException:
+            db.session.rollback()
+            raise
         except Exception as e:
             db.session.rollback()
             api.abort(500, f'Erro ao carregar ficheiros: {str(e)}')
 
+modelo_carregamento_direto = api.model('CarregamentoDireto', {
+    'filename': fields.String(required=True, description='Nome do ficheiro (define o tipo pela extensão)'),
+    'size': fields.Integer(required=True, description='Tamanho em bytes'),
+    'sha256': fields.String(required=True, description='SHA-256 do conteúdo, em hexadecimal')
+})
+
+def _ler_carregamento_direto():
+    dados = ler_payload(api) or {}
+    return dados.get('filename'), dados.get('size'), (dados.get('sha256') or '').lower()
+
+def _concluir_direto(assessment_id, gravado):
+    provas, poupados = registar_gravados(assessment_id, [gravado])
+    return {'estado': 'concluido', 'prova': descrever_prova(provas[0]), 'bytes_poupados': poupados}, 201
+
+@api.route('/<int:assessment_id>/evidence/direct')
+class CarregamentoDireto(Resource):
+    @api.doc('iniciar_carregamento_direto')
+    @api.expect(modelo_carregamento_direto)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def post(self, assessment_id):
+        """Pedir um URL pré-assinado para enviar o ficheiro diretamente ao armazenamento
+
+        Se o conteúdo já estiver no armazém a prova é registada logo (201) e não há
+        nada a enviar. Caso contrário (200) o cliente faz PUT para o URL devolvido,
+        com os cabeçalhos indicados, e chama depois /evidence/direct/confirm.
+        """
+        try:
+            verificar_avaliacao(assessment_id)
+            nome_original, tamanho, sha256 = _ler_carregamento_direto()
+            chave, tipo = validar_carregamento_direto(nome_original, tamanho, sha256)
+
+            existente = descrever_objeto_existente(sha256, nome_original)
+            if existente is not None:
+                return _concluir_direto(assessment_id, existente)
+
+            armazenamento = armazenamento_provas()
+            if not armazenamento.diretos:
+                raise ErroProva('O armazenamento configurado não suporta carregamentos diretos', 501)
+            return {
+                'estado': 'pendente',
+                'carregamento': armazenamento.url_carregamento(chave, tipo, sha256),
+                'confirmar': url_for('avaliacoes_confirmar_carregamento_direto', assessment_id=assessment_id)
+            }, 200
+
+        except ErroProva as e:
+            db.session.rollback()
+            api.abort(e.codigo, str(e))
+
+@api.route('/<int:assessment_id>/evidence/direct/confirm')
+class ConfirmarCarregamentoDireto(Resource):
+    @api.doc('confirmar_carregamento_direto')
+    @api.expect(modelo_carregamento_direto)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def post(self, assessment_id):
+        """Registar uma prova enviada diretamente (verifica tamanho e tipo no armazenamento)"""
+        try:
+            verificar_avaliacao(assessment_id)
+            nome_original, tamanho, sha256 = _ler_carregamento_direto()
+            gravado = confirmar_carregamento_direto(armazenamento_provas(), nome_original, tamanho, sha256)
+            return _concluir_direto(assessment_id, gravado)
+
+        except ErroProva as e:
+            db.session.rollback()
+            api.abort(e.codigo, str(e))
+
+@api.route('/<int:assessment_id>/evidence/<int:evidence_id>/preview')
+class RecursoMiniaturaProva(Resource):
+    @api.doc('obter_miniatura_prova')
+    @api.param('size', 'Lado maior desejado em píxeis; é servida a menor versão que o cumpra',
+               type='integer', default=TAMANHOS_MINIATURA[0])
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def get(self, assessment_id, evidence_id):
+        """Obter uma versão reduzida de uma imagem de prova (WebP se o cliente a aceitar, senão JPEG)"""
+        prova = ProvaAvaliacao.query.filter_by(id=evidence_id, avaliacao_id=assessment_id).first()
+        if prova is None:
+            api.abort(404, 'Prova não encontrada')
+
+        tamanho = request.args.get('size', TAMANHOS_MINIATURA[0], type=int)
+        tipos = ['image/webp', 'image/jpeg'] if request.accept_mimetypes['image/webp'] else ['image/jpeg']
+        miniatura = prova.escolher_miniatura(tamanho, tipos)
+        if miniatura is None and not miniaturas_disponiveis():
+            api.abort(501, 'Miniaturas indisponíveis neste servidor (Pillow não está instalado)')
+        if miniatura is None:
+            api.abort(404, 'Miniatura não disponível (ainda em geração ou a prova não é uma imagem)')
+
+        # O nome deriva do conteúdo: a resposta nunca muda e pode ficar em cache
+        resposta = armazenamento_provas().resposta(
+            miniatura.caminho, miniatura.tipo,
+            f'{miniatura.sha256}-{miniatura.tamanho}-{miniatura.tipo.rsplit("/", 1)[1]}'
+        )
+        resposta.vary.add('Accept')
+        return resposta
+
+@api.route('/<int:assessment_id>/evidence/<int:evidence_id>/file')
+class FicheiroProva(Resource):
+    @api.doc('descarregar_prova')
+    @api.header('Range', 'Intervalo de bytes (ex.: bytes=0-1048575), para retomar ou avançar em vídeos')
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def get(self, assessment_id, evidence_id):
+        """Descarregar o ficheiro de uma prova (Range, ETag forte, cache longa)"""
+        prova = ProvaAvaliacao.query.filter_by(id=evidence_id, avaliacao_id=assessment_id).first()
+        if prova is None:
+            api.abort(404, 'Prova não encontrada')
+        return armazenamento_provas().resposta(prova.objeto.caminho, prova.tipo, prova.objeto.etag,
+                                               nome_download=prova.nome_original)
+
+@api.route('/<int:assessment_id>/evidence/<int:evidence_id>/similar')
+class RecursoProvasSemelhantes(Resource):
+    @api.doc('obter_provas_semelhantes')
+    @api.param('max_distance', f'Distância de Hamming máxima (0-{MAX_DISTANCIA_SEMELHANCA})', type='integer', default=8)
+    @api.param('limit', 'Número máximo de provas (1-200)', type='integer', default=50)
+    @api.marshal_list_with(modelo_prova_semelhante)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def get(self, assessment_id, evidence_id):
+        """Obter as imagens quase iguais a uma prova, em todas as avaliações, da mais próxima à mais afastada"""
+        try:
+            maximo = request.args.get('max_distance', 8, type=int)
+            if maximo < 0 or maximo > MAX_DISTANCIA_SEMELHANCA:
+                raise ValueError(f'max_distance deve estar entre 0 e {MAX_DISTANCIA_SEMELHANCA}')
+            limite = request.args.get('limit', 50, type=int)
+            if limite < 1 or limite > 200:
+                raise ValueError('limit deve estar entre 1 e 200')
+        except ValueError as e:
+            api.abort(400, str(e))
+
+        prova = ProvaAvaliacao.query.filter_by(id=evidence_id, avaliacao_id=assessment_id).first()
+        if prova is None:
+            api.abort(404, 'Prova não encontrada')
+        valor = db.session.query(HashPerceptual.valor).filter_by(sha256=prova.sha256).scalar()
+        if valor is None and not semelhanca_disponivel():
+            api.abort(501, 'Pesquisa de imagens semelhantes indisponível neste servidor (Pillow não está instalado)')
+        if valor is None:
+            api.abort(404, 'A prova não tem hash perceptual (não é uma imagem ou ainda está a ser processada)')
+
+        distancias = {sha256: d for d, sha256 in indice_semelhanca.semelhantes(valor, maximo)}
+        # Todas as provas desses objetos; hashes de objetos já apagados não têm provas
+        semelhantes = ProvaAvaliacao.query.filter(
+            ProvaAvaliacao.sha256.in_(distancias), ProvaAvaliacao.id != prova.id
+        ).all()
+        semelhantes.sort(key=lambda p: (distancias[p.sha256], p.id))
+        return [dict(descrever_prova(p), distancia=distancias[p.sha256]) for p in semelhantes[:limite]]
+
+def _cabecalhos_tus(**extra):
+    return dict({'Tus-Resumable': VERSAO_TUS, 'Cache-Control': 'no-store'}, **extra)
+
+@api.route('/<int:assessment_id>/evidence/uploads')
+class CarregamentosRetomaveis(Resource):
+    @api.doc('criar_carregamento_retomavel')
+    @api.header('Upload-Length', 'Tamanho total do ficheiro em bytes', required=True)
+    @api.header('Upload-Metadata', 'Metadados tus; "filename <base64>" é obrigatório', required=True)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def post(self, assessment_id):
+        """Criar um carregamento retomável (tus); os dados são enviados depois por PATCH"""
+        try:
+            verificar_avaliacao(assessment_id)
+            try:
+                tamanho = int(request.headers['Upload-Length'])
+            except (KeyError, ValueError):
+                raise ErroProva('Upload-Length é obrigatório')
+            nome = ler_metadados_tus(request.headers.get('Upload-Metadata')).get('filename')
+            if not nome:
+                raise ErroProva('Upload-Metadata deve indicar filename')
+
+            carregamento = CarregamentoRetomavel.criar(garantir_pasta_parciais(), assessment_id, nome, tamanho)
+            localizacao = f'{request.base_url}/{carregamento.identificador}'
+            return {'id': carregamento.identificador}, 201, _cabecalhos_tus(Location=localizacao, **{'Upload-Offset': '0'})
+
+        except ErroProva as e:
+            return {'message': str(e)}, e.codigo, _cabecalhos_tus()
+
+@api.route('/<int:assessment_id>/evidence/uploads/<string:upload_id>')
+class RecursoCarregamentoRetomavel(Resource):
+    def _abrir(self, assessment_id, upload_id):
+        carregamento = CarregamentoRetomavel.abrir(garantir_pasta_parciais(), upload_id)
+        if carregamento is None or carregamento.metadados['avaliacao_id'] != assessment_id:
+            api.abort(404, 'Carregamento não encontrado')
+        return carregamento
+
+    @api.doc('estado_carregamento_retomavel')
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def head(self, assessment_id, upload_id):
+        """Obter o offset atual (bytes já recebidos) de um carregamento"""
+        carregamento = self._abrir(assessment_id, upload_id)
+        return '', 200, _cabecalhos_tus(**{
+            'Upload-Offset': str(carregamento.offset),
+            'Upload-Length': str(carregamento.tamanho)
+        })
+
+    @api.doc('enviar_bloco_carregamento')
+    @api.header('Upload-Offset', 'Offset em que o bloco começa (deve ser o atual)', required=True)
+    @api.header('Upload-Checksum', 'Checksum do bloco: "sha256|sha1|md5 <base64>"')
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def patch(self, assessment_id, upload_id):
+        """Enviar um bloco (application/offset+octet-stream); o último conclui o carregamento"""
+        try:
+            carregamento = self._abrir(assessment_id, upload_id)
+            if request.mimetype != 'application/offset+octet-stream':
+                raise ErroProva('Content-Type deve ser application/offset+octet-stream', 415)
+            try:
+                offset = int(request.headers['Upload-Offset'])
+            except (KeyError, ValueError):
+                raise ErroProva('Upload-Offset é obrigatório')
+
+            def concluir(carregamento):
+                # Último bloco: guardar no armazém de provas e registar na avaliação
+                verificar_avaliacao(assessment_id)
+                gravado = carregamento.concluir(armazenamento_provas())
+                registar_gravados(assessment_id, [gravado])
+
+            request.max_content_length = LIMITE_PEDIDO_PROVAS_BYTES
+            offset = carregamento.anexar(request.stream, offset, request.headers.get('Upload-Checksum'), concluir)
+
+            return '', 204, _cabecalhos_tus(**{'Upload-Offset': str(offset)})
+
+        except ErroProva as e:
+            # Resposta direta: 460 (checksum) não é um código HTTP conhecido pelo Werkzeug
+            db.session.rollback()
+            return {'message': str(e)}, e.codigo, _cabecalhos_tus()
+
+    @api.doc('cancelar_carregamento_retomavel')
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def delete(self, assessment_id, upload_id):
+        """Cancelar um carregamento e apagar os bytes já recebidos"""
+        self._abrir(assessment_id, upload_id).descartar()
+        return '', 204, _cabecalhos_tus()
+
 @api.route('/statistics')
 class RecursoEstatisticas(Resource):
     @api.doc('obter_estatisticas')
+    @api.doc(params=PARAMETROS_FILTRO)
     @api.marshal_with(modelo_estatisticas)
     @api.doc(security='Bearer')
     @token_obrigatorio
+    @coalescer
     def get(self):
-        """Obter estatísticas das avaliações"""
+        """Obter estatísticas das avaliações (aceita os mesmos filtros da listagem)"""
         try:
-            total_avaliacoes = AvaliacaoDesastre.query.count()
-
-            # Estatísticas por nível de danos
-            stats_nivel_danos = db.session.query(
-                AvaliacaoDesastre.nivel_danos,
-                db.func.count(AvaliacaoDesastre.id)
-            ).group_by(AvaliacaoDesastre.nivel_danos).all()
-
-            # Estatísticas por tipo de estrutura
-            stats_tipo_estrutura = db.session.query(
-                AvaliacaoDesastre.tipo_estrutura,
-                db.func.count(AvaliacaoDesastre.id)
-            ).group_by(AvaliacaoDesastre.tipo_estrutura).all()
-
-            # Estatísticas por necessidade urgente
-            stats_necessidade_urgente = db.session.query(
-                AvaliacaoDesastre.necessidade_urgente,
-                db.func.count(AvaliacaoDesastre.id)
-            ).group_by(AvaliacaoDesastre.necessidade_urgente).all()
+            # Uma única passagem agrupada (SQLite ou instantâneo em memória)
+            return calcular_estatisticas(extrair_filtros(request.args))
 
-            return {
-                'total_avaliacoes': total_avaliacoes,
-                'estatisticas_nivel_danos': {nivel: count for nivel, count in stats_nivel_danos},
-                'estatisticas_tipo_estrutura': {tipo: count for tipo, count in stats_tipo_estrutura},
-                'estatisticas_necessidade_urgente': {necessidade: count for necessidade, count in stats_necessidade_urgente}
-            }
+        except ValueError as e:
+            api.abort(400, str(e))
+        except Exception as e:
+            api.abort(500, f'Erro ao obter estatísticas: {str(e)}')
+
+@api.route('/statistics/cube')
+class RecursoCuboEstatisticas(Resource):
+    @api.doc('obter_cubo_estatisticas')
+    @api.param('dims', 'Dimensões separadas por vírgula', enum=list(DIMENSOES_CUBO))
+    @api.param('measures', 'Medidas separadas por vírgula (por omissão: count)', enum=list(MEDIDAS_CUBO))
+    @api.doc(params=PARAMETROS_FILTRO)
+    @api.marshal_with(modelo_cubo)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    @coalescer
+    def get(self):
+        """Obter uma tabulação cruzada (cubo) das avaliações numa só passagem"""
+        try:
+            filtros = extrair_filtros(request.args)
+            dimensoes = ler_lista(request.args.get('dims'), DIMENSOES_CUBO, 'dims')
+            medidas = ler_lista(request.args.get('measures', 'count'), MEDIDAS_CUBO, 'measures')
+            if not medidas:
+                raise ValueError('Indique pelo menos uma medida em "measures"')
+
+            return calcular_cubo(filtros, dimensoes, medidas)
+
+        except ValueError as e:
+            api.abort(400, str(e))
+        except Exception as e:
+            api.abort(500, f'Erro ao calcular cubo: {str(e)}')
+
+@api.route('/statistics/multivalued')
+class RecursoEstatisticasMultivalor(Resource):
+    @api.doc('obter_estatisticas_multivalor')
+    @api.doc(params=PARAMETROS_FILTRO)
+    @api.marshal_with(modelo_multivalor)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    @coalescer
+    def get(self):
+        """Obter estatísticas de grupos vulneráveis e perdas, com co-ocorrências"""
+        try:
+            return calcular_multivalor(extrair_filtros(request.args))
+        except ValueError as e:
+            api.abort(400, str(e))
+        except Exception as e:
+            api.abort(500, f'Erro ao obter estatísticas: {str(e)}')
+
+@api.route('/statistics/timeseries')
+class RecursoSerieTemporal(Resource):
+    @api.doc('obter_serie_temporal')
+    @api.param('bucket', 'Tamanho do intervalo', enum=list(BUCKETS_TEMPORAIS), default='day')
+    @api.param('by', 'Separar as séries por esta dimensão', enum=list(DIMENSOES_CUBO))
+    @api.doc(params={p: PARAMETROS_FILTRO[p] for p in PARAMETROS_FILTRO if p != 'bbox'})
+    @api.marshal_with(modelo_serie_temporal)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    @coalescer
+    def get(self):
+        """Obter registos por hora/dia a partir do rollup temporal"""
+        try:
+            filtros = extrair_filtros(request.args)
+            bucket = request.args.get('bucket', 'day')
+            if bucket not in BUCKETS_TEMPORAIS:
+                raise ValueError('bucket deve ser hour ou day')
+            por = request.args.get('by') or None
+            if por is not None and por not in DIMENSOES_CUBO:
+                raise ValueError(f'Dimensão inválida em "by": {por}')
+
+            return calcular_serie_temporal(filtros, bucket, por)
+
+        except ValueError as e:
+            api.abort(400, str(e))
+        except Exception as e:
+            api.abort(500, f'Erro ao obter série temporal: {str(e)}')
+
+@api.route('/statistics/households')
+class RecursoEstatisticasAgregados(Resource):
+    @api.doc('obter_estatisticas_agregados')
+    @api.param('approx', 'Usar sketches (HyperLogLog/quantis) em vez de contagens exatas', type='boolean', default=False)
+    @api.param('percentiles', 'Percentis separados por vírgula', default='50,90,99')
+    @api.doc(params=PARAMETROS_FILTRO)
+    @api.marshal_with(modelo_agregados)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    @coalescer
+    def get(self):
+        """Obter agregados distintos e percentis do agregado familiar (exatos ou aproximados)"""
+        try:
+            filtros = extrair_filtros(request.args)
+            try:
+                percentis = [float(p) for p in request.args.get('percentiles', '50,90,99').split(',') if p.strip()]
+            except ValueError:
+                raise ValueError('percentiles deve ser uma lista de números entre 0 e 100')
+            if any(p < 0 or p > 100 for p in percentis):
+                raise ValueError('percentiles deve ser uma lista de números entre 0 e 100')
+
+            # Os sketches são globais: com filtros (ou enquanto são construídos) usa-se o cálculo exato
+            if request.args.get('approx', '').lower() in ('1', 'true') and not filtros:
+                resumo = sketches_avaliacoes.resumo(percentis)
+                if resumo is not None:
+                    return resumo
+            return calcular_agregados(filtros, percentis)
 
+        except ValueError as e:
+            api.abort(400, str(e))
         except Exception as e:
             api.abort(500, f'Erro ao obter estatísticas: {str(e)}')
 
+@api.route('/statistics/grid')
+class RecursoEstatisticasGrelha(Resource):
+    @api.doc('obter_grelha_densidade')
+    @api.param('cell_m', 'Tamanho das células em metros', type='number', default=1000)
+    @api.param('weight', 'Valor somado por célula', enum=list(PESOS_GRELHA), default='count')
+    @api.doc(params=PARAMETROS_FILTRO)
+    @api.marshal_with(modelo_grelha)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    @coalescer
+    def get(self):
+        """Obter um mapa de densidade (contagem ou pessoas por célula) numa grelha regular"""
+        try:
+            filtros = extrair_filtros(request.args)
+            try:
+                cell_m = float(request.args.get('cell_m', 1000))
+            except ValueError:
+                raise ValueError('cell_m deve ser um número')
+
+            return calcular_grelha(filtros, cell_m, request.args.get('weight', 'count'))
+
+        except ValueError as e:
+            api.abort(400, str(e))
+        except Exception as e:
+            api.abort(500, f'Erro ao obter grelha: {str(e)}')
+
+@api.route('/statistics/areas')
+class RecursoEstatisticasAreas(Resource):
+    @api.doc('obter_estatisticas_areas')
+    @api.param('level', 'Nível da hierarquia', enum=list(NIVEIS_AREA), default='region')
+    @api.param('parent', 'Código da área do nível acima (drill-down)')
+    @api.marshal_with(modelo_areas)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    @coalescer
+    def get(self):
+        """Obter contagens, pessoas e necessidades por região, município ou freguesia"""
+        try:
+            return calcular_areas(request.args.get('level', 'region'), request.args.get('parent') or None)
+
+        except ValueError as e:
+            api.abort(400, str(e))
+        except Exception as e:
+            api.abort(500, f'Erro ao obter estatísticas por área: {str(e)}')
+
+@api.route('/clusters')
+class RecursoClusters(Resource):
+    @api.doc('obter_clusters')
+    @api.param('bbox', 'Área visível: min_lon,min_lat,max_lon,max_lat', required=True)
+    @api.param('zoom', 'Nível de zoom do mapa (0-22)', type='integer', required=True)
+    @api.marshal_list_with(modelo_cluster, skip_none=True)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    @coalescer
+    def get(self):
+        """Obter marcadores agrupados por célula para a área visível do mapa"""
+        try:
+            filtros = extrair_filtros(request.args)
+            if 'bbox' not in filtros:
+                raise ValueError('bbox é obrigatório')
+            if set(filtros) != {'bbox'}:
+                # O índice hierárquico é pré-agregado só por localização
+                raise ValueError('clusters só aceita o filtro bbox')
+            try:
+                zoom = int(request.args.get('zoom', ''))
+            except ValueError:
+                raise ValueError('zoom deve ser um inteiro entre 0 e 22')
+            if zoom < 0 or zoom > 22:
+                raise ValueError('zoom deve ser um inteiro entre 0 e 22')
+
+            return indice_clusters.clusters(filtros['bbox'], zoom)
+
+        except ValueError as e:
+            api.abort(400, str(e))
+        except Exception as e:
+            api.abort(500, f'Erro ao obter clusters: {str(e)}')
+
+@api.route('/nearest')
+class RecursoVizinhos(Resource):
+    @api.doc('obter_avaliacoes_proximas')
+    @api.param('lat', 'Latitude do ponto', type='number', required=True)
+    @api.param('lon', 'Longitude do ponto', type='number', required=True)
+    @api.param('k', 'Número de avaliações (1-100)', type='integer', default=10)
+    @api.doc(params=PARAMETROS_FILTRO)
+    @api.marshal_list_with(modelo_vizinho)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def get(self):
+        """Obter as k avaliações mais próximas de um ponto, com a distância em metros"""
+        try:
+            filtros = extrair_filtros(request.args)
+            try:
+                lat = float(request.args['lat'])
+                lon = float(request.args['lon'])
+            except (KeyError, ValueError):
+                raise ValueError('lat e lon são obrigatórios e devem ser números')
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                raise ValueError('lat/lon fora dos limites')
+            k = request.args.get('k', 10, type=int)
+            if k < 1 or k > 100:
+                raise ValueError('k deve estar entre 1 e 100')
+
+            vizinhos = indice_vizinhos.vizinhos(lat, lon, k, filtros)
+            avaliacoes = {a.id: a for a in AvaliacaoDesastre.query.filter(
+                AvaliacaoDesastre.id.in_([i for i, _ in vizinhos])
+            )}
+            resultado = []
+            for avaliacao_id, distancia in vizinhos:
+                # Ignorar linhas eliminadas entretanto
+                if avaliacao_id in avaliacoes:
+                    resultado.append(dict(avaliacoes[avaliacao_id].to_dict(), distancia_m=round(distancia, 1)))
+            return resultado
+
+        except ValueError as e:
+            api.abort(400, str(e))
+        except Exception as e:
+            api.abort(500, f'Erro ao obter avaliações próximas: {str(e)}')
+
+@api.route('/cache')
+class RecursoCache(Resource):
+    @api.doc('obter_estatisticas_cache')
+    @api.marshal_with(modelo_cache)
+    @api.doc(security='Bearer')
+    @token_obrigatorio
+    def get(self):
+        """Obter a taxa de acerto da cache de avaliações"""
+        return cache_avaliacoes.estatisticas()
+
 @api.route('/options')
 class RecursoOpcoes(Resource):
     @api.doc('obter_opcoes')
@@ -328,9 +1041,9 @@ class RecursoOpcoes(Resource):
     def get(self):
         """Obter opções disponíveis para os formulários"""
         return {
-            'grupos_vulneraveis': ['bebe_crianca', 'idoso', 'pessoa_deficiencia', 'doente_cronico'],
-            'tipos_estrutura': ['habitacao', 'comercio', 'agricultura', 'outro'],
-            'niveis_danos': ['parcial', 'grave', 'total'],
-            'tipos_perdas': ['alimentos', 'roupas_calcado', 'moveis', 'eletrodomesticos', 'documentos_pessoais', 'animais_domesticos', 'outros'],
-            'necessidades_urgentes': ['agua_potavel', 'alimentacao', 'abrigo_temporario', 'roupas_cobertores', 'medicamentos', 'outros']
+            'grupos_vulneraveis': GRUPOS_VULNERAVEIS,
+            'tipos_estrutura': TIPOS_ESTRUTURA,
+            'niveis_danos': NIVEIS_DANOS,
+            'tipos_perdas': TIPOS_PERDAS,
+            'necessidades_urgentes': NECESSIDADES_URGENTES
         }
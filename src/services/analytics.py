@@ -0,0 +1,307 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from src.models.assessment import AvaliacaoDesastre, NIVEIS_DANOS, TIPOS_ESTRUTURA, NECESSIDADES_URGENTES
+from src.models.change_log import alteracoes_desde, ultima_alteracao
+
+# Responder às estatísticas a partir do instantâneo em memória em vez do SQLite
+ANALITICA_EM_MEMORIA = os.environ.get('ANALITICA_EM_MEMORIA', '0') == '1'
+
+# Intervalo mínimo entre leituras da sequência de alterações
+INTERVALO_SINCRONIZACAO_SEGUNDOS = float(os.environ.get('INTERVALO_SINCRONIZACAO_SEGUNDOS', 1.0))
+
+# Colunas categóricas guardadas como códigos inteiros (índice no vocabulário)
+COLUNAS_CATEGORICAS = {
+    'nivel_danos': NIVEIS_DANOS,
+    'tipo_estrutura': TIPOS_ESTRUTURA,
+    'necessidade_urgente': NECESSIDADES_URGENTES,
+    # Vocabulários dinâmicos (códigos da hierarquia administrativa)
+    'codigo_area': [None],
+    'codigo_regiao': [None],
+    'codigo_municipio': [None],
+}
+
+# Tipos das colunas do instantâneo
+TIPOS_COLUNAS = {
+    'id': np.int64,
+    'nivel_danos': np.uint8,
+    'tipo_estrutura': np.uint8,
+    'necessidade_urgente': np.uint8,
+    'latitude_gps': np.float32,
+    'longitude_gps': np.float32,
+    'data_criacao': np.int64,           # Microssegundos desde 1970 (NaT = mínimo int64)
+    'membros_agregado': np.int32,
+    'mascara_grupos': np.uint8,
+    'mascara_perdas': np.uint8,
+    'codigo_area': np.uint16,
+    'codigo_regiao': np.uint16,
+    'codigo_municipio': np.uint16,
+    'ativo': np.bool_,                  # False para linhas eliminadas
+}
+
+TAMANHO_LOTE = 50000
+
+
+def _para_microssegundos(data):
+    return np.datetime64(data, 'us').astype(np.int64)
+
+
+class InstantaneoColunar:
+    """Cópia colunar (NumPy) da tabela de avaliações, atualizada pela sequência de alterações"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._colunas = None
+        self._n = 0
+        self._seq = 0
+        self._ultima_sincronizacao = 0.0
+        self._ouvintes = []
+        self.vocabularios = {c: list(opcoes) for c, opcoes in COLUNAS_CATEGORICAS.items()}
+        self._codigos = {c: {v: i for i, v in enumerate(opcoes)} for c, opcoes in self.vocabularios.items()}
+
+    def subscrever(self, ouvinte):
+        """Registar um índice derivado, notificado via invalidar(), reordenado() e aplicar(antigos, novos)"""
+        with self._lock:
+            self._ouvintes.append(ouvinte)
+
+    # --- carregamento ---
+
+    def _codigo(self, coluna, valor):
+        codigos = self._codigos[coluna]
+        codigo = codigos.get(valor)
+        if codigo is None:
+            vocabulario = self.vocabularios[coluna]
+            if len(vocabulario) > np.iinfo(TIPOS_COLUNAS[coluna]).max:
+                raise ValueError(f'Demasiados valores distintos em {coluna}')
+            codigo = codigos[valor] = len(vocabulario)
+            vocabulario.append(valor)
+        return codigo
+
+    def _ler_linhas(self, query):
+        colunas = [getattr(AvaliacaoDesastre, c) for c in TIPOS_COLUNAS if c != 'ativo']
+        return query.with_entities(*colunas)
+
+    def _converter(self, linhas):
+        """Converter tuplas da base de dados em colunas NumPy"""
+        nomes = [c for c in TIPOS_COLUNAS if c != 'ativo']
+        valores = list(zip(*linhas)) if linhas else [()] * len(nomes)
+        colunas = {}
+        for nome, coluna in zip(nomes, valores):
+            if nome in COLUNAS_CATEGORICAS:
+                colunas[nome] = np.array([self._codigo(nome, v) for v in coluna], dtype=TIPOS_COLUNAS[nome])
+            elif nome == 'data_criacao':
+                colunas[nome] = np.array(coluna, dtype='datetime64[us]').astype(np.int64)
+            elif nome in ('latitude_gps', 'longitude_gps'):
+                colunas[nome] = np.array([np.nan if v is None else v for v in coluna], dtype=np.float32)
+            else:
+                colunas[nome] = np.array([v or 0 for v in coluna], dtype=TIPOS_COLUNAS[nome])
+        colunas['ativo'] = np.ones(len(linhas), dtype=np.bool_)
+        return colunas
+
+    def carregar(self):
+        """Carregar a tabela completa (também usado quando a sequência foi podada)"""
+        with self._lock:
+            # Ler a posição antes dos dados: alterações concorrentes serão reaplicadas
+            seq = ultima_alteracao()
+            partes = []
+            ultimo_id = 0
+            while True:
+                linhas = self._ler_linhas(AvaliacaoDesastre.query.filter(
+                    AvaliacaoDesastre.id > ultimo_id
+                ).order_by(AvaliacaoDesastre.id).limit(TAMANHO_LOTE)).all()
+                if not linhas:
+                    break
+                partes.append(self._converter(linhas))
+                ultimo_id = linhas[-1][0]
+
+            if partes:
+                self._colunas = {c: np.concatenate([p[c] for p in partes]) for c in TIPOS_COLUNAS}
+            else:
+                self._colunas = {c: np.empty(0, dtype=t) for c, t in TIPOS_COLUNAS.items()}
+            self._n = len(self._colunas['id'])
+            self._seq = seq
+            self._ultima_sincronizacao = time.monotonic()
+            for ouvinte in self._ouvintes:
+                ouvinte.invalidar()
+
+    def localizar(self, ids):
+        """Posições de ids no instantâneo e se cada um já lá existe"""
+        existentes = self._colunas['id'][:self._n]
+        posicoes = np.searchsorted(existentes, ids)
+        existe = np.zeros(len(ids), dtype=np.bool_)
+        dentro = posicoes < self._n
+        existe[dentro] = existentes[posicoes[dentro]] == ids[dentro]
+        return posicoes, existe
+
+    def _aplicar(self, ids):
+        """Reler as linhas alteradas e atualizá-las, acrescentá-las ou marcá-las como eliminadas"""
+        ids = np.array(sorted(ids), dtype=np.int64)
+        for inicio in range(0, len(ids), 500):
+            lote = ids[inicio:inicio + 500]
+            linhas = self._ler_linhas(AvaliacaoDesastre.query.filter(
+                AvaliacaoDesastre.id.in_(lote.tolist())
+            ).order_by(AvaliacaoDesastre.id)).all()
+            novos = self._converter(linhas)
+
+            # Linhas que já não existem foram eliminadas
+            eliminados = np.setdiff1d(lote, novos['id'])
+            posicoes_eliminados, existe_eliminados = self.localizar(eliminados)
+            posicoes, existe = self.localizar(novos['id'])
+
+            if self._ouvintes:
+                # Valores anteriores das linhas ativas que vão ser eliminadas ou substituídas
+                anteriores = np.concatenate([posicoes_eliminados[existe_eliminados], posicoes[existe]])
+                anteriores = anteriores[self._colunas['ativo'][anteriores]]
+                antigos = {c: self._colunas[c][anteriores] for c in TIPOS_COLUNAS}
+                for ouvinte in self._ouvintes:
+                    ouvinte.aplicar(antigos, novos)
+
+            self._colunas['ativo'][posicoes_eliminados[existe_eliminados]] = False
+            for c in TIPOS_COLUNAS:
+                self._colunas[c][posicoes[existe]] = novos[c][existe]
+            if not existe.all():
+                self._acrescentar({c: novos[c][~existe] for c in TIPOS_COLUNAS})
+
+    def _acrescentar(self, novos):
+        n_novos = len(novos['id'])
+        capacidade = len(self._colunas['id'])
+        if self._n + n_novos > capacidade:
+            # Crescer por duplicação para que inserções sucessivas custem O(1) amortizado
+            nova_capacidade = max(self._n + n_novos, capacidade * 2, 1024)
+            for c, tipo in TIPOS_COLUNAS.items():
+                coluna = np.zeros(nova_capacidade, dtype=tipo)
+                coluna[:self._n] = self._colunas[c][:self._n]
+                self._colunas[c] = coluna
+        for c in TIPOS_COLUNAS:
+            self._colunas[c][self._n:self._n + n_novos] = novos[c]
+        self._n += n_novos
+
+        # IDs inseridos fora de ordem (raro): reordenar para manter a pesquisa binária
+        ids = self._colunas['id'][:self._n]
+        if self._n > n_novos and ids[self._n - n_novos] < ids[self._n - n_novos - 1]:
+            ordem = np.argsort(ids, kind='stable')
+            for c in TIPOS_COLUNAS:
+                self._colunas[c][:self._n] = self._colunas[c][:self._n][ordem]
+            for ouvinte in self._ouvintes:
+                ouvinte.reordenado()
+
+    def sincronizar(self, forcar=False):
+        """Aplicar as alterações pendentes (no máximo uma leitura por intervalo)"""
+        with self._lock:
+            if self._colunas is None:
+                self.carregar()
+                return
+            if not forcar and time.monotonic() - self._ultima_sincronizacao < INTERVALO_SINCRONIZACAO_SEGUNDOS:
+                return
+            resultado = alteracoes_desde(self._seq)
+            if resultado is None:
+                self.carregar()
+                return
+            ids, seq = resultado
+            if ids:
+                self._aplicar(ids)
+            self._seq = seq
+            self._ultima_sincronizacao = time.monotonic()
+
+    # --- consultas ---
+
+    def colunas(self):
+        """Vistas (sem cópia) das colunas; as linhas eliminadas ficam fora via mascara()"""
+        return {c: v[:self._n] for c, v in self._colunas.items()}
+
+    def mascara(self, colunas, filtros):
+        """Máscara booleana equivalente a services.filters.aplicar_filtros"""
+        selecao = colunas['ativo'].copy()
+        for coluna in COLUNAS_CATEGORICAS:
+            valores = filtros.get(coluna)
+            if valores:
+                # Tabela de consulta por código: mais rápida do que np.isin em inteiros pequenos
+                permitidos = np.zeros(np.iinfo(TIPOS_COLUNAS[coluna]).max + 1, dtype=np.bool_)
+                permitidos[[self._codigos[coluna][v] for v in valores if v in self._codigos[coluna]]] = True
+                selecao &= permitidos[colunas[coluna]]
+        if 'data_inicio' in filtros:
+            selecao &= colunas['data_criacao'] >= _para_microssegundos(filtros['data_inicio'])
+        if 'data_fim' in filtros:
+            selecao &= colunas['data_criacao'] < _para_microssegundos(filtros['data_fim'])
+        if 'bbox' in filtros:
+            min_lon, min_lat, max_lon, max_lat = filtros['bbox']
+            lat = colunas['latitude_gps']
+            lon = colunas['longitude_gps']
+            selecao &= (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+        return selecao
+
+    def consultar(self, funcao):
+        """Executar funcao(instantaneo, colunas) com o instantâneo sincronizado e bloqueado"""
+        with self._lock:
+            self.sincronizar()
+            return funcao(self, self.colunas())
+
+    def cubo(self, filtros, dimensoes, medidas):
+        """Mesmo formato que services.statistics.calcular_cubo, com np.bincount"""
+        def calcular(instantaneo, colunas):
+            selecao = instantaneo.mascara(colunas, filtros)
+            forma = [len(self.vocabularios[d]) for d in dimensoes]
+            tamanho = int(np.prod(forma)) if forma else 1
+            # Índice plano da célula; as linhas fora da seleção vão para uma célula extra descartada
+            indices = np.zeros(len(selecao), dtype=np.int32)
+            for d, n in zip(dimensoes, forma):
+                indices *= n
+                indices += colunas[d]
+            indices[~selecao] = tamanho
+
+            valores = {}
+            for m in medidas:
+                pesos = colunas['membros_agregado'] if m == 'people' else None
+                contagens = np.bincount(indices, weights=pesos, minlength=tamanho + 1)[:tamanho]
+                valores[m] = contagens.astype(np.int64).tolist()
+            return {
+                'dimensoes': dimensoes,
+                'eixos': {d: list(self.vocabularios[d]) for d in dimensoes},
+                'forma': forma,
+                'medidas': valores
+            }
+        return self.consultar(calcular)
+
+    def histograma_mascaras(self, filtros):
+        """Contagens por máscara de grupos vulneráveis e de perdas"""
+        def calcular(instantaneo, colunas):
+            selecao = instantaneo.mascara(colunas, filtros)
+            contagens = []
+            for coluna in ('mascara_grupos', 'mascara_perdas'):
+                # Linhas fora da seleção vão para a posição 256, descartada
+                mascaras = colunas[coluna].astype(np.int16)
+                mascaras[~selecao] = 256
+                contagens.append(np.bincount(mascaras, minlength=257)[:256])
+            grupos, perdas = contagens
+            return (
+                int(selecao.sum()),
+                {int(m): int(n) for m, n in enumerate(grupos) if n},
+                {int(m): int(n) for m, n in enumerate(perdas) if n}
+            )
+        return self.consultar(calcular)
+
+    def grelha(self, filtros, origem, passo, forma, peso=None):
+        """Histograma 2D (células com valor diferente de zero) numa grelha regular"""
+        def calcular(instantaneo, colunas):
+            selecao = instantaneo.mascara(colunas, filtros)
+            linhas = ((colunas['latitude_gps'][selecao] - origem[1]) / passo[1]).astype(np.int64)
+            colunas_grelha = ((colunas['longitude_gps'][selecao] - origem[0]) / passo[0]).astype(np.int64)
+            # Pontos em cima do limite superior da bbox ficam na última célula
+            np.minimum(linhas, forma[0] - 1, out=linhas)
+            np.minimum(colunas_grelha, forma[1] - 1, out=colunas_grelha)
+            pesos = colunas[peso][selecao] if peso else None
+            valores = np.bincount(linhas * forma[1] + colunas_grelha, weights=pesos, minlength=forma[0] * forma[1])
+            indices = np.flatnonzero(valores)
+            return indices.tolist(), valores[indices].astype(np.int64).tolist()
+        return self.consultar(calcular)
+
+
+instantaneo_avaliacoes = InstantaneoColunar()
+
+
+def motor_analitico():
+    """Instantâneo em memória, ou None quando a análise corre no SQLite"""
+    return instantaneo_avaliacoes if ANALITICA_EM_MEMORIA else None
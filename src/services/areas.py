@@ -0,0 +1,195 @@
+import json
+import math
+import os
+import threading
+
+import numpy as np
+
+# Ficheiro GeoJSON (FeatureCollection de Polygon/MultiPolygon) com os limites administrativos
+FICHEIRO_AREAS = os.environ.get('FICHEIRO_AREAS')
+
+# Propriedade de cada feature com o código da área
+PROPRIEDADE_CODIGO_AREA = os.environ.get('PROPRIEDADE_CODIGO_AREA', 'codigo')
+
+# Hierarquia dos códigos: comprimento do prefixo que identifica a região e o município
+# (por omissão o esquema DTMNFR: distrito 2 dígitos, concelho 4, freguesia 6)
+COMPRIMENTOS_CODIGO_AREA = [int(n) for n in os.environ.get('COMPRIMENTOS_CODIGO_AREA', '2,4').split(',')]
+
+# Níveis da hierarquia, do mais largo ao mais fino, e a coluna de cada um
+NIVEIS_AREA = {
+    'region': 'codigo_regiao',
+    'municipality': 'codigo_municipio',
+    'parish': 'codigo_area',
+}
+
+# Elementos (pontos × arestas) avaliados de cada vez no teste de inclusão
+TAMANHO_BLOCO = 1000000
+
+
+class IndiceAreas:
+    """Atribuição de pontos a áreas: grelha uniforme de caixas como pré-filtro e
+    teste exato par-ímpar (ray casting) sobre todas as arestas do polígono"""
+
+    def __init__(self, features, propriedade_codigo=PROPRIEDADE_CODIGO_AREA):
+        self.codigos = []
+        self.propriedades = []
+        # Uma parte por polígono: (índice da área, caixa, arestas)
+        self._partes = []
+        for feature in features:
+            geometria = feature.get('geometry') or {}
+            if geometria.get('type') == 'Polygon':
+                poligonos = [geometria['coordinates']]
+            elif geometria.get('type') == 'MultiPolygon':
+                poligonos = geometria['coordinates']
+            else:
+                continue
+            propriedades = feature.get('properties') or {}
+            codigo = propriedades.get(propriedade_codigo)
+            if codigo is None:
+                continue
+            self.codigos.append(str(codigo))
+            self.propriedades.append(propriedades)
+            for aneis in poligonos:
+                self._partes.append(self._preparar(len(self.codigos) - 1, aneis))
+        self.conjunto_codigos = set(self.codigos)
+        self._construir_grelha()
+
+    @staticmethod
+    def _preparar(indice, aneis):
+        """Arestas de todos os anéis (exterior e buracos) como vetores NumPy"""
+        x1, y1, x2, y2 = [], [], [], []
+        for anel in aneis:
+            pontos = np.asarray(anel, dtype=np.float64)[:, :2]
+            seguintes = np.roll(pontos, -1, axis=0)
+            x1.append(pontos[:, 0])
+            y1.append(pontos[:, 1])
+            x2.append(seguintes[:, 0])
+            y2.append(seguintes[:, 1])
+        x1, y1, x2, y2 = (np.concatenate(v) for v in (x1, y1, x2, y2))
+        # Inverso do declive; as arestas horizontais nunca cruzam o raio
+        altura = y2 - y1
+        declive = np.divide(x2 - x1, altura, out=np.zeros_like(altura), where=altura != 0)
+        caixa = (x1.min(), y1.min(), x1.max(), y1.max())
+        return indice, caixa, (x1, y1, y2, declive)
+
+    def _construir_grelha(self):
+        if not self._partes:
+            self._limites, self._passo, self._divisoes, self._grelha = (0.0, 0.0, 0.0, 0.0), (1.0, 1.0), 1, {}
+            return
+        caixas = np.array([caixa for _, caixa, _ in self._partes])
+        min_x, min_y = caixas[:, 0].min(), caixas[:, 1].min()
+        max_x, max_y = caixas[:, 2].max(), caixas[:, 3].max()
+        self._divisoes = min(512, max(1, int(math.sqrt(len(self._partes)) * 2)))
+        self._limites = (min_x, min_y, max_x, max_y)
+        self._passo = (max((max_x - min_x) / self._divisoes, 1e-9), max((max_y - min_y) / self._divisoes, 1e-9))
+        self._grelha = {}
+        for numero, (_, caixa, _) in enumerate(self._partes):
+            x0, y0 = self._celula(caixa[0], caixa[1])
+            x1, y1 = self._celula(caixa[2], caixa[3])
+            for cx in range(x0, x1 + 1):
+                for cy in range(y0, y1 + 1):
+                    self._grelha.setdefault(cx * self._divisoes + cy, []).append(numero)
+
+    def _celula(self, x, y):
+        cx = int((x - self._limites[0]) / self._passo[0])
+        cy = int((y - self._limites[1]) / self._passo[1])
+        return min(max(cx, 0), self._divisoes - 1), min(max(cy, 0), self._divisoes - 1)
+
+    @staticmethod
+    def _contem(arestas, x, y):
+        """Teste par-ímpar para vetores de pontos, em blocos de TAMANHO_BLOCO elementos"""
+        x1, y1, y2, declive = arestas
+        dentro = np.zeros(len(x), dtype=np.bool_)
+        passo = max(1, TAMANHO_BLOCO // len(x1))
+        for inicio in range(0, len(x), passo):
+            xs = x[inicio:inicio + passo, None]
+            ys = y[inicio:inicio + passo, None]
+            cruza = ((y1 > ys) != (y2 > ys)) & (xs < declive * (ys - y1) + x1)
+            dentro[inicio:inicio + passo] = np.count_nonzero(cruza, axis=1) % 2 == 1
+        return dentro
+
+    def localizar_lote(self, lat, lon):
+        """Índice da área de cada ponto (-1 fora de todas as áreas ou sem coordenadas)"""
+        x = np.asarray(lon, dtype=np.float64)
+        y = np.asarray(lat, dtype=np.float64)
+        resultado = np.full(len(x), -1, dtype=np.int64)
+        if not self._partes or not len(x):
+            return resultado
+
+        min_x, min_y, max_x, max_y = self._limites
+        validos = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)   # False para NaN
+        cx = np.clip(np.floor((x - min_x) / self._passo[0]), 0, self._divisoes - 1)
+        cy = np.clip(np.floor((y - min_y) / self._passo[1]), 0, self._divisoes - 1)
+        celulas = np.where(validos, cx * self._divisoes + cy, -1).astype(np.int64)
+
+        # Agrupar os pontos por célula e testar só as partes registadas nessa célula
+        ordem = np.argsort(celulas, kind='stable')
+        unicas, inicios = np.unique(celulas[ordem], return_index=True)
+        fins = np.append(inicios[1:], len(ordem))
+        for celula, inicio, fim in zip(unicas.tolist(), inicios.tolist(), fins.tolist()):
+            if celula < 0:
+                continue
+            pontos = ordem[inicio:fim]
+            for numero in self._grelha.get(celula, ()):
+                indice, caixa, arestas = self._partes[numero]
+                livres = pontos[resultado[pontos] < 0]
+                if not len(livres):
+                    break
+                px, py = x[livres], y[livres]
+                candidatos = livres[(px >= caixa[0]) & (px <= caixa[2]) & (py >= caixa[1]) & (py <= caixa[3])]
+                if len(candidatos):
+                    resultado[candidatos[self._contem(arestas, x[candidatos], y[candidatos])]] = indice
+        return resultado
+
+    def localizar(self, lat, lon):
+        """Código da área que contém o ponto, ou None"""
+        if lat is None or lon is None:
+            return None
+        indice = self.localizar_lote([lat], [lon])[0]
+        return self.codigos[indice] if indice >= 0 else None
+
+
+def carregar_areas(caminho, propriedade_codigo=PROPRIEDADE_CODIGO_AREA):
+    with open(caminho, encoding='utf-8') as ficheiro:
+        dados = json.load(ficheiro)
+    return IndiceAreas(dados.get('features', []), propriedade_codigo)
+
+
+_indice = None
+_lock = threading.Lock()
+
+
+def indice_areas():
+    """Índice carregado de FICHEIRO_AREAS na primeira utilização, ou None se não configurado"""
+    global _indice
+    if FICHEIRO_AREAS and _indice is None:
+        with _lock:
+            if _indice is None:
+                _indice = carregar_areas(FICHEIRO_AREAS)
+    return _indice
+
+
+def validar_codigo_area(codigo):
+    """Código de área enviado pelo cliente, validado; ValueError se não for aceitável
+
+    Tem de ser mais comprido do que o prefixo do município (senão a hierarquia
+    ficaria com níveis repetidos) e, com FICHEIRO_AREAS configurado, existir nos limites.
+    """
+    if codigo is None or codigo == '':
+        return None
+    if not isinstance(codigo, str):
+        raise ValueError('codigo_area tem de ser texto')
+    if len(codigo) <= max(COMPRIMENTOS_CODIGO_AREA):
+        raise ValueError(f'codigo_area tem de ter mais de {max(COMPRIMENTOS_CODIGO_AREA)} caracteres')
+    indice = indice_areas()
+    if indice is not None and codigo not in indice.conjunto_codigos:
+        raise ValueError(f'codigo_area desconhecido: {codigo}')
+    return codigo
+
+
+def hierarquia_area(codigo):
+    """Códigos de região e município de um código de área (prefixos do próprio código)"""
+    if not codigo:
+        return {'codigo_regiao': None, 'codigo_municipio': None}
+    regiao, municipio = COMPRIMENTOS_CODIGO_AREA
+    return {'codigo_regiao': codigo[:regiao], 'codigo_municipio': codigo[:municipio]}
@@ -0,0 +1,234 @@
+import base64
+import os
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import quote
+
+from flask import redirect
+
+from src.services.envio import enviar_ficheiro
+
+# O backend S3 é opcional (pip install boto3)
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+# Backend das provas: 'local' (pasta partilhada) ou 's3' (qualquer serviço compatível: AWS, MinIO, ...)
+ARMAZENAMENTO_PROVAS = os.environ.get('ARMAZENAMENTO_PROVAS', 'local').lower()
+
+# Backend local: pasta das provas (fora de static: só são servidas pela API, com autenticação)
+PASTA_PROVAS = os.environ.get('PASTA_PROVAS', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'provas'
+))
+
+# Backend S3: bucket, prefixo das chaves e endpoint (vazio para a AWS)
+S3_BUCKET_PROVAS = os.environ.get('S3_BUCKET_PROVAS')
+S3_PREFIXO_PROVAS = os.environ.get('S3_PREFIXO_PROVAS', 'evidence/')
+S3_ENDPOINT_PROVAS = os.environ.get('S3_ENDPOINT_PROVAS') or None
+S3_REGIAO_PROVAS = os.environ.get('S3_REGIAO_PROVAS') or None
+
+# Validade (segundos) dos URLs pré-assinados
+VALIDADE_URL_PROVAS = int(os.environ.get('VALIDADE_URL_PROVAS', 900))
+
+# Pasta local dos temporários quando o backend não é local
+PASTA_TEMPORARIA_PROVAS = os.environ.get('PASTA_TEMPORARIA_PROVAS') or tempfile.gettempdir()
+
+
+class ArmazenamentoLocal:
+    """Provas numa pasta do sistema de ficheiros (um só nó, ou pasta partilhada por NFS)"""
+
+    # Sem URLs pré-assinados: os bytes passam sempre pela API
+    diretos = False
+
+    def __init__(self, pasta=PASTA_PROVAS):
+        self.pasta = pasta
+        os.makedirs(pasta, exist_ok=True)
+
+    @property
+    def pasta_temporaria(self):
+        # Na própria pasta, para que guardar seja um hard link no mesmo sistema de ficheiros
+        return self.pasta
+
+    def caminho(self, chave):
+        return os.path.join(self.pasta, chave)
+
+    def guardar(self, temporario, chave, tipo):
+        """Guardar o temporário em chave se ainda não existir; devolve True se foi criado
+
+        O hard link falha se o destino já existir, por isso dois carregamentos do
+        mesmo conteúdo em simultâneo nunca se sobrepõem.
+        """
+        destino = self.caminho(chave)
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        try:
+            os.link(temporario, destino)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temporario)
+
+    def tamanho(self, chave):
+        try:
+            return os.path.getsize(self.caminho(chave))
+        except FileNotFoundError:
+            return None
+
+    def ler_inicio(self, chave, n):
+        with open(self.caminho(chave), 'rb') as ficheiro:
+            return ficheiro.read(n)
+
+    @contextmanager
+    def ficheiro_local(self, chave):
+        yield self.caminho(chave)
+
+    def remover(self, chave):
+        try:
+            os.remove(self.caminho(chave))
+        except FileNotFoundError:
+            pass
+
+    def listar(self, depois=''):
+        """(chave, tamanho, data de modificação) de todos os ficheiros, por ordem de chave, após depois"""
+        def percorrer(pasta, prefixo):
+            try:
+                entradas = sorted(os.scandir(pasta), key=lambda e: e.name)
+            except FileNotFoundError:
+                return
+            for entrada in entradas:
+                chave = prefixo + entrada.name
+                if entrada.is_dir(follow_symlinks=False):
+                    # Saltar subpastas inteiras já percorridas
+                    if chave + '/' > depois or depois.startswith(chave + '/'):
+                        yield from percorrer(entrada.path, chave + '/')
+                elif chave > depois:
+                    estado = entrada.stat(follow_symlinks=False)
+                    yield chave, estado.st_size, datetime.utcfromtimestamp(estado.st_mtime)
+        yield from percorrer(self.pasta, '')
+
+    def url_carregamento(self, chave, tipo, sha256):
+        return None
+
+    def resposta(self, chave, tipo, etag, nome_download=None):
+        return enviar_ficheiro(self.pasta, chave, tipo, etag, nome_download)
+
+
+class ArmazenamentoS3:
+    """Provas num bucket S3; os clientes podem carregar e descarregar diretamente com URLs pré-assinados"""
+
+    diretos = True
+
+    def __init__(self, bucket=S3_BUCKET_PROVAS, prefixo=S3_PREFIXO_PROVAS, endpoint=S3_ENDPOINT_PROVAS,
+                 regiao=S3_REGIAO_PROVAS, validade=VALIDADE_URL_PROVAS):
+        if boto3 is None:
+            raise RuntimeError('ARMAZENAMENTO_PROVAS=s3 requer o pacote boto3')
+        if not bucket:
+            raise RuntimeError('ARMAZENAMENTO_PROVAS=s3 requer S3_BUCKET_PROVAS')
+        self.bucket = bucket
+        self.prefixo = prefixo
+        self.validade = validade
+        self.pasta_temporaria = PASTA_TEMPORARIA_PROVAS
+        self.cliente = boto3.client('s3', endpoint_url=endpoint, region_name=regiao,
+                                    config=Config(signature_version='s3v4'))
+
+    def _cabecalho(self, chave):
+        try:
+            return self.cliente.head_object(Bucket=self.bucket, Key=self.prefixo + chave)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def guardar(self, temporario, chave, tipo):
+        """Enviar o temporário para chave se ainda não existir; devolve True se foi criado
+
+        As chaves são endereçadas pelo conteúdo: dois envios simultâneos da mesma
+        chave escrevem os mesmos bytes, por isso não há corrida a resolver.
+        """
+        try:
+            if self._cabecalho(chave) is not None:
+                return False
+            self.cliente.upload_file(temporario, self.bucket, self.prefixo + chave, ExtraArgs={'ContentType': tipo})
+            return True
+        finally:
+            os.remove(temporario)
+
+    def tamanho(self, chave):
+        cabecalho = self._cabecalho(chave)
+        return cabecalho['ContentLength'] if cabecalho is not None else None
+
+    def ler_inicio(self, chave, n):
+        resposta = self.cliente.get_object(Bucket=self.bucket, Key=self.prefixo + chave, Range=f'bytes=0-{n - 1}')
+        return resposta['Body'].read()
+
+    @contextmanager
+    def ficheiro_local(self, chave):
+        caminho = os.path.join(self.pasta_temporaria, f'.{uuid.uuid4().hex}.parcial')
+        try:
+            self.cliente.download_file(self.bucket, self.prefixo + chave, caminho)
+            yield caminho
+        finally:
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+
+    def remover(self, chave):
+        self.cliente.delete_object(Bucket=self.bucket, Key=self.prefixo + chave)
+
+    def listar(self, depois=''):
+        paginador = self.cliente.get_paginator('list_objects_v2')
+        for pagina in paginador.paginate(Bucket=self.bucket, Prefix=self.prefixo,
+                                         StartAfter=self.prefixo + depois if depois else ''):
+            for objeto in pagina.get('Contents', []):
+                modificado = objeto['LastModified'].replace(tzinfo=None)
+                yield objeto['Key'][len(self.prefixo):], objeto['Size'], modificado
+
+    def url_carregamento(self, chave, tipo, sha256):
+        """URL e cabeçalhos para o cliente enviar o ficheiro com PUT
+
+        O checksum SHA-256 faz parte da assinatura: o S3 rejeita conteúdo
+        diferente do declarado, por isso a chave continua a ser o hash real.
+        """
+        checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+        url = self.cliente.generate_presigned_url('put_object', Params={
+            'Bucket': self.bucket, 'Key': self.prefixo + chave,
+            'ContentType': tipo, 'ChecksumSHA256': checksum
+        }, ExpiresIn=self.validade)
+        return {
+            'url': url,
+            'metodo': 'PUT',
+            'cabecalhos': {'Content-Type': tipo, 'x-amz-checksum-sha256': checksum},
+            'expira_em': self.validade
+        }
+
+    def resposta(self, chave, tipo, etag, nome_download=None):
+        """Redirecionar para um URL pré-assinado: os bytes vêm diretamente do S3"""
+        parametros = {'Bucket': self.bucket, 'Key': self.prefixo + chave, 'ResponseContentType': tipo}
+        if nome_download:
+            parametros['ResponseContentDisposition'] = f"inline; filename*=UTF-8''{quote(nome_download)}"
+        url = self.cliente.generate_presigned_url('get_object', Params=parametros, ExpiresIn=self.validade)
+        resposta = redirect(url, 302)
+        # O URL expira: o redirecionamento não pode ficar em cache
+        resposta.cache_control.no_store = True
+        return resposta
+
+
+_armazenamento = None
+_lock = threading.Lock()
+
+
+def armazenamento_provas():
+    """Backend configurado em ARMAZENAMENTO_PROVAS, criado na primeira utilização"""
+    global _armazenamento
+    if _armazenamento is None:
+        with _lock:
+            if _armazenamento is None:
+                _armazenamento = ArmazenamentoS3() if ARMAZENAMENTO_PROVAS == 's3' else ArmazenamentoLocal()
+    return _armazenamento
@@ -0,0 +1,129 @@
+import os
+import threading
+from collections import OrderedDict
+
+# O backend Redis é opcional (pip install redis)
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Ex.: redis://localhost:6379/0 (sem valor, usa a cache LRU em memória do processo)
+CACHE_AVALIACOES_URL = os.environ.get('CACHE_AVALIACOES_URL')
+CACHE_AVALIACOES_CAPACIDADE = int(os.environ.get('CACHE_AVALIACOES_CAPACIDADE', 1000))
+CACHE_AVALIACOES_TTL = int(os.environ.get('CACHE_AVALIACOES_TTL', 3600))
+
+
+class CacheMemoriaLRU:
+    """Cache LRU em memória, local a cada processo"""
+
+    def __init__(self, capacidade=CACHE_AVALIACOES_CAPACIDADE):
+        self.capacidade = capacidade
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, chave):
+        with self._lock:
+            valor = self._entradas.get(chave)
+            if valor is not None:
+                self._entradas.move_to_end(chave)
+            return valor
+
+    def guardar(self, chave, valor):
+        with self._lock:
+            self._entradas[chave] = valor
+            self._entradas.move_to_end(chave)
+            while len(self._entradas) > self.capacidade:
+                self._entradas.popitem(last=False)
+
+    def remover(self, chave):
+        with self._lock:
+            self._entradas.pop(chave, None)
+
+    def __len__(self):
+        return len(self._entradas)
+
+
+class CacheRedis:
+    """Cache partilhada entre processos num servidor compatível com o protocolo Redis"""
+
+    def __init__(self, url, prefixo='avaliacao:', ttl=CACHE_AVALIACOES_TTL):
+        if redis is None:
+            raise RuntimeError('CACHE_AVALIACOES_URL definido mas o pacote "redis" não está instalado')
+        self.cliente = redis.Redis.from_url(url)
+        self.prefixo = prefixo
+        self.ttl = ttl
+
+    # Falhas do Redis não devem derrubar o pedido: são tratadas como falhas de cache
+    def obter(self, chave):
+        try:
+            valor = self.cliente.get(f'{self.prefixo}{chave}')
+        except redis.RedisError:
+            return None
+        return valor.decode('utf-8') if valor is not None else None
+
+    def guardar(self, chave, valor):
+        try:
+            self.cliente.set(f'{self.prefixo}{chave}', valor, ex=self.ttl)
+        except redis.RedisError:
+            pass
+
+    def remover(self, chave):
+        try:
+            self.cliente.delete(f'{self.prefixo}{chave}')
+        except redis.RedisError:
+            pass
+
+    def __len__(self):
+        return 0
+
+
+class CacheAvaliacoes:
+    """Cache read-through de avaliações serializadas, validada pela versão da linha"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.acertos = 0
+        self.falhas = 0
+        self.invalidacoes = 0
+
+    def obter(self, avaliacao_id, versao_atual):
+        """Devolver o corpo serializado se a versão em cache coincidir com a da base de dados"""
+        entrada = self.backend.obter(avaliacao_id)
+        if entrada is not None:
+            versao, corpo = entrada.split('\n', 1)
+            if int(versao) == versao_atual:
+                self.acertos += 1
+                return corpo
+            # Outro processo alterou a avaliação: a entrada está obsoleta
+            self.backend.remover(avaliacao_id)
+        self.falhas += 1
+        return None
+
+    def guardar(self, avaliacao_id, versao, corpo):
+        self.backend.guardar(avaliacao_id, f'{versao}\n{corpo}')
+
+    def invalidar(self, avaliacao_id):
+        self.invalidacoes += 1
+        self.backend.remover(avaliacao_id)
+
+    def estatisticas(self):
+        """Contadores deste processo (cada worker tem os seus)"""
+        pedidos = self.acertos + self.falhas
+        return {
+            'backend': type(self.backend).__name__,
+            'entradas': len(self.backend),
+            'acertos': self.acertos,
+            'falhas': self.falhas,
+            'invalidacoes': self.invalidacoes,
+            'taxa_acerto': round(self.acertos / pedidos, 4) if pedidos else 0.0
+        }
+
+
+def criar_cache_avaliacoes():
+    if CACHE_AVALIACOES_URL:
+        return CacheAvaliacoes(CacheRedis(CACHE_AVALIACOES_URL))
+    return CacheAvaliacoes(CacheMemoriaLRU())
+
+
+cache_avaliacoes = criar_cache_avaliacoes()
@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import request
+
+# Durante quanto tempo um resultado é reutilizado depois de calculado (0 desativa)
+JANELA_COALESCENCIA_SEGUNDOS = float(os.environ.get('JANELA_COALESCENCIA_SEGUNDOS', 1.0))
+
+# Espera máxima pelo pedido que já está a calcular o resultado; depois disso cada um calcula o seu
+ESPERA_COALESCENCIA_SEGUNDOS = float(os.environ.get('ESPERA_COALESCENCIA_SEGUNDOS', 5.0))
+
+
+class _Chamada:
+    def __init__(self):
+        self.evento = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+
+def _resultado_sucesso(resultado):
+    return not (isinstance(resultado, tuple) and len(resultado) > 1 and resultado[1] >= 400)
+
+
+class SingleFlight:
+    """Agrupar chamadas idênticas e concorrentes numa só execução"""
+
+    def __init__(self, janela=JANELA_COALESCENCIA_SEGUNDOS, espera=ESPERA_COALESCENCIA_SEGUNDOS):
+        self.janela = janela
+        self.espera = espera
+        self._lock = threading.Lock()
+        self._em_curso = {}
+        self._recentes = {}
+
+    def executar(self, chave, funcao):
+        with self._lock:
+            recente = self._recentes.get(chave)
+            if recente is not None and recente[0] > time.monotonic():
+                return recente[1]
+
+            chamada = self._em_curso.get(chave)
+            lider = chamada is None
+            if lider:
+                chamada = _Chamada()
+                self._em_curso[chave] = chamada
+
+        if not lider:
+            # Esperar pelo pedido que já está a calcular o mesmo resultado; se estiver
+            # bloqueado, não prender também todos os que chegam atrás dele
+            if not chamada.evento.wait(self.espera):
+                return funcao()
+            if chamada.erro is not None:
+                raise chamada.erro
+            return chamada.resultado
+
+        try:
+            chamada.resultado = funcao()
+        except Exception as e:
+            chamada.erro = e
+            raise
+        finally:
+            with self._lock:
+                del self._em_curso[chave]
+                if chamada.erro is None and self.janela > 0 and _resultado_sucesso(chamada.resultado):
+                    agora = time.monotonic()
+                    self._recentes[chave] = (agora + self.janela, chamada.resultado)
+                    if len(self._recentes) > 256:
+                        self._recentes = {c: r for c, r in self._recentes.items() if r[0] > agora}
+            chamada.evento.set()
+
+        return chamada.resultado
+
+    def limpar(self):
+        """Descartar resultados recentes (chamado depois de escritas)"""
+        with self._lock:
+            self._recentes.clear()
+
+
+pedidos_partilhados = SingleFlight()
+
+
+def coalescer(f):
+    """Decorador para leituras quentes: pedidos iguais do mesmo papel partilham o resultado"""
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        utilizador = getattr(request, 'current_user', None)
+        papel = utilizador.papel.value if utilizador is not None else ''
+        consulta = '&'.join(f'{k}={v}' for k, v in sorted(request.args.items(multi=True)))
+        chave = (request.path, consulta, papel)
+        return pedidos_partilhados.executar(chave, lambda: f(*args, **kwargs))
+
+    return decorator
@@ -0,0 +1,127 @@
+import json
+import os
+import zlib
+from tempfile import SpooledTemporaryFile
+
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import ClosingIterator, get_input_stream
+
+# zstandard está em requirements.txt; sem ele os pedidos com Content-Encoding zstd recebem 415
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Tamanho máximo do corpo dos pedidos (MAX_CONTENT_LENGTH); as rotas de carregamento de
+# provas sobem-no para LIMITE_PEDIDO_PROVAS_BYTES com request.max_content_length
+LIMITE_PEDIDO_BYTES = int(os.environ.get('LIMITE_PEDIDO_BYTES', 2 * 1024 * 1024))
+
+# Tamanho máximo do corpo depois de descomprimido (proteção contra "zip bombs")
+LIMITE_DESCOMPRESSAO_BYTES = int(os.environ.get('LIMITE_DESCOMPRESSAO_BYTES', 32 * 1024 * 1024))
+
+# Corpos descomprimidos até este tamanho ficam em memória, acima disso vão para disco
+LIMITE_MEMORIA_BYTES = 1024 * 1024
+
+TAMANHO_BLOCO = 64 * 1024
+
+CODIFICACOES_SUPORTADAS = {'gzip', 'x-gzip', 'deflate'}
+if zstandard is not None:
+    CODIFICACOES_SUPORTADAS.add('zstd')
+
+ERROS_DESCOMPRESSAO = (zlib.error, EOFError)
+if zstandard is not None:
+    ERROS_DESCOMPRESSAO += (zstandard.ZstdError,)
+
+
+def _blocos_zlib(entrada, deflate=False):
+    """Descomprimir gzip/deflate em blocos de tamanho limitado"""
+    # 32 + MAX_WBITS deteta automaticamente cabeçalhos gzip e zlib
+    wbits = 32 + zlib.MAX_WBITS
+    descompressor = zlib.decompressobj(wbits)
+    while True:
+        dados = entrada.read(TAMANHO_BLOCO)
+        if not dados:
+            break
+        if deflate:
+            deflate = False
+            try:
+                zlib.decompressobj(wbits).decompress(dados[:2])
+            except zlib.error:
+                # Alguns clientes enviam deflate "cru" (RFC 1951), sem o cabeçalho zlib
+                wbits = -zlib.MAX_WBITS
+                descompressor = zlib.decompressobj(wbits)
+        while dados:
+            bloco = descompressor.decompress(dados, TAMANHO_BLOCO)
+            if bloco:
+                yield bloco
+            if descompressor.eof and descompressor.unused_data:
+                # gzip com vários membros concatenados
+                dados = descompressor.unused_data
+                descompressor = zlib.decompressobj(wbits)
+            else:
+                dados = descompressor.unconsumed_tail
+
+    if not descompressor.eof:
+        raise EOFError('Corpo comprimido truncado')
+
+
+def _blocos_zstd(entrada):
+    """Descomprimir zstd em blocos de tamanho limitado"""
+    leitor = zstandard.ZstdDecompressor().stream_reader(entrada, read_across_frames=True)
+    while True:
+        bloco = leitor.read(TAMANHO_BLOCO)
+        if not bloco:
+            break
+        yield bloco
+
+
+def _resposta_erro(mensagem, codigo):
+    return Response(json.dumps({'error': mensagem}), status=codigo, mimetype='application/json')
+
+
+class DescompressaoPedidos:
+    """Middleware WSGI que aceita corpos de pedido com Content-Encoding gzip/deflate/zstd"""
+
+    def __init__(self, app, limite=LIMITE_DESCOMPRESSAO_BYTES):
+        self.app = app
+        self.limite = limite
+
+    def __call__(self, environ, start_response):
+        codificacao = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if not codificacao or codificacao == 'identity':
+            return self.app(environ, start_response)
+
+        if codificacao not in CODIFICACOES_SUPORTADAS:
+            resposta = _resposta_erro(f'Content-Encoding não suportado: {codificacao}', 415)
+            return resposta(environ, start_response)
+
+        entrada = get_input_stream(environ)
+        if codificacao == 'zstd':
+            blocos = _blocos_zstd(entrada)
+        else:
+            blocos = _blocos_zlib(entrada, deflate=codificacao == 'deflate')
+
+        # Descomprimir bloco a bloco, abortando assim que o limite é ultrapassado
+        corpo = SpooledTemporaryFile(max_size=LIMITE_MEMORIA_BYTES)
+        total = 0
+        try:
+            for bloco in blocos:
+                total += len(bloco)
+                if total > self.limite:
+                    corpo.close()
+                    resposta = _resposta_erro(
+                        f'Corpo descomprimido excede o limite de {self.limite} bytes', 413)
+                    return resposta(environ, start_response)
+                corpo.write(bloco)
+        except ERROS_DESCOMPRESSAO as e:
+            corpo.close()
+            resposta = _resposta_erro(f'Corpo comprimido inválido: {str(e)}', 400)
+            return resposta(environ, start_response)
+
+        corpo.seek(0)
+        environ['wsgi.input'] = corpo
+        environ['CONTENT_LENGTH'] = str(total)
+        environ.pop('HTTP_CONTENT_ENCODING', None)
+        environ.pop('wsgi.input_terminated', None)
+
+        return ClosingIterator(self.app(environ, start_response), corpo.close)
@@ -0,0 +1,44 @@
+import os
+
+from flask import current_app, request, send_file
+
+# Entrega dos ficheiros de prova: '' (o Python envia os bytes), 'x-accel' (nginx) ou 'x-sendfile' (Apache/lighttpd)
+MODO_ENVIO_PROVAS = os.environ.get('MODO_ENVIO_PROVAS', '').lower()
+
+# Com x-accel: prefixo da location internal do nginx que aponta para a pasta de provas
+PREFIXO_X_ACCEL_PROVAS = os.environ.get('PREFIXO_X_ACCEL_PROVAS', '/_provas/')
+
+# Os ficheiros são endereçados pelo conteúdo: o mesmo URL devolve sempre os mesmos bytes
+MAX_AGE_PROVAS = 365 * 24 * 3600
+
+
+def enviar_ficheiro(pasta, caminho, tipo, etag, nome_download=None):
+    """Resposta com o ficheiro caminho (relativo a pasta)
+
+    O ETag forte é o hash do conteúdo. Sem proxy, o Werkzeug trata If-None-Match,
+    If-Range e Range (206, 416); com x-accel/x-sendfile a resposta não tem corpo,
+    o proxy lê o ficheiro e trata os intervalos, e aqui só se responde 304.
+    """
+    absoluto = os.path.join(pasta, caminho)
+    if MODO_ENVIO_PROVAS in ('x-accel', 'x-sendfile'):
+        resposta = current_app.response_class(mimetype=tipo)
+        if MODO_ENVIO_PROVAS == 'x-accel':
+            resposta.headers['X-Accel-Redirect'] = PREFIXO_X_ACCEL_PROVAS.rstrip('/') + '/' + caminho
+        else:
+            resposta.headers['X-Sendfile'] = absoluto
+        resposta.set_etag(etag)
+        resposta.make_conditional(request)
+        if nome_download:
+            resposta.headers.set('Content-Disposition', 'inline', filename=nome_download)
+    else:
+        resposta = send_file(absoluto, mimetype=tipo, etag=etag, conditional=True,
+                             download_name=nome_download, max_age=MAX_AGE_PROVAS)
+        # O Werkzeug só o indica nas respostas a pedidos com Range
+        resposta.accept_ranges = 'bytes'
+
+    # Respostas autenticadas: só a cache do cliente as guarda
+    resposta.cache_control.public = False
+    resposta.cache_control.private = True
+    resposta.cache_control.max_age = MAX_AGE_PROVAS
+    resposta.cache_control.immutable = True
+    return resposta
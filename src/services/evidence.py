@@ -0,0 +1,464 @@
+import base64
+import fcntl
+import hashlib
+import io
+import json
+import os
+import re
+import time
+import uuid
+
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+from werkzeug.utils import secure_filename
+
+# Pasta (dentro de static/) das provas antigas, guardadas por avaliação antes do armazém por conteúdo
+PASTA_UPLOAD = 'uploads/evidence'
+
+# Limites dos carregamentos de provas
+LIMITE_FICHEIRO_PROVA_BYTES = int(os.environ.get('LIMITE_FICHEIRO_PROVA_BYTES', 100 * 1024 * 1024))
+LIMITE_PEDIDO_PROVAS_BYTES = int(os.environ.get('LIMITE_PEDIDO_PROVAS_BYTES', 300 * 1024 * 1024))
+MAX_FICHEIROS_PEDIDO = 3
+
+# Tamanho dos blocos lidos do pedido e escritos no disco
+TAMANHO_BLOCO = 64 * 1024
+
+# Bytes necessários para reconhecer o tipo pelo conteúdo
+BYTES_ASSINATURA = 12
+
+# Bytes lidos de um ficheiro enviado diretamente para o tipo e as dimensões
+BYTES_INICIO_DIRETO = 64 * 1024
+
+# Tipo MIME de cada extensão permitida
+TIPOS_PROVA = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+    'mp4': 'video/mp4',
+    'mov': 'video/quicktime',
+    'avi': 'video/x-msvideo',
+}
+
+
+# Extensão com que cada tipo é guardado no armazém (o nome do ficheiro é o hash do conteúdo)
+EXTENSAO_TIPO = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/gif': 'gif',
+    'video/mp4': 'mp4',
+    'video/quicktime': 'mov',
+    'video/x-msvideo': 'avi',
+}
+
+
+class ErroProva(Exception):
+    """Carregamento rejeitado; codigo é o estado HTTP a devolver"""
+
+    def __init__(self, mensagem, codigo=400):
+        super().__init__(mensagem)
+        self.codigo = codigo
+
+
+def detetar_tipo(cabecalho):
+    """Tipo MIME a partir dos primeiros bytes (assinatura), ou None se desconhecido"""
+    if cabecalho.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if cabecalho.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if cabecalho[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if cabecalho[:4] == b'RIFF' and cabecalho[8:12] == b'AVI ':
+        return 'video/x-msvideo'
+    if cabecalho[4:8] == b'ftyp':
+        return 'video/quicktime' if cabecalho[8:10] == b'qt' else 'video/mp4'
+    if cabecalho[4:8] in (b'moov', b'mdat', b'wide', b'free', b'skip'):
+        # QuickTime antigo, sem caixa ftyp
+        return 'video/quicktime'
+    return None
+
+
+def _tipos_compativeis(extensao, detetado):
+    esperado = TIPOS_PROVA[extensao]
+    # mp4 e mov partilham o formato ISO BMFF; muitos telemóveis trocam os dois
+    contentores = {'video/mp4', 'video/quicktime'}
+    return detetado == esperado or (detetado in contentores and esperado in contentores)
+
+
+class _FicheiroEmCurso:
+    """Ficheiro a ser escrito por blocos num nome temporário (na pasta temporária do armazenamento)"""
+
+    def __init__(self, pasta, nome_original):
+        self.nome_original = nome_original
+        nome = secure_filename(nome_original or '')
+        extensao = nome.rsplit('.', 1)[1].lower() if '.' in nome else ''
+        if extensao not in TIPOS_PROVA:
+            raise ErroProva(f'Tipo de ficheiro não permitido: {nome_original}')
+        self.nome = nome
+        self.extensao = extensao
+        self.caminho_temporario = os.path.join(pasta, f'.{uuid.uuid4().hex}.parcial')
+        self.ficheiro = open(self.caminho_temporario, 'xb')
+        self.hash = hashlib.sha256()
+        self.tamanho = 0
+        self.cabecalho = b''
+        self.tipo = None
+
+    def escrever(self, dados):
+        self.tamanho += len(dados)
+        if self.tamanho > LIMITE_FICHEIRO_PROVA_BYTES:
+            raise ErroProva(f'Ficheiro demasiado grande: {self.nome_original}', 413)
+        if self.tipo is None and len(self.cabecalho) < BYTES_ASSINATURA:
+            self.cabecalho += dados[:BYTES_ASSINATURA - len(self.cabecalho)]
+            if len(self.cabecalho) >= BYTES_ASSINATURA:
+                self._verificar_tipo()
+        self.hash.update(dados)
+        self.ficheiro.write(dados)
+
+    def _verificar_tipo(self):
+        self.tipo = detetar_tipo(self.cabecalho)
+        if self.tipo is None or not _tipos_compativeis(self.extensao, self.tipo):
+            raise ErroProva(f'O conteúdo não corresponde a um tipo permitido: {self.nome_original}', 415)
+
+    def concluir(self, armazenamento):
+        """Verificar o tipo (ficheiros muito pequenos) e guardar no armazém"""
+        if self.tipo is None:
+            self._verificar_tipo()
+        self.ficheiro.close()
+        return guardar_objeto(armazenamento, self.caminho_temporario, self.hash.hexdigest(), self.tipo,
+                              self.tamanho, self.nome_original)
+
+    def descartar(self):
+        self.ficheiro.close()
+        try:
+            os.remove(self.caminho_temporario)
+        except FileNotFoundError:
+            pass
+
+
+def dimensoes_imagem(ficheiro, tipo):
+    """(largura, altura) lidas do cabeçalho de uma imagem (ficheiro binário aberto), ou (None, None)
+
+    Só lê os bytes necessários: o IHDR do PNG, o ecrã lógico do GIF ou, no JPEG,
+    os segmentos até ao primeiro SOF. Vídeos e ficheiros truncados dão (None, None).
+    """
+    if tipo == 'image/png':
+        cabecalho = ficheiro.read(24)
+        if len(cabecalho) == 24 and cabecalho[12:16] == b'IHDR':
+            return int.from_bytes(cabecalho[16:20], 'big'), int.from_bytes(cabecalho[20:24], 'big')
+    elif tipo == 'image/gif':
+        cabecalho = ficheiro.read(10)
+        if len(cabecalho) == 10:
+            return int.from_bytes(cabecalho[6:8], 'little'), int.from_bytes(cabecalho[8:10], 'little')
+    elif tipo == 'image/jpeg':
+        ficheiro.seek(2)
+        while True:
+            marcador = ficheiro.read(4)
+            if len(marcador) < 4 or marcador[0] != 0xFF:
+                break
+            codigo, comprimento = marcador[1], int.from_bytes(marcador[2:4], 'big')
+            # SOF0..SOF15, exceto DHT (C4), JPG (C8) e DAC (CC)
+            if 0xC0 <= codigo <= 0xCF and codigo not in (0xC4, 0xC8, 0xCC):
+                dados = ficheiro.read(5)
+                if len(dados) == 5:
+                    return int.from_bytes(dados[3:5], 'big'), int.from_bytes(dados[1:3], 'big')
+                break
+            ficheiro.seek(comprimento - 2, os.SEEK_CUR)
+    return None, None
+
+
+def descrever_objeto(nome, sha256, tipo, tamanho, nome_original, dimensoes, novo):
+    """Descrição de um objeto guardado, no formato devolvido pelos carregamentos"""
+    largura, altura = dimensoes
+    return {
+        'nome': nome,
+        'nome_original': nome_original,
+        'tamanho': tamanho,
+        'sha256': sha256,
+        'tipo': tipo,
+        'largura': largura,
+        'altura': altura,
+        'novo': novo
+    }
+
+
+def caminho_objeto(sha256, tipo):
+    """Caminho relativo de um objeto no armazém: <2 primeiros dígitos>/<sha256>.<ext>"""
+    return f'{sha256[:2]}/{sha256}.{EXTENSAO_TIPO[tipo]}'
+
+
+def guardar_objeto(armazenamento, caminho_temporario, sha256, tipo, tamanho, nome_original):
+    """Guardar um ficheiro já verificado no armazém endereçado pelo conteúdo
+
+    Se o objeto já existir o temporário é apenas descartado (novo=False).
+    """
+    with open(caminho_temporario, 'rb') as ficheiro:
+        dimensoes = dimensoes_imagem(ficheiro, tipo)
+    nome = caminho_objeto(sha256, tipo)
+    novo = armazenamento.guardar(caminho_temporario, nome, tipo)
+    return descrever_objeto(nome, sha256, tipo, tamanho, nome_original, dimensoes, novo)
+
+
+def validar_carregamento_direto(nome_original, tamanho, sha256):
+    """Chave e tipo esperado de um ficheiro a enviar diretamente para o armazenamento"""
+    nome = secure_filename(nome_original or '')
+    extensao = nome.rsplit('.', 1)[1].lower() if '.' in nome else ''
+    if extensao not in TIPOS_PROVA:
+        raise ErroProva(f'Tipo de ficheiro não permitido: {nome_original}')
+    if not isinstance(tamanho, int) or tamanho <= 0:
+        raise ErroProva('size deve ser um inteiro positivo')
+    if tamanho > LIMITE_FICHEIRO_PROVA_BYTES:
+        raise ErroProva(f'Ficheiro demasiado grande: {nome_original}', 413)
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256 or ''):
+        raise ErroProva('sha256 deve ter 64 dígitos hexadecimais')
+    tipo = TIPOS_PROVA[extensao]
+    return caminho_objeto(sha256, tipo), tipo
+
+
+def confirmar_carregamento_direto(armazenamento, nome_original, tamanho, sha256):
+    """Verificar um ficheiro enviado diretamente (tamanho e conteúdo) e descrevê-lo
+
+    O conteúdo já foi verificado pelo armazenamento contra o SHA-256 assinado no
+    URL; aqui só se leem os primeiros bytes para o tipo e as dimensões.
+    """
+    nome, esperado = validar_carregamento_direto(nome_original, tamanho, sha256)
+    if armazenamento.tamanho(nome) != tamanho:
+        raise ErroProva('O ficheiro ainda não foi recebido pelo armazenamento', 409)
+    inicio = armazenamento.ler_inicio(nome, BYTES_INICIO_DIRETO)
+    tipo = detetar_tipo(inicio[:BYTES_ASSINATURA])
+    if tipo is None or not _tipos_compativeis(nome.rsplit('.', 1)[1], tipo):
+        armazenamento.remover(nome)
+        raise ErroProva(f'O conteúdo não corresponde a um tipo permitido: {nome_original}', 415)
+    dimensoes = dimensoes_imagem(io.BytesIO(inicio), tipo)
+    return descrever_objeto(nome, sha256, tipo, tamanho, nome_original, dimensoes, True)
+
+
+def receber_ficheiros(stream, boundary, armazenamento, campo='files', tamanho_pedido=None):
+    """Ler um pedido multipart por blocos e gravar cada ficheiro no armazém
+
+    Os limites por ficheiro e por pedido são verificados à medida que os dados
+    chegam; em caso de erro é lançado ErroProva. Os objetos já guardados por
+    este pedido ficam no armazém (podem ser partilhados por outro carregamento
+    em curso) e, sem referências, são removidos pela recolha de lixo.
+    """
+    if tamanho_pedido is not None and tamanho_pedido > LIMITE_PEDIDO_PROVAS_BYTES:
+        raise ErroProva('Pedido demasiado grande', 413)
+    if not boundary:
+        raise ErroProva('Pedido multipart/form-data inválido')
+
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=TAMANHO_BLOCO * 4)
+    gravados = []
+    atual = None
+    total = 0
+    try:
+        while True:
+            evento = decoder.next_event()
+            if isinstance(evento, NeedData):
+                bloco = stream.read(TAMANHO_BLOCO)
+                total += len(bloco)
+                if total > LIMITE_PEDIDO_PROVAS_BYTES:
+                    raise ErroProva('Pedido demasiado grande', 413)
+                decoder.receive_data(bloco or None)
+            elif isinstance(evento, File) and evento.name == campo:
+                if len(gravados) >= MAX_FICHEIROS_PEDIDO:
+                    raise ErroProva(f'Máximo de {MAX_FICHEIROS_PEDIDO} ficheiros permitidos')
+                if not evento.filename:
+                    raise ErroProva('Nenhum ficheiro selecionado')
+                atual = _FicheiroEmCurso(armazenamento.pasta_temporaria, evento.filename)
+            elif isinstance(evento, (File, Field)):
+                # Outros campos do formulário são ignorados
+                atual = None
+            elif isinstance(evento, Data) and atual is not None:
+                atual.escrever(evento.data)
+                if not evento.more_data:
+                    gravados.append(atual.concluir(armazenamento))
+                    atual = None
+            elif isinstance(evento, Epilogue):
+                break
+    except ValueError:
+        if atual is not None:
+            atual.descartar()
+        raise ErroProva('Pedido multipart/form-data inválido')
+    except BaseException:
+        if atual is not None:
+            atual.descartar()
+        raise
+
+    if not gravados:
+        raise ErroProva('Nenhum ficheiro fornecido')
+    return gravados
+
+
+# --- carregamentos retomáveis (protocolo tus 1.0: criação, PATCH com offset, HEAD) ---
+
+VERSAO_TUS = '1.0.0'
+
+# Algoritmos aceites no cabeçalho Upload-Checksum de cada bloco
+ALGORITMOS_CHECKSUM = ('sha256', 'sha1', 'md5')
+
+
+def ler_metadados_tus(valor):
+    """Cabeçalho Upload-Metadata ('chave base64,chave base64') para dicionário"""
+    metadados = {}
+    for par in (valor or '').split(','):
+        partes = par.strip().split(' ', 1)
+        if not partes[0]:
+            continue
+        try:
+            metadados[partes[0]] = base64.b64decode(partes[1]).decode('utf-8') if len(partes) > 1 else ''
+        except (ValueError, UnicodeDecodeError):
+            raise ErroProva('Upload-Metadata inválido')
+    return metadados
+
+
+class CarregamentoRetomavel:
+    """Carregamento parcial guardado em disco: os bytes recebidos (.parcial) e os
+    metadados (.json). O offset é sempre o tamanho do ficheiro parcial, por isso
+    um bloco interrompido a meio só custa reenviar a parte em falta."""
+
+    def __init__(self, pasta, identificador, metadados):
+        self.identificador = identificador
+        self.metadados = metadados
+        self.caminho = os.path.join(pasta, f'{identificador}.parcial')
+        self.caminho_metadados = os.path.join(pasta, f'{identificador}.json')
+
+    @classmethod
+    def criar(cls, pasta, avaliacao_id, nome_original, tamanho):
+        nome = secure_filename(nome_original or '')
+        extensao = nome.rsplit('.', 1)[1].lower() if '.' in nome else ''
+        if extensao not in TIPOS_PROVA:
+            raise ErroProva(f'Tipo de ficheiro não permitido: {nome_original}')
+        if tamanho <= 0:
+            raise ErroProva('Upload-Length deve ser positivo')
+        if tamanho > LIMITE_FICHEIRO_PROVA_BYTES:
+            raise ErroProva(f'Ficheiro demasiado grande: {nome_original}', 413)
+
+        carregamento = cls(pasta, uuid.uuid4().hex, {
+            'avaliacao_id': avaliacao_id,
+            'nome': nome,
+            'nome_original': nome_original,
+            'extensao': extensao,
+            'tamanho': tamanho,
+            'criado': time.time()
+        })
+        open(carregamento.caminho, 'xb').close()
+        with open(carregamento.caminho_metadados, 'x', encoding='utf-8') as ficheiro:
+            json.dump(carregamento.metadados, ficheiro)
+        return carregamento
+
+    @classmethod
+    def abrir(cls, pasta, identificador):
+        """Carregamento existente, ou None"""
+        if not re.fullmatch(r'[0-9a-f]{32}', identificador or ''):
+            return None
+        try:
+            with open(os.path.join(pasta, f'{identificador}.json'), encoding='utf-8') as ficheiro:
+                return cls(pasta, identificador, json.load(ficheiro))
+        except FileNotFoundError:
+            return None
+
+    @property
+    def offset(self):
+        return os.path.getsize(self.caminho)
+
+    @property
+    def tamanho(self):
+        return self.metadados['tamanho']
+
+    def anexar(self, stream, offset, checksum=None, ao_concluir=None):
+        """Acrescentar um bloco a partir de offset; devolve o novo offset
+
+        Com checksum ('algoritmo base64'), um bloco corrompido ou interrompido é
+        descartado (o ficheiro volta ao offset anterior); se não corresponder é
+        lançado ErroProva 460. Quando o ficheiro fica completo, ao_concluir(self)
+        corre ainda com o carregamento bloqueado, por isso um PATCH final repetido
+        nunca conclui duas vezes.
+        """
+        verificacao = None
+        if checksum:
+            algoritmo, _, esperado = checksum.partition(' ')
+            if algoritmo not in ALGORITMOS_CHECKSUM:
+                raise ErroProva(f'Algoritmo de checksum não suportado: {algoritmo}')
+            verificacao = hashlib.new(algoritmo)
+
+        try:
+            ficheiro = open(self.caminho, 'r+b')
+        except FileNotFoundError:
+            raise ErroProva('Carregamento não encontrado', 404)
+        with ficheiro:
+            try:
+                # Um só PATCH de cada vez por carregamento (também entre processos)
+                fcntl.flock(ficheiro, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise ErroProva('Outro bloco deste carregamento está a ser recebido', 409)
+            # Concluído (ou cancelado) por outro pedido entre abrir e bloquear
+            if not os.path.exists(self.caminho_metadados) or not os.path.exists(self.caminho):
+                raise ErroProva('Carregamento não encontrado', 404)
+            atual = os.fstat(ficheiro.fileno()).st_size
+            if offset != atual:
+                raise ErroProva(f'Upload-Offset {offset} não corresponde ao offset atual {atual}', 409)
+
+            ficheiro.seek(atual)
+            recebidos = 0
+            try:
+                while True:
+                    bloco = stream.read(TAMANHO_BLOCO)
+                    if not bloco:
+                        break
+                    recebidos += len(bloco)
+                    if atual + recebidos > self.tamanho:
+                        raise ErroProva('O bloco ultrapassa o Upload-Length declarado', 413)
+                    if verificacao is not None:
+                        verificacao.update(bloco)
+                    ficheiro.write(bloco)
+                if verificacao is not None and base64.b64encode(verificacao.digest()).decode() != esperado.strip():
+                    raise ErroProva('Checksum do bloco não corresponde', 460)
+            except ErroProva:
+                ficheiro.truncate(atual)
+                raise
+            except Exception:
+                # Ligação interrompida a meio do bloco: sem checksum os bytes recebidos
+                # ficam (o cliente retoma a partir do offset devolvido por HEAD); com
+                # checksum não puderam ser verificados e são descartados
+                if verificacao is not None:
+                    ficheiro.truncate(atual)
+                raise
+            ficheiro.flush()
+            os.fsync(ficheiro.fileno())
+
+            offset = atual + recebidos
+            if offset == self.tamanho and ao_concluir is not None:
+                self.metadados['concluindo'] = time.time()
+                self._gravar_metadados()
+                ao_concluir(self)
+            return offset
+
+    def _gravar_metadados(self):
+        temporario = os.path.join(os.path.dirname(self.caminho_metadados), f'.{uuid.uuid4().hex}.parcial')
+        with open(temporario, 'w', encoding='utf-8') as ficheiro:
+            json.dump(self.metadados, ficheiro)
+        os.replace(temporario, self.caminho_metadados)
+
+    def concluir(self, armazenamento):
+        """Verificar o conteúdo e guardar no armazém de provas"""
+        nome_original = self.metadados['nome_original']
+        verificacao = hashlib.sha256()
+        with open(self.caminho, 'rb') as ficheiro:
+            tipo = detetar_tipo(ficheiro.read(BYTES_ASSINATURA))
+            if tipo is None or not _tipos_compativeis(self.metadados['extensao'], tipo):
+                self.descartar()
+                raise ErroProva(f'O conteúdo não corresponde a um tipo permitido: {nome_original}', 415)
+            ficheiro.seek(0)
+            for bloco in iter(lambda: ficheiro.read(TAMANHO_BLOCO * 16), b''):
+                verificacao.update(bloco)
+
+        descricao = guardar_objeto(armazenamento, self.caminho, verificacao.hexdigest(), tipo,
+                                   self.tamanho, nome_original)
+        os.remove(self.caminho_metadados)
+        return descricao
+
+    def descartar(self):
+        for caminho in (self.caminho, self.caminho_metadados):
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+from src.models.assessment import AvaliacaoDesastre
+
+# Parâmetros de consulta aceites e a coluna correspondente
+FILTROS_CATEGORIAS = {
+    'damage_level': 'nivel_danos',
+    'structure_type': 'tipo_estrutura',
+    'urgent_need': 'necessidade_urgente',
+    'area': 'codigo_area',
+    'region': 'codigo_regiao',
+    'municipality': 'codigo_municipio',
+}
+
+
+def _ler_data(valor, parametro, fim=False):
+    """Ler uma data ISO; num limite final só com data, incluir o dia inteiro"""
+    try:
+        data = datetime.fromisoformat(valor)
+    except ValueError:
+        raise ValueError(f'Data inválida em "{parametro}": {valor}')
+    if fim and len(valor) == 10:
+        data += timedelta(days=1)
+    return data
+
+
+def _ler_bbox(valor):
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in valor.split(','))
+    except ValueError:
+        raise ValueError('bbox deve ter o formato min_lon,min_lat,max_lon,max_lat')
+    if min_lon > max_lon or min_lat > max_lat:
+        raise ValueError('bbox inválida: os mínimos devem ser inferiores aos máximos')
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def extrair_filtros(args):
+    """Ler os filtros comuns à listagem e às estatísticas a partir dos parâmetros do pedido"""
+    filtros = {}
+    for parametro, coluna in FILTROS_CATEGORIAS.items():
+        valor = args.get(parametro)
+        if valor:
+            # Aceitar vários valores separados por vírgula
+            filtros[coluna] = [v.strip() for v in valor.split(',') if v.strip()]
+
+    if args.get('date_from'):
+        filtros['data_inicio'] = _ler_data(args['date_from'], 'date_from')
+    if args.get('date_to'):
+        # Limite exclusivo (ver _ler_data)
+        filtros['data_fim'] = _ler_data(args['date_to'], 'date_to', fim=True)
+    if args.get('bbox'):
+        filtros['bbox'] = _ler_bbox(args['bbox'])
+    return filtros
+
+
+def aplicar_filtros(query, filtros):
+    """Aplicar os filtros a uma query sobre AvaliacaoDesastre"""
+    for coluna in FILTROS_CATEGORIAS.values():
+        valores = filtros.get(coluna)
+        if valores:
+            atributo = getattr(AvaliacaoDesastre, coluna)
+            query = query.filter(atributo == valores[0] if len(valores) == 1 else atributo.in_(valores))
+
+    if 'data_inicio' in filtros:
+        query = query.filter(AvaliacaoDesastre.data_criacao >= filtros['data_inicio'])
+    if 'data_fim' in filtros:
+        query = query.filter(AvaliacaoDesastre.data_criacao < filtros['data_fim'])
+    if 'bbox' in filtros:
+        min_lon, min_lat, max_lon, max_lat = filtros['bbox']
+        query = query.filter(
+            AvaliacaoDesastre.latitude_gps.between(min_lat, max_lat),
+            AvaliacaoDesastre.longitude_gps.between(min_lon, max_lon)
+        )
+    return query
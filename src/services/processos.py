@@ -0,0 +1,21 @@
+import multiprocessing
+
+# Módulos carregados uma vez no servidor forkserver; cada processo dos pools é um fork dele
+MODULOS_POOL = ['src.services.thumbnails', 'src.services.recompressao']
+
+
+def contexto_pool():
+    """Contexto 'forkserver' para os pools de processos (miniaturas e recompressão)
+
+    Um fork do processo da aplicação herdaria as threads (recolha, sketches,
+    servidor) e os locks e ligações SQLite que estivessem em uso nesse momento;
+    o forkserver é um processo limpo que só carrega os módulos dos trabalhos.
+    """
+    contexto = multiprocessing.get_context('forkserver')
+    contexto.set_forkserver_preload(MODULOS_POOL)
+    return contexto
+
+
+def processo_principal():
+    """False nos processos dos pools, que importam de novo o módulo __main__ ao arrancar"""
+    return multiprocessing.current_process().name == 'MainProcess'
@@ -0,0 +1,267 @@
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from src.models.user import db
+from src.models.change_log import podar_alteracoes
+from src.models.evidence import (
+    PADRAO_MINIATURA, PADRAO_OBJETO, REFERENCIAS_EM_RECOLHA, HashPerceptual, MiniaturaProva, ObjetoProva
+)
+from src.services.armazenamento import ArmazenamentoLocal, armazenamento_provas
+from src.services.processos import processo_principal
+
+# Idade mínima (segundos) de um ficheiro ou objeto sem referências antes de ser apagado:
+# protege os carregamentos em curso e os envios diretos ainda por confirmar
+CARENCIA_RECOLHA_PROVAS = int(os.environ.get('CARENCIA_RECOLHA_PROVAS', 24 * 3600))
+
+# Entradas examinadas em cada passo (objetos sem referências e ficheiros do armazém)
+LOTE_RECOLHA_PROVAS = int(os.environ.get('LOTE_RECOLHA_PROVAS', 500))
+
+# Operações por segundo no armazenamento (ficheiros examinados + apagados)
+TAXA_RECOLHA_PROVAS = float(os.environ.get('TAXA_RECOLHA_PROVAS', 200))
+
+# Segundos entre passos da recolha em segundo plano; 0 desliga (usar collect_evidence_garbage.py)
+INTERVALO_RECOLHA_PROVAS = int(os.environ.get('INTERVALO_RECOLHA_PROVAS', 0))
+
+# Carregamentos retomáveis sem atividade há mais do que isto (segundos) são descartados
+VALIDADE_CARREGAMENTOS_PARCIAIS = int(os.environ.get('VALIDADE_CARREGAMENTOS_PARCIAIS', 7 * 24 * 3600))
+
+# Temporário de um carregamento ou miniatura ('.<uuid>.parcial')
+PADRAO_TEMPORARIO = re.compile(r'(?:^|/)\.[0-9a-f]{32}\.parcial$')
+
+# Carregamento retomável ('<uuid>.parcial' e '<uuid>.json')
+PADRAO_PARCIAL = re.compile(r'^([0-9a-f]{32})\.(parcial|json)$')
+
+
+class Ritmo:
+    """Limitar as operações a taxa por segundo (dorme o necessário entre lotes)"""
+
+    def __init__(self, taxa):
+        self.taxa = taxa
+        self._proximo = time.monotonic()
+
+    def esperar(self, operacoes):
+        if self.taxa <= 0 or operacoes <= 0:
+            return
+        agora = time.monotonic()
+        self._proximo = max(self._proximo, agora) + operacoes / self.taxa
+        if self._proximo > agora:
+            time.sleep(self._proximo - agora)
+
+
+class RecolhaProvas:
+    """Apagar do armazenamento o que já não é referenciado, um lote de cada vez
+
+    Cada passo trata três coisas:
+    - objetos com referencias = 0 (avaliações eliminadas): a linha, as miniaturas,
+      o hash perceptual e os ficheiros;
+    - ficheiros do armazém sem linha correspondente (carregamentos falhados,
+      envios diretos nunca confirmados, miniaturas órfãs, temporários .parcial);
+    - carregamentos retomáveis abandonados.
+    Os cursores avançam entre passos, por isso uma passagem completa pelo armazém
+    é repartida por muitos passos. Ficheiros desconhecidos (que não seguem as
+    chaves do armazém) nunca são apagados, só contados.
+    """
+
+    def __init__(self, armazenamento=None, pasta_parciais=None, carencia=CARENCIA_RECOLHA_PROVAS,
+                 lote=LOTE_RECOLHA_PROVAS, taxa=TAXA_RECOLHA_PROVAS, simular=False):
+        self.armazenamento = armazenamento or armazenamento_provas()
+        self.pasta_parciais = pasta_parciais
+        self.carencia = carencia
+        self.lote = lote
+        self.simular = simular
+        self.ritmo = Ritmo(taxa)
+        self._cursor_objetos = ''
+        self._cursor_ficheiros = ''
+        self.totais = self._contadores()
+
+    @staticmethod
+    def _contadores():
+        return {'objetos': 0, 'ficheiros': 0, 'parciais': 0, 'desconhecidos': 0, 'bytes': 0}
+
+    def _remover(self, chaves):
+        if not self.simular:
+            for chave in chaves:
+                self.armazenamento.remover(chave)
+        self.ritmo.esperar(len(chaves))
+
+    def recolher_objetos(self, contadores):
+        """Um lote de objetos sem referências; devolve True quando chega ao fim da tabela"""
+        limite = datetime.utcnow() - timedelta(seconds=self.carencia)
+        candidatos = ObjetoProva.query.filter(
+            ObjetoProva.sha256 > self._cursor_objetos,
+            ObjetoProva.referencias <= 0,
+            ObjetoProva.data_criacao < limite
+        ).order_by(ObjetoProva.sha256).limit(self.lote).all()
+
+        objetos = ObjetoProva.__table__
+        miniaturas = MiniaturaProva.__table__
+        hashes = HashPerceptual.__table__
+        apagar = []
+        marcados = []
+        for objeto in candidatos:
+            chaves = [objeto.caminho] + [m.caminho for m in objeto.miniaturas]
+            libertados = objeto.tamanho + sum(m.bytes for m in objeto.miniaturas)
+            if not self.simular:
+                # Só se continuar sem referências: uma prova pode ter chegado entretanto.
+                # A linha fica marcada enquanto os ficheiros são apagados: um carregamento
+                # do mesmo conteúdo que chegue agora é recusado em vez de ficar a apontar
+                # para um ficheiro apagado
+                resultado = db.session.execute(objetos.update().where(
+                    objetos.c.sha256 == objeto.sha256, objetos.c.referencias <= 0
+                ).values(referencias=REFERENCIAS_EM_RECOLHA))
+                if not resultado.rowcount:
+                    continue
+                marcados.append(objeto.sha256)
+            apagar.extend(chaves)
+            contadores['objetos'] += 1
+            contadores['bytes'] += libertados
+        db.session.commit()
+
+        # Os ficheiros só saem depois de as linhas estarem marcadas, e as linhas depois dos ficheiros
+        self._remover(apagar)
+        if marcados:
+            db.session.execute(miniaturas.delete().where(miniaturas.c.sha256.in_(marcados)))
+            db.session.execute(hashes.delete().where(hashes.c.sha256.in_(marcados)))
+            db.session.execute(objetos.delete().where(
+                objetos.c.sha256.in_(marcados), objetos.c.referencias == REFERENCIAS_EM_RECOLHA
+            ))
+            db.session.commit()
+        self._cursor_objetos = candidatos[-1].sha256 if len(candidatos) == self.lote else ''
+        return not self._cursor_objetos
+
+    def recolher_ficheiros(self, contadores):
+        """Um lote de ficheiros do armazém; devolve True quando chega ao fim da listagem"""
+        entradas = []
+        for entrada in self.armazenamento.listar(self._cursor_ficheiros):
+            entradas.append(entrada)
+            if len(entradas) == self.lote:
+                break
+        self.ritmo.esperar(len(entradas))
+
+        # Linhas que referenciam os ficheiros do lote, lidas pela chave primária
+        hashes = set()
+        for chave, _, _ in entradas:
+            correspondencia = PADRAO_OBJETO.search(chave) or PADRAO_MINIATURA.search(chave)
+            if correspondencia:
+                hashes.add(correspondencia.group(1))
+        referenciados = set()
+        if hashes:
+            referenciados.update(caminho for (caminho,) in db.session.query(ObjetoProva.caminho)
+                                 .filter(ObjetoProva.sha256.in_(hashes)))
+            referenciados.update(caminho for (caminho,) in db.session.query(MiniaturaProva.caminho)
+                                 .filter(MiniaturaProva.sha256.in_(hashes)))
+
+        limite = datetime.utcnow() - timedelta(seconds=self.carencia)
+        apagar = []
+        for chave, tamanho, modificado in entradas:
+            conhecido = (PADRAO_OBJETO.search(chave) or PADRAO_MINIATURA.search(chave)
+                         or PADRAO_TEMPORARIO.search(chave))
+            if not conhecido:
+                contadores['desconhecidos'] += 1
+            elif chave not in referenciados and modificado < limite:
+                apagar.append(chave)
+                contadores['ficheiros'] += 1
+                contadores['bytes'] += tamanho
+        self._remover(apagar)
+
+        self._cursor_ficheiros = entradas[-1][0] if len(entradas) == self.lote else ''
+        return not self._cursor_ficheiros
+
+    def recolher_parciais(self, contadores):
+        """Carregamentos retomáveis abandonados e temporários fora do armazém"""
+        agora = time.time()
+        pastas = []
+        if self.pasta_parciais:
+            pastas.append(self.pasta_parciais)
+        # No backend local os temporários estão na pasta do armazém e são listados com ele
+        if not isinstance(self.armazenamento, ArmazenamentoLocal):
+            pastas.append(self.armazenamento.pasta_temporaria)
+
+        for pasta in pastas:
+            try:
+                entradas = list(os.scandir(pasta))
+            except FileNotFoundError:
+                continue
+            # Um carregamento retomável está ativo enquanto o .parcial ou o .json mudarem
+            carregamentos = {}
+            if pasta == self.pasta_parciais:
+                for entrada in entradas:
+                    correspondencia = PADRAO_PARCIAL.match(entrada.name)
+                    if correspondencia:
+                        carregamentos.setdefault(correspondencia.group(1), []).append(entrada)
+
+            apagar = [entrada for entrada in entradas
+                      if PADRAO_TEMPORARIO.search(entrada.name) and agora - entrada.stat().st_mtime > self.carencia]
+            for grupo in carregamentos.values():
+                if agora - max(entrada.stat().st_mtime for entrada in grupo) > VALIDADE_CARREGAMENTOS_PARCIAIS:
+                    apagar.extend(grupo)
+                    contadores['parciais'] += 1
+
+            for entrada in apagar:
+                contadores['bytes'] += entrada.stat().st_size
+                if not self.simular:
+                    try:
+                        os.remove(entrada.path)
+                    except FileNotFoundError:
+                        pass
+            self.ritmo.esperar(len(entradas) + len(apagar))
+
+    def passo(self):
+        """Um lote de objetos e um de ficheiros; devolve (contadores, True no fim de uma passagem pelo armazém)"""
+        contadores = self._contadores()
+        self.recolher_objetos(contadores)
+        completa = self.recolher_ficheiros(contadores)
+        if completa:
+            self.recolher_parciais(contadores)
+        for chave, valor in contadores.items():
+            self.totais[chave] += valor
+        return contadores, completa
+
+    def executar(self):
+        """Uma passagem completa (ainda assim por lotes e ao ritmo configurado); devolve os contadores"""
+        contadores = self._contadores()
+        while not self.recolher_objetos(contadores):
+            pass
+        while not self.recolher_ficheiros(contadores):
+            pass
+        self.recolher_parciais(contadores)
+        return contadores
+
+
+def iniciar_recolha(app, pasta_parciais, intervalo=INTERVALO_RECOLHA_PROVAS):
+    """Correr a recolha numa thread em segundo plano, um passo a cada intervalo segundos
+
+    No fim de cada passagem pelo armazém também poda a sequência de alterações.
+    Com vários processos (gunicorn) cada um tem a sua thread; os passos são
+    idempotentes, por isso basta que cada processo use um intervalo maior.
+    """
+    # Os processos dos pools também importam o módulo da aplicação ao arrancar
+    if intervalo <= 0 or not processo_principal():
+        return None
+
+    def ciclo():
+        recolha = None
+        while True:
+            time.sleep(intervalo)
+            try:
+                with app.app_context():
+                    if recolha is None:
+                        recolha = RecolhaProvas(pasta_parciais=pasta_parciais)
+                    contadores, completa = recolha.passo()
+                    if completa:
+                        # Manutenção da sequência de alterações, uma vez por passagem
+                        podar_alteracoes()
+                        app.logger.info(
+                            'Recolha de provas: %(objetos)d objetos, %(ficheiros)d ficheiros e '
+                            '%(parciais)d carregamentos parciais apagados, %(bytes)d bytes recuperados', recolha.totais
+                        )
+                        recolha.totais = recolha._contadores()
+            except Exception:
+                app.logger.exception('Falha na recolha de provas')
+
+    thread = threading.Thread(target=ciclo, name='recolha-provas', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from src.services.armazenamento import armazenamento_provas
+from src.services.processos import contexto_pool, processo_principal
+
+# A recompressão usa o Pillow, tal como as miniaturas (está em requirements.txt)
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Recomprimir as imagens à entrada (desligado por omissão: o armazém guarda os bytes recebidos)
+RECOMPRIMIR_PROVAS = os.environ.get('RECOMPRIMIR_PROVAS', '0') == '1'
+
+# Lado maior (píxeis) das imagens guardadas; as maiores são reduzidas
+DIMENSAO_MAXIMA_PROVAS = int(os.environ.get('DIMENSAO_MAXIMA_PROVAS', 2560))
+
+# Qualidade JPEG da versão recomprimida (os PNG são recomprimidos sem perdas)
+QUALIDADE_PROVAS = int(os.environ.get('QUALIDADE_PROVAS', 85))
+
+# Processos dedicados à recompressão (o pedido espera pelo resultado, mas o GIL fica livre)
+PROCESSOS_RECOMPRESSAO = int(os.environ.get('PROCESSOS_RECOMPRESSAO', 2))
+
+# Prefixo das chaves das versões recomprimidas no armazém
+PASTA_OTIMIZADAS = 'otimizadas'
+
+# Os GIF podem ser animados: ficam como foram enviados
+TIPOS_RECOMPRESSAO = {'image/jpeg': ('JPEG', 'jpg'), 'image/png': ('PNG', 'png')}
+
+
+def disponivel():
+    return RECOMPRIMIR_PROVAS and Image is not None
+
+
+def avisar_se_indisponivel(app):
+    """Avisar no arranque quando RECOMPRIMIR_PROVAS está ligado mas o Pillow não está instalado"""
+    if RECOMPRIMIR_PROVAS and Image is None and processo_principal():
+        app.logger.warning('RECOMPRIMIR_PROVAS=1 mas o Pillow não está instalado: '
+                           'as imagens são guardadas como foram recebidas')
+
+
+def recomprimir(chave, sha256, tipo, dimensao=DIMENSAO_MAXIMA_PROVAS, qualidade=QUALIDADE_PROVAS):
+    """Recomprimir uma imagem do armazém sem metadados (corre num processo do pool)
+
+    A orientação EXIF é aplicada aos píxeis antes de os metadados saírem; o perfil
+    ICC é mantido para as cores não mudarem. A chave nova deriva do hash original,
+    que continua a identificar o objeto. Devolve None se não houver ganho.
+    """
+    formato, extensao = TIPOS_RECOMPRESSAO[tipo]
+    armazenamento = armazenamento_provas()
+    with armazenamento.ficheiro_local(chave) as caminho, Image.open(caminho) as original:
+        tamanho_original = os.path.getsize(caminho)
+        perfil_icc = original.info.get('icc_profile')
+        original.draft('RGB', (dimensao, dimensao))
+        imagem = ImageOps.exif_transpose(original)
+
+    if max(imagem.size) > dimensao:
+        imagem.thumbnail((dimensao, dimensao), Image.Resampling.LANCZOS)
+    # EXIF (incluindo GPS), XMP e comentários; a transparência de paleta não é metadado
+    imagem.info = {chave_info: valor for chave_info, valor in imagem.info.items() if chave_info == 'transparency'}
+
+    temporario = os.path.join(armazenamento.pasta_temporaria, f'.{uuid.uuid4().hex}.parcial')
+    if formato == 'JPEG':
+        if imagem.mode not in ('RGB', 'L'):
+            imagem = imagem.convert('RGB')
+        imagem.save(temporario, formato, quality=qualidade, optimize=True, progressive=True, icc_profile=perfil_icc)
+    else:
+        imagem.save(temporario, formato, optimize=True, icc_profile=perfil_icc)
+
+    tamanho = os.path.getsize(temporario)
+    if tamanho >= tamanho_original:
+        os.remove(temporario)
+        return None
+    verificacao = hashlib.sha256()
+    with open(temporario, 'rb') as ficheiro:
+        for bloco in iter(lambda: ficheiro.read(1024 * 1024), b''):
+            verificacao.update(bloco)
+
+    chave_nova = f'{PASTA_OTIMIZADAS}/{sha256[:2]}/{sha256}.{extensao}'
+    armazenamento.guardar(temporario, chave_nova, tipo)
+    return {
+        'nome': chave_nova,
+        'tamanho': tamanho,
+        'tamanho_original': tamanho_original,
+        'sha256_conteudo': verificacao.hexdigest(),
+        'largura': imagem.size[0],
+        'altura': imagem.size[1]
+    }
+
+
+class RecompressorProvas:
+    """Pool de processos partilhado para a recompressão das imagens recebidas"""
+
+    def __init__(self, processos=PROCESSOS_RECOMPRESSAO):
+        self.processos = processos
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _obter_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.processos, mp_context=contexto_pool())
+            return self._executor
+
+    def recomprimir(self, gravados):
+        """Recomprimir em paralelo os ficheiros novos que sejam imagens
+
+        Devolve, por ficheiro, a descrição da versão recomprimida, None (nada a
+        fazer ou sem ganho) ou a exceção do processo.
+        """
+        if not disponivel():
+            return [None] * len(gravados)
+        futuros = [
+            self._obter_executor().submit(recomprimir, f['nome'], f['sha256'], f['tipo'])
+            if f['novo'] and f['tipo'] in TIPOS_RECOMPRESSAO else None
+            for f in gravados
+        ]
+        return [(futuro.exception() or futuro.result()) if futuro is not None else None for futuro in futuros]
+
+    def encerrar(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+recompressor_provas = RecompressorProvas()
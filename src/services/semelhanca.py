@@ -0,0 +1,130 @@
+import os
+import threading
+
+import numpy as np
+
+from src.models.user import db
+from src.models.evidence import HashPerceptual
+
+# O hash é calculado no processo das miniaturas, que já tem a imagem aberta (pip install Pillow)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Distância de Hamming máxima aceite nas consultas (acima disto quase tudo é "semelhante")
+MAX_DISTANCIA_SEMELHANCA = int(os.environ.get('MAX_DISTANCIA_SEMELHANCA', 16))
+
+# A imagem é reduzida a LADO_DCT × LADO_DCT e o hash usa as BITS_HASH × BITS_HASH frequências mais baixas
+LADO_DCT = 32
+BITS_HASH = 8
+
+# Matriz da DCT-II ortonormal: a DCT 2D de X é M @ X @ M.T
+_n = np.arange(LADO_DCT)
+_MATRIZ_DCT = np.sqrt(2.0 / LADO_DCT) * np.cos(np.pi * (2 * _n[None, :] + 1) * _n[:, None] / (2 * LADO_DCT))
+_MATRIZ_DCT[0] /= np.sqrt(2.0)
+
+
+def disponivel():
+    return Image is not None
+
+
+def hash_perceptual(imagem):
+    """pHash de 64 bits de uma imagem Pillow, em hexadecimal
+
+    Cada bit diz se uma frequência baixa da DCT da imagem em tons de cinzento está
+    acima da mediana; recompressão, redimensionamento e pequenos ajustes de cor
+    mudam poucos bits.
+    """
+    pixels = np.asarray(imagem.convert('L').resize((LADO_DCT, LADO_DCT), Image.Resampling.LANCZOS),
+                        dtype=np.float64)
+    frequencias = (_MATRIZ_DCT @ pixels @ _MATRIZ_DCT.T)[:BITS_HASH, :BITS_HASH].ravel()
+    # O termo contínuo (brilho médio) fica fora da mediana
+    bits = frequencias > np.median(frequencias[1:])
+    return np.packbits(bits).tobytes().hex()
+
+
+def distancia(a, b):
+    """Distância de Hamming entre dois hashes (inteiros)"""
+    return (a ^ b).bit_count()
+
+
+class ArvoreBK:
+    """Árvore BK sobre a distância de Hamming
+
+    Cada filho fica na aresta com a sua distância ao pai; numa procura com raio r a
+    partir de um nó à distância d só podem ter resultados as arestas entre d - r e
+    d + r (desigualdade triangular), por isso a maior parte da árvore não é visitada.
+    Os nós são tuplos (hash, itens com esse hash, filhos por distância).
+    """
+
+    def __init__(self):
+        self.raiz = None
+        self.tamanho = 0
+
+    def adicionar(self, valor, item):
+        self.tamanho += 1
+        if self.raiz is None:
+            self.raiz = (valor, [item], {})
+            return
+        no = self.raiz
+        while True:
+            d = distancia(valor, no[0])
+            if d == 0:
+                no[1].append(item)
+                return
+            filho = no[2].get(d)
+            if filho is None:
+                no[2][d] = (valor, [item], {})
+                return
+            no = filho
+
+    def procurar(self, valor, maximo):
+        """(distância, item) de todos os itens a distância <= maximo, do mais próximo ao mais afastado"""
+        resultados = []
+        pilha = [self.raiz] if self.raiz is not None else []
+        while pilha:
+            hash_no, itens, filhos = pilha.pop()
+            d = distancia(valor, hash_no)
+            if d <= maximo:
+                resultados.extend((d, item) for item in itens)
+            for aresta, filho in filhos.items():
+                if d - maximo <= aresta <= d + maximo:
+                    pilha.append(filho)
+        resultados.sort()
+        return resultados
+
+
+class IndiceSemelhanca:
+    """Árvore BK dos hashes perceptuais de todo o armazém, local a cada processo
+
+    Construída na primeira consulta e atualizada em cada consulta com as linhas
+    novas (seq crescente). Objetos apagados pela recolha ficam na árvore até o
+    processo reiniciar; quem consulta descarta os hashes sem provas.
+    """
+
+    def __init__(self):
+        self._arvore = ArvoreBK()
+        self._ultimo_seq = 0
+        self._lock = threading.Lock()
+
+    def _atualizar(self):
+        novos = db.session.query(HashPerceptual.seq, HashPerceptual.sha256, HashPerceptual.valor).filter(
+            HashPerceptual.seq > self._ultimo_seq
+        ).order_by(HashPerceptual.seq).all()
+        for _, sha256, valor in novos:
+            self._arvore.adicionar(int(valor, 16), sha256)
+        if novos:
+            self._ultimo_seq = novos[-1][0]
+
+    def semelhantes(self, valor, maximo):
+        """(distância, sha256) dos objetos a distância <= maximo do hash valor (hexadecimal)"""
+        with self._lock:
+            self._atualizar()
+            return self._arvore.procurar(int(valor, 16), maximo)
+
+    def __len__(self):
+        return self._arvore.tamanho
+
+
+indice_semelhanca = IndiceSemelhanca()
@@ -0,0 +1,35 @@
+from flask import make_response, request
+import msgpack
+
+MIMETYPE_MSGPACK = 'application/msgpack'
+
+
+def _colunar(data):
+    """Converter uma lista de dicionários em colunas + linhas (chaves enviadas uma só vez)"""
+    colunas = list(data[0].keys()) if data else []
+    return {
+        'colunas': colunas,
+        'linhas': [[linha.get(coluna) for coluna in colunas] for linha in data]
+    }
+
+
+def saida_msgpack(data, code, headers=None):
+    """Representação MessagePack para respostas Flask-RESTX"""
+    if (request.args.get('layout') == 'columnar' and isinstance(data, list)
+            and all(isinstance(linha, dict) for linha in data)):
+        data = _colunar(data)
+
+    resposta = make_response(msgpack.packb(data, use_bin_type=True), code)
+    resposta.headers.extend(headers or {})
+    resposta.headers['Content-Type'] = MIMETYPE_MSGPACK
+    return resposta
+
+
+def ler_payload(api):
+    """Obter o corpo do pedido em JSON ou MessagePack consoante o Content-Type"""
+    if request.mimetype in (MIMETYPE_MSGPACK, 'application/x-msgpack'):
+        try:
+            return msgpack.unpackb(request.get_data(), raw=False)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError):
+            return None
+    return api.payload
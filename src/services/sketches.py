@@ -0,0 +1,253 @@
+import hashlib
+import math
+import os
+import threading
+import time
+from array import array
+
+from flask import current_app
+
+from src.models.assessment import AvaliacaoDesastre
+from src.models.change_log import alteracoes_desde, ultima_alteracao
+from src.services.analytics import INTERVALO_SINCRONIZACAO_SEGUNDOS
+
+# Reconstruir os sketches quando as alterações não refletidas passam esta fração das linhas
+LIMIAR_RECONSTRUCAO = float(os.environ.get('SKETCHES_LIMIAR_RECONSTRUCAO', 0.05))
+
+
+class HyperLogLog:
+    """Contagem aproximada de valores distintos
+
+    Com p=14 (16384 registos, 16 KiB) o erro padrão é 1.04 / sqrt(2^p) ~= 0.81%.
+    Não suporta remoções: valores eliminados continuam contados até à reconstrução.
+    """
+
+    def __init__(self, p=14):
+        self.p = p
+        self.m = 1 << p
+        self.registos = bytearray(self.m)
+        self._estimativa = None
+
+    @property
+    def erro_padrao(self):
+        return 1.04 / math.sqrt(self.m)
+
+    def adicionar(self, valor):
+        h = int.from_bytes(hashlib.blake2b(valor.encode('utf-8'), digest_size=8).digest(), 'big')
+        indice = h >> (64 - self.p)
+        resto = h & ((1 << (64 - self.p)) - 1)
+        rho = (64 - self.p) - resto.bit_length() + 1
+        if rho > self.registos[indice]:
+            self.registos[indice] = rho
+            self._estimativa = None
+
+    def estimativa(self):
+        if self._estimativa is None:
+            alfa = 0.7213 / (1 + 1.079 / self.m)
+            estimativa = alfa * self.m * self.m / sum(2.0 ** -r for r in self.registos)
+            zeros = self.registos.count(0)
+            if estimativa <= 2.5 * self.m and zeros:
+                # Correção para cardinalidades pequenas (linear counting)
+                estimativa = self.m * math.log(self.m / zeros)
+            self._estimativa = int(round(estimativa))
+        return self._estimativa
+
+
+class SketchQuantis:
+    """Sketch de quantis com erro relativo garantido (estilo DDSketch)
+
+    Cada valor x > 0 cai no intervalo ceil(log_gama(x)); o quantil devolvido
+    está a menos de `alfa` (erro relativo) do valor exato. Suporta remoções.
+    """
+
+    def __init__(self, alfa=0.01):
+        self.alfa = alfa
+        self.gama = (1 + alfa) / (1 - alfa)
+        self._log_gama = math.log(self.gama)
+        self.contagens = {}
+        self.total = 0
+
+    def _chave(self, valor):
+        return math.ceil(math.log(valor) / self._log_gama) if valor > 0 else None
+
+    def adicionar(self, valor, n=1):
+        chave = self._chave(valor)
+        self.contagens[chave] = self.contagens.get(chave, 0) + n
+        if not self.contagens[chave]:
+            del self.contagens[chave]
+        self.total += n
+
+    def quantil(self, q):
+        if self.total <= 0:
+            return None
+        posicao = q * (self.total - 1)
+        acumulado = 0
+        # A chave None (valores <= 0) ordena-se antes de todas as outras
+        for chave in sorted(self.contagens, key=lambda c: float('-inf') if c is None else c):
+            acumulado += self.contagens[chave]
+            if acumulado > posicao:
+                if chave is None:
+                    return 0.0
+                return 2 * self.gama ** chave / (self.gama + 1)
+        return None
+
+
+def normalizar_texto(texto):
+    """Forma usada para contar documentos e endereços distintos (exata e aproximada)"""
+    return (texto or '').strip().lower()
+
+
+class _EstadoSketches:
+    """Sketches de todas as avaliações até à posição seq da sequência de alterações"""
+
+    def __init__(self):
+        self.documentos = HyperLogLog()
+        self.enderecos = HyperLogLog()
+        self.membros = SketchQuantis()
+        # Valor de membros_agregado por id, para remover o valor antigo em atualizações
+        self.membros_por_id = array('i')
+        # Hash do documento e do endereço por id, para saber se uma atualização os mudou
+        self.textos_por_id = array('q')
+        self.linhas = 0
+        self.nao_refletidas = 0
+        self.seq = ultima_alteracao()
+        self.ultima_sincronizacao = time.monotonic()
+
+    @classmethod
+    def construir(cls):
+        estado = cls()
+        ultimo_id = 0
+        while True:
+            linhas = _ler(AvaliacaoDesastre.id > ultimo_id, limite=50000)
+            if not linhas:
+                break
+            for linha in linhas:
+                estado.adicionar(*linha)
+            ultimo_id = linhas[-1][0]
+        return estado
+
+    @staticmethod
+    def _textos(documento, endereco):
+        return hash((normalizar_texto(documento), normalizar_texto(endereco)))
+
+    def adicionar(self, avaliacao_id, documento, endereco, membros):
+        self.documentos.adicionar(normalizar_texto(documento))
+        self.enderecos.adicionar(normalizar_texto(endereco))
+        membros = membros or 0
+        self.membros.adicionar(membros)
+        if avaliacao_id >= len(self.membros_por_id):
+            falta = avaliacao_id + 1 - len(self.membros_por_id)
+            self.membros_por_id.extend([-1] * falta)
+            self.textos_por_id.extend([0] * falta)
+        self.membros_por_id[avaliacao_id] = membros
+        self.textos_por_id[avaliacao_id] = self._textos(documento, endereco)
+        self.linhas += 1
+
+    def remover(self, avaliacao_id, nova=None):
+        """Tirar uma linha dos sketches; nova é a linha atualizada, que volta a ser adicionada"""
+        if avaliacao_id < len(self.membros_por_id) and self.membros_por_id[avaliacao_id] >= 0:
+            self.membros.adicionar(self.membros_por_id[avaliacao_id], -1)
+            self.membros_por_id[avaliacao_id] = -1
+            self.linhas -= 1
+            # O HyperLogLog não esquece o documento/endereço antigo: só fica desatualizado
+            # se a linha foi eliminada ou um deles mudou
+            if nova is None or self._textos(nova[1], nova[2]) != self.textos_por_id[avaliacao_id]:
+                self.nao_refletidas += 1
+
+    @property
+    def desatualizado(self):
+        return self.nao_refletidas > LIMIAR_RECONSTRUCAO * max(self.linhas, 1)
+
+
+def _ler(condicao, limite=None):
+    query = AvaliacaoDesastre.query.with_entities(
+        AvaliacaoDesastre.id,
+        AvaliacaoDesastre.numero_documento,
+        AvaliacaoDesastre.endereco_completo,
+        AvaliacaoDesastre.membros_agregado
+    ).filter(condicao).order_by(AvaliacaoDesastre.id)
+    return (query.limit(limite) if limite else query).all()
+
+
+class SketchesAvaliacoes:
+    """Sketches globais das avaliações, mantidos a partir da sequência de alterações
+
+    A construção completa (na primeira utilização e quando as remoções não
+    refletidas passam o limiar) corre numa thread em segundo plano; entretanto
+    as consultas usam os sketches anteriores ou, se ainda não houver nenhuns,
+    o cálculo exato. Cada consulta só aplica as alterações desde a última.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._estado = None
+        self._construcao = None
+
+    def _construir_em_fundo(self):
+        if self._construcao is not None and self._construcao.is_alive():
+            return
+        app = current_app._get_current_object()
+
+        def construir():
+            try:
+                with app.app_context():
+                    estado = _EstadoSketches.construir()
+            except Exception:
+                app.logger.exception('Falha ao construir os sketches das avaliações')
+                return
+            with self._lock:
+                self._estado = estado
+
+        self._construcao = threading.Thread(target=construir, name='sketches-avaliacoes', daemon=True)
+        self._construcao.start()
+
+    def sincronizar(self):
+        """Sketches atualizados com as alterações recentes, ou None enquanto não estão construídos"""
+        with self._lock:
+            estado = self._estado
+            if estado is None:
+                self._construir_em_fundo()
+                return None
+            if time.monotonic() - estado.ultima_sincronizacao < INTERVALO_SINCRONIZACAO_SEGUNDOS:
+                return estado
+            estado.ultima_sincronizacao = time.monotonic()
+
+            resultado = alteracoes_desde(estado.seq)
+            if resultado is None:
+                # Sequência podada além da posição dos sketches: só uma construção completa os corrige
+                self._construir_em_fundo()
+                return estado
+            ids, estado.seq = resultado
+            ids = sorted(ids)
+            for inicio in range(0, len(ids), 500):
+                lote = ids[inicio:inicio + 500]
+                novas = {linha[0]: linha for linha in _ler(AvaliacaoDesastre.id.in_(lote))}
+                for avaliacao_id in lote:
+                    nova = novas.get(avaliacao_id)
+                    estado.remover(avaliacao_id, nova)
+                    if nova is not None:
+                        estado.adicionar(*nova)
+            if estado.desatualizado:
+                self._construir_em_fundo()
+            return estado
+
+    def resumo(self, percentis):
+        """Resumo aproximado, ou None se os sketches ainda estiverem a ser construídos"""
+        estado = self.sincronizar()
+        if estado is None:
+            return None
+        with self._lock:
+            return {
+                'aproximado': True,
+                'total_avaliacoes': estado.linhas,
+                'agregados_distintos': estado.documentos.estimativa(),
+                'enderecos_distintos': estado.enderecos.estimativa(),
+                'percentis_membros': {f'p{p:g}': estado.membros.quantil(p / 100) for p in percentis},
+                'erro': {
+                    'distintos_erro_padrao_relativo': round(estado.documentos.erro_padrao, 4),
+                    'percentis_erro_relativo_maximo': estado.membros.alfa
+                }
+            }
+
+
+sketches_avaliacoes = SketchesAvaliacoes()
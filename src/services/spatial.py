@@ -0,0 +1,421 @@
+import heapq
+import math
+import os
+import threading
+
+import numpy as np
+
+from src.models.assessment import NIVEIS_DANOS
+from src.services.analytics import instantaneo_avaliacoes
+
+# Zoom máximo com agrupamento; acima disto devolvem-se os pontos individuais
+ZOOM_MAXIMO_CLUSTERS = int(os.environ.get('ZOOM_MAXIMO_CLUSTERS', 14))
+
+# Cada mosaico de 256 px é dividido em 2^BITS_CELULA × 2^BITS_CELULA células (64 px com 2)
+BITS_CELULA = 2
+
+# Células visíveis admitidas por pedido (evita varrer o mundo inteiro num zoom alto)
+MAX_CELULAS_PEDIDO = 65536
+
+# Entradas pendentes por nível antes de as fundir nos vetores ordenados
+LIMITE_DELTA = 4096
+
+LATITUDE_MAXIMA = 85.05112878
+
+# Colunas dos agregados por célula: contagem, soma das latitudes, soma das longitudes
+# e uma contagem por nível de danos (a última posição agrupa valores fora do vocabulário)
+N_NIVEIS = len(NIVEIS_DANOS) + 1
+LARGURA = 3 + N_NIVEIS
+
+
+def celulas(lat, lon, divisoes):
+    """Coordenadas (x, y) Web Mercator das células para vetores de latitude/longitude"""
+    lat = np.radians(np.clip(np.asarray(lat, dtype=np.float64), -LATITUDE_MAXIMA, LATITUDE_MAXIMA))
+    lon = np.asarray(lon, dtype=np.float64)
+    x = np.floor((lon + 180.0) / 360.0 * divisoes)
+    y = np.floor((1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * divisoes)
+    return (np.clip(x, 0, divisoes - 1).astype(np.int64),
+            np.clip(y, 0, divisoes - 1).astype(np.int64))
+
+
+class NivelClusters:
+    """Agregados por célula de um nível de zoom: vetores ordenados pela chave x*divisoes+y
+    mais um dicionário de alterações ainda não fundidas"""
+
+    def __init__(self, zoom):
+        self.zoom = zoom
+        self.divisoes = 2 ** (zoom + BITS_CELULA)
+        self.chaves = np.empty(0, dtype=np.int64)
+        self.valores = np.empty((0, LARGURA), dtype=np.float64)
+        self.delta = {}
+
+    def _linhas(self, colunas):
+        """Chaves, coordenadas e códigos de danos por linha (linhas sem coordenadas ficam de fora)"""
+        lat = colunas['latitude_gps'].astype(np.float64)
+        lon = colunas['longitude_gps'].astype(np.float64)
+        validas = ~(np.isnan(lat) | np.isnan(lon))
+        lat, lon = lat[validas], lon[validas]
+        x, y = celulas(lat, lon, self.divisoes)
+        niveis = np.minimum(colunas['nivel_danos'][validas], N_NIVEIS - 1).astype(np.int64)
+        return x * self.divisoes + y, lat, lon, niveis
+
+    @staticmethod
+    def _somar(chaves, contagens, lat, lon, niveis):
+        """Agregar por chave com np.bincount (muito mais rápido do que np.add.at)"""
+        unicas, inverso = np.unique(chaves, return_inverse=True)
+        inverso = inverso.ravel()
+        n = len(unicas)
+        valores = np.empty((n, LARGURA), dtype=np.float64)
+        valores[:, 0] = np.bincount(inverso, weights=contagens, minlength=n)
+        valores[:, 1] = np.bincount(inverso, weights=lat, minlength=n)
+        valores[:, 2] = np.bincount(inverso, weights=lon, minlength=n)
+        valores[:, 3:] = np.bincount(
+            inverso * N_NIVEIS + niveis, weights=contagens, minlength=n * N_NIVEIS
+        ).reshape(n, N_NIVEIS)
+        return unicas, valores
+
+    def construir(self, colunas):
+        chaves, lat, lon, niveis = self._linhas(colunas)
+        self.chaves, self.valores = self._somar(chaves, np.ones(len(chaves)), lat, lon, niveis)
+        self.delta = {}
+
+    def ajustar(self, colunas, sinal):
+        chaves, lat, lon, niveis = self._linhas(colunas)
+        for chave, la, lo, nivel in zip(chaves.tolist(), lat.tolist(), lon.tolist(), niveis.tolist()):
+            contribuicao = self.delta.get(chave)
+            if contribuicao is None:
+                contribuicao = self.delta[chave] = np.zeros(LARGURA, dtype=np.float64)
+            contribuicao[0] += sinal
+            contribuicao[1] += sinal * la
+            contribuicao[2] += sinal * lo
+            contribuicao[3 + nivel] += sinal
+        if len(self.delta) > LIMITE_DELTA:
+            self.fundir()
+
+    def fundir(self):
+        """Incorporar o dicionário de alterações nos vetores ordenados"""
+        if not self.delta:
+            return
+        chaves = np.concatenate([self.chaves, np.fromiter(self.delta, dtype=np.int64, count=len(self.delta))])
+        valores = np.vstack([self.valores, np.array(list(self.delta.values()))])
+        self.chaves, inverso = np.unique(chaves, return_inverse=True)
+        self.valores = np.zeros((len(self.chaves), LARGURA), dtype=np.float64)
+        for coluna in range(LARGURA):
+            self.valores[:, coluna] = np.bincount(inverso.ravel(), weights=valores[:, coluna], minlength=len(self.chaves))
+        # Células que ficaram vazias depois de eliminações
+        ocupadas = self.valores[:, 0] > 0.5
+        self.chaves, self.valores = self.chaves[ocupadas], self.valores[ocupadas]
+        self.delta = {}
+
+    def consultar(self, x0, x1, y0, y1):
+        """Agregados das células no retângulo [x0, x1] × [y0, y1]"""
+        partes = []
+        for x in range(x0, x1 + 1):
+            inicio = np.searchsorted(self.chaves, x * self.divisoes + y0)
+            fim = np.searchsorted(self.chaves, x * self.divisoes + y1, side='right')
+            if fim > inicio:
+                partes.append((self.chaves[inicio:fim], self.valores[inicio:fim]))
+        resultado = {}
+        for chaves, valores in partes:
+            resultado.update(zip(chaves.tolist(), valores))
+        for chave, contribuicao in self.delta.items():
+            x, y = divmod(chave, self.divisoes)
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                atual = resultado.get(chave)
+                resultado[chave] = contribuicao if atual is None else atual + contribuicao
+        return [v for v in resultado.values() if v[0] > 0.5]
+
+
+class IndiceClusters:
+    """Índice hierárquico (um nível por zoom) derivado do instantâneo colunar e
+    mantido incrementalmente pelas alterações que o instantâneo aplica"""
+
+    def __init__(self, instantaneo):
+        self._lock = threading.Lock()
+        self._instantaneo = instantaneo
+        self._niveis = None
+        instantaneo.subscrever(self)
+
+    # --- notificações do instantâneo (chamadas com o instantâneo bloqueado) ---
+
+    def invalidar(self):
+        with self._lock:
+            self._niveis = None
+
+    def reordenado(self):
+        # Os agregados não dependem das posições das linhas no instantâneo
+        pass
+
+    def aplicar(self, antigos, novos):
+        with self._lock:
+            if self._niveis is None:
+                return
+            for nivel in self._niveis:
+                nivel.ajustar(antigos, -1.0)
+                nivel.ajustar(novos, 1.0)
+
+    # --- consulta ---
+
+    def _construir(self, colunas):
+        ativas = colunas['ativo']
+        colunas = {c: colunas[c][ativas] for c in ('latitude_gps', 'longitude_gps', 'nivel_danos')}
+        niveis = []
+        for zoom in range(ZOOM_MAXIMO_CLUSTERS + 1):
+            nivel = NivelClusters(zoom)
+            nivel.construir(colunas)
+            niveis.append(nivel)
+        self._niveis = niveis
+
+    def clusters(self, bbox, zoom):
+        """Clusters visíveis na bbox; acima de ZOOM_MAXIMO_CLUSTERS devolve pontos individuais"""
+        min_lon, min_lat, max_lon, max_lat = bbox
+
+        def calcular(instantaneo, colunas):
+            if zoom > ZOOM_MAXIMO_CLUSTERS:
+                return self._pontos(instantaneo, colunas, bbox)
+            with self._lock:
+                if self._niveis is None:
+                    self._construir(colunas)
+                nivel = self._niveis[zoom]
+                x0, y0 = celulas([max_lat], [min_lon], nivel.divisoes)
+                x1, y1 = celulas([min_lat], [max_lon], nivel.divisoes)
+                x0, x1, y0, y1 = int(x0[0]), int(x1[0]), int(y0[0]), int(y1[0])
+                if (x1 - x0 + 1) * (y1 - y0 + 1) > MAX_CELULAS_PEDIDO:
+                    raise ValueError('bbox demasiado grande para o zoom pedido')
+                valores = nivel.consultar(x0, x1, y0, y1)
+
+            vocabulario = instantaneo.vocabularios['nivel_danos']
+            resultado = []
+            for v in valores:
+                contagem = v[0]
+                dominante = int(np.argmax(v[3:]))
+                resultado.append({
+                    'contagem': int(round(contagem)),
+                    'latitude': round(float(v[1] / contagem), 6),
+                    'longitude': round(float(v[2] / contagem), 6),
+                    'nivel_danos_dominante': vocabulario[dominante] if dominante < N_NIVEIS - 1 else None
+                })
+            resultado.sort(key=lambda c: -c['contagem'])
+            return resultado
+
+        return self._instantaneo.consultar(calcular)
+
+    def _pontos(self, instantaneo, colunas, bbox):
+        selecao = instantaneo.mascara(colunas, {'bbox': bbox})
+        if selecao.sum() > MAX_CELULAS_PEDIDO:
+            raise ValueError('bbox demasiado grande para o zoom pedido')
+        vocabulario = instantaneo.vocabularios['nivel_danos']
+        return [{
+            'contagem': 1,
+            'latitude': round(float(lat), 6),
+            'longitude': round(float(lon), 6),
+            'nivel_danos_dominante': vocabulario[nivel],
+            'id': int(i)
+        } for i, lat, lon, nivel in zip(
+            colunas['id'][selecao], colunas['latitude_gps'][selecao],
+            colunas['longitude_gps'][selecao], colunas['nivel_danos'][selecao]
+        )]
+
+
+# --- vizinhos mais próximos ---
+
+RAIO_TERRA_METROS = 6371008.8
+
+# Pontos por folha da árvore KD
+TAMANHO_FOLHA = 32
+
+# Linhas alteradas desde a construção (fração do total) antes de reconstruir a árvore
+LIMIAR_RECONSTRUCAO_ARVORE = float(os.environ.get('LIMIAR_RECONSTRUCAO_ARVORE', 0.05))
+
+
+def vetores_unitarios(lat, lon):
+    """Coordenadas em graus para vetores 3D na esfera unitária
+
+    A distância euclidiana (corda) entre vetores cresce com a distância do
+    grande círculo, por isso a árvore KD pode trabalhar em 3D sem distorção
+    junto aos polos ou ao antimeridiano.
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)])
+
+
+def corda_para_metros(corda2):
+    """Quadrado da corda entre vetores unitários para distância do grande círculo (igual à haversine)"""
+    return RAIO_TERRA_METROS * 2.0 * math.asin(min(1.0, math.sqrt(corda2) / 2.0))
+
+
+class ArvoreKD:
+    """Árvore KD estática sobre vetores 3D; os nós guardam intervalos do vetor reordenado"""
+
+    def __init__(self, pontos, posicoes):
+        self.pontos = pontos
+        self.posicoes = posicoes
+        self.inicio, self.fim, self.esquerda, self.direita = [], [], [], []
+        self.minimo, self.maximo = [], []
+        if len(pontos):
+            self._construir()
+
+    def _novo_no(self, inicio, fim):
+        bloco = self.pontos[inicio:fim]
+        self.inicio.append(inicio)
+        self.fim.append(fim)
+        self.esquerda.append(-1)
+        self.direita.append(-1)
+        self.minimo.append(tuple(bloco.min(axis=0).tolist()))
+        self.maximo.append(tuple(bloco.max(axis=0).tolist()))
+        return len(self.inicio) - 1
+
+    def _construir(self):
+        pendentes = [self._novo_no(0, len(self.pontos))]
+        while pendentes:
+            no = pendentes.pop()
+            inicio, fim = self.inicio[no], self.fim[no]
+            if fim - inicio <= TAMANHO_FOLHA:
+                continue
+            # Dividir pela mediana do eixo com maior amplitude
+            eixo = int(np.argmax(np.subtract(self.maximo[no], self.minimo[no])))
+            meio = (inicio + fim) // 2
+            ordem = np.argpartition(self.pontos[inicio:fim, eixo], meio - inicio)
+            self.pontos[inicio:fim] = self.pontos[inicio:fim][ordem]
+            self.posicoes[inicio:fim] = self.posicoes[inicio:fim][ordem]
+            self.esquerda[no] = self._novo_no(inicio, meio)
+            self.direita[no] = self._novo_no(meio, fim)
+            pendentes.extend((self.esquerda[no], self.direita[no]))
+
+    def _distancia_caixa(self, no, q):
+        total = 0.0
+        for v, mn, mx in zip(q, self.minimo[no], self.maximo[no]):
+            if v < mn:
+                total += (mn - v) ** 2
+            elif v > mx:
+                total += (v - mx) ** 2
+        return total
+
+    def vizinhos(self, q, k, aceitar):
+        """Os k pontos mais próximos de q aceites por aceitar(inicio, fim) -> máscara booleana
+
+        Devolve pares (quadrado da corda, posição no instantâneo).
+        """
+        melhores = []   # heap de máximo via (-distância, posição)
+        if not self.inicio:
+            return []
+        fila = [(0.0, 0)]
+        q_lista = tuple(q.tolist())
+        while fila:
+            distancia_no, no = heapq.heappop(fila)
+            if len(melhores) == k and distancia_no > -melhores[0][0]:
+                break
+            if self.esquerda[no] >= 0:
+                for filho in (self.esquerda[no], self.direita[no]):
+                    heapq.heappush(fila, (self._distancia_caixa(filho, q_lista), filho))
+                continue
+
+            inicio, fim = self.inicio[no], self.fim[no]
+            diferencas = self.pontos[inicio:fim] - q
+            distancias = np.einsum('ij,ij->i', diferencas, diferencas)
+            aceites = aceitar(inicio, fim)
+            for d, posicao in zip(distancias[aceites].tolist(), self.posicoes[inicio:fim][aceites].tolist()):
+                if len(melhores) < k:
+                    heapq.heappush(melhores, (-d, posicao))
+                elif d < -melhores[0][0]:
+                    heapq.heapreplace(melhores, (-d, posicao))
+        return [(-d, posicao) for d, posicao in melhores]
+
+
+class IndiceVizinhos:
+    """Árvore KD sobre as coordenadas do instantâneo colunar
+
+    Linhas alteradas depois da construção são retiradas da árvore (marcadas como
+    inválidas) e procuradas por força bruta numa lista de posições pendentes; a
+    árvore é reconstruída quando essa lista passa de LIMIAR_RECONSTRUCAO_ARVORE.
+    """
+
+    def __init__(self, instantaneo):
+        self._lock = threading.Lock()
+        self._instantaneo = instantaneo
+        self._arvore = None
+        instantaneo.subscrever(self)
+
+    # --- notificações do instantâneo (chamadas com o instantâneo bloqueado) ---
+
+    def invalidar(self):
+        with self._lock:
+            self._arvore = None
+
+    def reordenado(self):
+        # A árvore guarda posições no instantâneo, que mudaram
+        self.invalidar()
+
+    def aplicar(self, antigos, novos):
+        with self._lock:
+            if self._arvore is not None:
+                self._alterados.update(antigos['id'].tolist())
+                self._alterados.update(novos['id'].tolist())
+
+    # --- consulta ---
+
+    def _construir(self, colunas):
+        lat = colunas['latitude_gps']
+        lon = colunas['longitude_gps']
+        posicoes = np.flatnonzero(colunas['ativo'] & ~(np.isnan(lat) | np.isnan(lon)))
+        self._arvore = ArvoreKD(vetores_unitarios(lat[posicoes], lon[posicoes]), posicoes)
+        # Posição no instantâneo -> posição na árvore
+        self._posicao_na_arvore = np.full(len(lat), -1, dtype=np.int64)
+        self._posicao_na_arvore[self._arvore.posicoes] = np.arange(len(posicoes))
+        self._valido = np.ones(len(posicoes), dtype=np.bool_)
+        self._pendentes = np.empty(0, dtype=np.int64)
+        self._alterados = set()
+
+    def _atualizar(self, instantaneo, colunas):
+        if self._arvore is not None and self._alterados:
+            ids = np.array(sorted(self._alterados), dtype=np.int64)
+            posicoes, existe = instantaneo.localizar(ids)
+            posicoes = posicoes[existe]
+            na_arvore = posicoes[posicoes < len(self._posicao_na_arvore)]
+            na_arvore = self._posicao_na_arvore[na_arvore]
+            self._valido[na_arvore[na_arvore >= 0]] = False
+            self._pendentes = np.union1d(self._pendentes, posicoes)
+            self._alterados = set()
+        if self._arvore is None or len(self._pendentes) > LIMIAR_RECONSTRUCAO_ARVORE * max(len(self._valido), 1000):
+            self._construir(colunas)
+
+    def vizinhos(self, lat, lon, k, filtros):
+        """As k avaliações mais próximas de (lat, lon) que cumprem os filtros
+
+        Devolve pares (id, distância em metros) por ordem crescente de distância.
+        """
+        q = vetores_unitarios([lat], [lon])[0]
+
+        def calcular(instantaneo, colunas):
+            with self._lock:
+                self._atualizar(instantaneo, colunas)
+                arvore = self._arvore
+
+                def aceitar_posicoes(posicoes):
+                    if filtros:
+                        return instantaneo.mascara({c: v[posicoes] for c, v in colunas.items()}, filtros)
+                    return colunas['ativo'][posicoes]
+
+                def aceitar(inicio, fim):
+                    return self._valido[inicio:fim] & aceitar_posicoes(arvore.posicoes[inicio:fim])
+
+                candidatos = arvore.vizinhos(q, k, aceitar)
+
+                # Linhas alteradas depois da construção: força bruta
+                pendentes = self._pendentes
+                if len(pendentes):
+                    pontos = vetores_unitarios(colunas['latitude_gps'][pendentes], colunas['longitude_gps'][pendentes])
+                    distancias = ((pontos - q) ** 2).sum(axis=1)
+                    aceites = aceitar_posicoes(pendentes) & ~np.isnan(distancias)
+                    candidatos.extend(zip(distancias[aceites].tolist(), pendentes[aceites].tolist()))
+
+            candidatos.sort()
+            return [(int(colunas['id'][posicao]), corda_para_metros(d)) for d, posicao in candidatos[:k]]
+
+        return self._instantaneo.consultar(calcular)
+
+
+indice_clusters = IndiceClusters(instantaneo_avaliacoes)
+indice_vizinhos = IndiceVizinhos(instantaneo_avaliacoes)
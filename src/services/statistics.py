@@ -0,0 +1,374 @@
+import math
+from datetime import datetime, timedelta
+from itertools import product
+
+from src.models.user import db
+from src.models.assessment import (
+    AvaliacaoDesastre, GRUPOS_VULNERAVEIS, NIVEIS_DANOS, TIPOS_ESTRUTURA, TIPOS_PERDAS, NECESSIDADES_URGENTES
+)
+from src.models.rollup import RollupArea, RollupHorario, truncar_hora
+from src.services.areas import NIVEIS_AREA
+from src.services.analytics import motor_analitico
+from src.services.filters import FILTROS_CATEGORIAS, aplicar_filtros
+from src.services.sketches import normalizar_texto
+
+# Dimensões disponíveis no cubo e os valores conhecidos de cada eixo
+DIMENSOES_CUBO = {
+    'nivel_danos': NIVEIS_DANOS,
+    'tipo_estrutura': TIPOS_ESTRUTURA,
+    'necessidade_urgente': NECESSIDADES_URGENTES,
+}
+
+# count = agregados familiares, people = pessoas afetadas (soma de membros_agregado)
+MEDIDAS_CUBO = {
+    'count': lambda: db.func.count(AvaliacaoDesastre.id),
+    'people': lambda: db.func.coalesce(db.func.sum(AvaliacaoDesastre.membros_agregado), 0),
+}
+
+
+def ler_lista(valor, permitidos, nome):
+    """Ler uma lista separada por vírgulas, validando os valores"""
+    itens = [v.strip() for v in (valor or '').split(',') if v.strip()]
+    invalidos = [v for v in itens if v not in permitidos]
+    if invalidos:
+        raise ValueError(f'Valores inválidos em "{nome}": {", ".join(invalidos)}')
+    if len(set(itens)) != len(itens):
+        raise ValueError(f'Valores repetidos em "{nome}"')
+    return itens
+
+
+def calcular_cubo(filtros, dimensoes, medidas):
+    """Calcular uma tabulação cruzada numa só passagem GROUP BY
+
+    O resultado é denso: para cada medida, uma lista plana em ordem row-major
+    com o produto dos eixos (índice = ((i0 * n1) + i1) * n2 + i2 ...).
+    """
+    motor = motor_analitico()
+    if motor is not None:
+        return motor.cubo(filtros, dimensoes, medidas)
+
+    colunas = [getattr(AvaliacaoDesastre, d) for d in dimensoes]
+    agregados = [MEDIDAS_CUBO[m]() for m in medidas]
+    linhas = aplicar_filtros(db.session.query(*colunas, *agregados), filtros)
+    if colunas:
+        linhas = linhas.group_by(*colunas)
+    linhas = linhas.all()
+
+    # Eixos pela ordem das opções; valores inesperados na base de dados vão para o fim
+    eixos = {d: list(DIMENSOES_CUBO[d]) for d in dimensoes}
+    for linha in linhas:
+        for d, valor in zip(dimensoes, linha):
+            if valor not in eixos[d]:
+                eixos[d].append(valor)
+
+    posicoes = {d: {valor: i for i, valor in enumerate(eixos[d])} for d in dimensoes}
+    forma = [len(eixos[d]) for d in dimensoes]
+    tamanho = 1
+    for n in forma:
+        tamanho *= n
+
+    valores = {m: [0] * tamanho for m in medidas}
+    for linha in linhas:
+        indice = 0
+        for d, n, valor in zip(dimensoes, forma, linha):
+            indice = indice * n + posicoes[d][valor]
+        for m, valor in zip(medidas, linha[len(dimensoes):]):
+            valores[m][indice] = int(valor or 0)
+
+    return {
+        'dimensoes': dimensoes,
+        'eixos': eixos,
+        'forma': forma,
+        'medidas': valores
+    }
+
+
+def calcular_estatisticas(filtros):
+    """Total e contagens por categoria, somando as margens do cubo das três dimensões"""
+    dimensoes = list(DIMENSOES_CUBO)
+    cubo = calcular_cubo(filtros, dimensoes, ['count'])
+    contagens = cubo['medidas']['count']
+    margens = {d: {} for d in dimensoes}
+    indices = product(*[range(n) for n in cubo['forma']])
+    for indice, n in zip(indices, contagens):
+        if not n:
+            continue
+        for d, i in zip(dimensoes, indice):
+            valor = cubo['eixos'][d][i]
+            margens[d][valor] = margens[d].get(valor, 0) + n
+
+    return {
+        'total_avaliacoes': sum(contagens),
+        'estatisticas_nivel_danos': margens['nivel_danos'],
+        'estatisticas_tipo_estrutura': margens['tipo_estrutura'],
+        'estatisticas_necessidade_urgente': margens['necessidade_urgente']
+    }
+
+
+def _contagens_mascaras(histograma, opcoes):
+    """Contagens por opção e matriz de co-ocorrência a partir de {máscara: n}"""
+    n_opcoes = len(opcoes)
+    matriz = [[0] * n_opcoes for _ in range(n_opcoes)]
+    for mascara, n in histograma.items():
+        bits = [i for i in range(n_opcoes) if mascara & (1 << i)]
+        for i in bits:
+            for j in bits:
+                matriz[i][j] += n
+    return {
+        # A diagonal da matriz é a contagem de cada opção
+        'contagens': {opcao: matriz[i][i] for i, opcao in enumerate(opcoes)},
+        'coocorrencia': {'eixo': opcoes, 'matriz': matriz}
+    }
+
+
+def calcular_multivalor(filtros):
+    """Estatísticas de grupos vulneráveis e perdas a partir das máscaras de bits
+
+    Uma só passagem GROUP BY sobre (mascara_grupos, mascara_perdas) devolve no
+    máximo 2^4 * 2^7 linhas, expandidas aqui sem descodificar JSON linha a linha.
+    """
+    motor = motor_analitico()
+    if motor is not None:
+        total, histograma_grupos, histograma_perdas = motor.histograma_mascaras(filtros)
+    else:
+        linhas = aplicar_filtros(db.session.query(
+            AvaliacaoDesastre.mascara_grupos,
+            AvaliacaoDesastre.mascara_perdas,
+            db.func.count(AvaliacaoDesastre.id)
+        ), filtros).group_by(
+            AvaliacaoDesastre.mascara_grupos,
+            AvaliacaoDesastre.mascara_perdas
+        ).all()
+
+        total = 0
+        histograma_grupos = {}
+        histograma_perdas = {}
+        for mascara_grupos, mascara_perdas, n in linhas:
+            total += n
+            histograma_grupos[mascara_grupos] = histograma_grupos.get(mascara_grupos, 0) + n
+            histograma_perdas[mascara_perdas] = histograma_perdas.get(mascara_perdas, 0) + n
+
+    return {
+        'total_avaliacoes': total,
+        'grupos_vulneraveis': _contagens_mascaras(histograma_grupos, GRUPOS_VULNERAVEIS),
+        'perdas': _contagens_mascaras(histograma_perdas, TIPOS_PERDAS)
+    }
+
+
+# Tamanho de cada intervalo das séries temporais
+BUCKETS_TEMPORAIS = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+
+MAX_INTERVALOS_SERIE = 20000
+
+
+def calcular_serie_temporal(filtros, bucket, por=None):
+    """Séries de registos por hora/dia lidas do rollup horário, sem varrer as avaliações
+
+    Cada hora do rollup tem no máximo uma linha por combinação de categorias,
+    por isso semanas de dados são centenas de linhas, não milhões.
+    """
+    if 'bbox' in filtros:
+        raise ValueError('O filtro bbox não é suportado nas séries temporais')
+
+    if bucket == 'hour':
+        coluna_tempo = RollupHorario.hora
+    else:
+        coluna_tempo = db.func.date(RollupHorario.hora)
+    colunas = [coluna_tempo] + ([getattr(RollupHorario, por)] if por else [])
+
+    query = db.session.query(
+        *colunas,
+        db.func.sum(RollupHorario.contagem),
+        db.func.sum(RollupHorario.pessoas)
+    )
+    for parametro, coluna in FILTROS_CATEGORIAS.items():
+        if filtros.get(coluna):
+            if not hasattr(RollupHorario, coluna):
+                raise ValueError(f'O filtro {parametro} não é suportado nas séries temporais')
+            query = query.filter(getattr(RollupHorario, coluna).in_(filtros[coluna]))
+    # O rollup tem resolução horária: os limites são arredondados à hora
+    if 'data_inicio' in filtros:
+        query = query.filter(RollupHorario.hora >= truncar_hora(filtros['data_inicio']))
+    if 'data_fim' in filtros:
+        query = query.filter(RollupHorario.hora < filtros['data_fim'])
+    linhas = query.group_by(*colunas).having(db.func.sum(RollupHorario.contagem) != 0).all()
+
+    valores = {}
+    for linha in linhas:
+        inicio = linha[0] if bucket == 'hour' else datetime.strptime(linha[0], '%Y-%m-%d')
+        serie = linha[1] if por else 'total'
+        valores[(inicio, serie)] = (int(linha[-2]), int(linha[-1]))
+
+    # Eixo temporal contínuo entre o primeiro e o último intervalo com dados
+    intervalos = []
+    if valores:
+        passo = BUCKETS_TEMPORAIS[bucket]
+        atual = min(inicio for inicio, _ in valores)
+        fim = max(inicio for inicio, _ in valores)
+        if (fim - atual) / passo >= MAX_INTERVALOS_SERIE:
+            raise ValueError('Intervalo demasiado longo para este bucket: use date_from/date_to ou bucket=day')
+        while atual <= fim:
+            intervalos.append(atual)
+            atual += passo
+
+    # Séries pela ordem das opções; valores inesperados no fim
+    ordem = DIMENSOES_CUBO.get(por, [])
+    nomes_series = sorted({serie for _, serie in valores},
+                          key=lambda v: (ordem.index(v) if v in ordem else len(ordem), v))
+    series = {}
+    for serie in nomes_series:
+        pontos = [valores.get((inicio, serie), (0, 0)) for inicio in intervalos]
+        series[serie] = {
+            'contagem': [p[0] for p in pontos],
+            'pessoas': [p[1] for p in pontos]
+        }
+
+    return {
+        'bucket': bucket,
+        'por': por,
+        'intervalos': [inicio.isoformat() for inicio in intervalos],
+        'series': series
+    }
+
+
+def calcular_agregados(filtros, percentis):
+    """Agregados distintos, endereços distintos e percentis do agregado familiar (exatos)"""
+    def distintos(coluna):
+        # Normalizado em Python, tal como nos sketches (o lower() do SQLite só trata ASCII)
+        valores = aplicar_filtros(db.session.query(coluna), filtros).execution_options(yield_per=10000)
+        return len({normalizar_texto(valor) for (valor,) in valores})
+
+    # Histograma de membros_agregado (poucos valores distintos) para percentis exatos
+    histograma = aplicar_filtros(db.session.query(
+        AvaliacaoDesastre.membros_agregado,
+        db.func.count(AvaliacaoDesastre.id)
+    ), filtros).group_by(AvaliacaoDesastre.membros_agregado).order_by(AvaliacaoDesastre.membros_agregado).all()
+    total = sum(n for _, n in histograma)
+
+    def percentil(q):
+        if not total:
+            return None
+        posicao = q * (total - 1)
+        acumulado = 0
+        for valor, n in histograma:
+            acumulado += n
+            if acumulado > posicao:
+                return float(valor or 0)
+
+    return {
+        'aproximado': False,
+        'total_avaliacoes': total,
+        'agregados_distintos': distintos(AvaliacaoDesastre.numero_documento),
+        'enderecos_distintos': distintos(AvaliacaoDesastre.endereco_completo),
+        'percentis_membros': {f'p{p:g}': percentil(p / 100) for p in percentis},
+        'erro': None
+    }
+
+
+# Grelha de densidade: graus de latitude por metro e limite de células por pedido
+METROS_POR_GRAU = 111320.0
+MAX_CELULAS_GRELHA = 4000000
+
+# Pesos aceites na grelha (None = contar avaliações)
+PESOS_GRELHA = {
+    'count': None,
+    'membros_agregado': 'membros_agregado',
+}
+
+
+def calcular_grelha(filtros, cell_m, peso='count'):
+    """Mapa de densidade numa grelha regular de cell_m metros sobre a bbox
+
+    A largura das células em longitude é corrigida pela latitude do centro da
+    bbox. O resultado é esparso: índices planos (linha * colunas + coluna, com a
+    linha 0 no sul) e os valores das células não vazias.
+    """
+    if 'bbox' not in filtros:
+        raise ValueError('bbox é obrigatório')
+    if cell_m <= 0:
+        raise ValueError('cell_m deve ser positivo')
+    if peso not in PESOS_GRELHA:
+        raise ValueError(f'weight deve ser um de: {", ".join(PESOS_GRELHA)}')
+
+    min_lon, min_lat, max_lon, max_lat = filtros['bbox']
+    latitude_centro = math.radians((min_lat + max_lat) / 2)
+    passo_lat = cell_m / METROS_POR_GRAU
+    passo_lon = cell_m / (METROS_POR_GRAU * max(math.cos(latitude_centro), 0.01))
+    forma = [max(1, math.ceil((max_lat - min_lat) / passo_lat)),
+             max(1, math.ceil((max_lon - min_lon) / passo_lon))]
+    if forma[0] * forma[1] > MAX_CELULAS_GRELHA:
+        raise ValueError('Demasiadas células: aumente cell_m ou reduza a bbox')
+
+    coluna_peso = PESOS_GRELHA[peso]
+    motor = motor_analitico()
+    if motor is not None:
+        indices, valores = motor.grelha(filtros, (min_lon, min_lat), (passo_lon, passo_lat), forma, coluna_peso)
+    else:
+        linha = db.cast((AvaliacaoDesastre.latitude_gps - min_lat) / passo_lat, db.Integer)
+        coluna = db.cast((AvaliacaoDesastre.longitude_gps - min_lon) / passo_lon, db.Integer)
+        if coluna_peso:
+            medida = db.func.coalesce(db.func.sum(getattr(AvaliacaoDesastre, coluna_peso)), 0)
+        else:
+            medida = db.func.count(AvaliacaoDesastre.id)
+        linhas = aplicar_filtros(db.session.query(linha, coluna, medida), filtros).group_by(linha, coluna).all()
+
+        celulas = {}
+        for i, j, valor in linhas:
+            # Pontos em cima do limite superior da bbox ficam na última célula
+            indice = min(i, forma[0] - 1) * forma[1] + min(j, forma[1] - 1)
+            celulas[indice] = celulas.get(indice, 0) + int(valor or 0)
+        indices = sorted(i for i, valor in celulas.items() if valor)
+        valores = [celulas[i] for i in indices]
+
+    return {
+        'origem': [min_lon, min_lat],
+        'passo': [passo_lon, passo_lat],
+        'forma': forma,
+        'peso': peso,
+        'total': sum(valores),
+        'indices': indices,
+        'valores': valores
+    }
+
+
+def calcular_areas(nivel, pai=None):
+    """Contagens, pessoas e necessidades por área de um nível, lidas do rollup por área
+
+    Com pai, devolve só as áreas dentro dessa área do nível acima (drill-down).
+    """
+    if nivel not in NIVEIS_AREA:
+        raise ValueError(f'level deve ser um de: {", ".join(NIVEIS_AREA)}')
+    if pai and nivel == next(iter(NIVEIS_AREA)):
+        raise ValueError(f'parent não se aplica ao nível {nivel}')
+
+    query = db.session.query(
+        RollupArea.codigo,
+        RollupArea.codigo_pai,
+        RollupArea.necessidade_urgente,
+        RollupArea.contagem,
+        RollupArea.pessoas
+    ).filter(RollupArea.nivel == nivel, RollupArea.contagem != 0)
+    if pai:
+        query = query.filter(RollupArea.codigo_pai == pai)
+
+    areas = {}
+    for codigo, codigo_pai, necessidade, contagem, pessoas in query.order_by(RollupArea.codigo):
+        area = areas.setdefault(codigo, {
+            'codigo': codigo,
+            'codigo_pai': codigo_pai,
+            'contagem': 0,
+            'pessoas': 0,
+            'necessidades': {}
+        })
+        area['contagem'] += contagem
+        area['pessoas'] += pessoas
+        area['necessidades'][necessidade] = contagem
+
+    return {
+        'nivel': nivel,
+        'pai': pai,
+        'areas': list(areas.values())
+    }
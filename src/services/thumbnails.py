@@ -0,0 +1,123 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from src.services.armazenamento import armazenamento_provas
+from src.services.processos import contexto_pool
+from src.services.semelhanca import hash_perceptual
+
+# Pillow está em requirements.txt; sem ele não há miniaturas e a rota de pré-visualização responde 501
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+# Lado maior (píxeis) de cada versão reduzida
+TAMANHOS_MINIATURA = [int(n) for n in os.environ.get('TAMANHOS_MINIATURA', '160,480,1280').split(',')]
+
+# Processos dedicados à geração (fora do caminho dos pedidos)
+PROCESSOS_MINIATURAS = int(os.environ.get('PROCESSOS_MINIATURAS', 2))
+
+# Prefixo das chaves das versões reduzidas no armazém
+PASTA_MINIATURAS = 'miniaturas'
+
+# Formatos gerados para cada tamanho: (formato Pillow, tipo MIME, extensão, opções)
+FORMATOS_MINIATURA = [
+    ('WEBP', 'image/webp', 'webp', {'quality': 80, 'method': 4}),
+    ('JPEG', 'image/jpeg', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+]
+
+TIPOS_COM_MINIATURA = {'image/png', 'image/jpeg', 'image/gif'}
+
+
+def disponivel():
+    return Image is not None
+
+
+def _formatos():
+    if features.check('webp'):
+        return FORMATOS_MINIATURA
+    return [formato for formato in FORMATOS_MINIATURA if formato[0] != 'WEBP']
+
+
+def gerar_miniaturas(chave, sha256, tamanhos=TAMANHOS_MINIATURA):
+    """Gerar as versões reduzidas de uma imagem do armazém (corre num processo do pool)
+
+    Os tamanhos são gerados do maior para o menor, cada um a partir do anterior,
+    e só os menores que a imagem original. Devolve uma descrição por ficheiro e o
+    hash perceptual, calculado aqui porque a imagem já está descodificada.
+    """
+    armazenamento = armazenamento_provas()
+    with armazenamento.ficheiro_local(chave) as caminho, Image.open(caminho) as original:
+        # No JPEG o descodificador pode reduzir logo por 2/4/8, o que evita
+        # descodificar a imagem inteira para obter uma miniatura pequena
+        original.draft('RGB', (max(tamanhos), max(tamanhos)))
+        imagem = ImageOps.exif_transpose(original)
+        imagem = imagem.convert('RGBA' if imagem.mode in ('RGBA', 'LA', 'P') else 'RGB')
+    hash_imagem = hash_perceptual(imagem)
+
+    miniaturas = []
+    for tamanho in sorted(tamanhos, reverse=True):
+        if tamanho >= max(imagem.size) and miniaturas:
+            continue
+        imagem.thumbnail((tamanho, tamanho), Image.Resampling.LANCZOS)
+        for formato, tipo, extensao, opcoes in _formatos():
+            versao = imagem.convert('RGB') if formato == 'JPEG' and imagem.mode != 'RGB' else imagem
+            temporario = os.path.join(armazenamento.pasta_temporaria, f'.{uuid.uuid4().hex}.parcial')
+            versao.save(temporario, formato, **opcoes)
+            tamanho_ficheiro = os.path.getsize(temporario)
+            caminho_miniatura = f'{PASTA_MINIATURAS}/{sha256[:2]}/{sha256}_{tamanho}.{extensao}'
+            armazenamento.guardar(temporario, caminho_miniatura, tipo)
+            miniaturas.append({
+                'tamanho': tamanho,
+                'tipo': tipo,
+                'caminho': caminho_miniatura,
+                'largura': imagem.size[0],
+                'altura': imagem.size[1],
+                'bytes': tamanho_ficheiro
+            })
+    return miniaturas, hash_imagem
+
+
+def calcular_hash(chave):
+    """Só o hash perceptual de uma imagem do armazém (imagens que já têm miniaturas)"""
+    with armazenamento_provas().ficheiro_local(chave) as caminho, Image.open(caminho) as original:
+        # A mesma descodificação reduzida que gerar_miniaturas, para o hash ser igual
+        original.draft('RGB', (max(TAMANHOS_MINIATURA), max(TAMANHOS_MINIATURA)))
+        return hash_perceptual(ImageOps.exif_transpose(original))
+
+
+class GeradorMiniaturas:
+    """Pool de processos partilhado; o resultado é entregue a um callback no processo principal"""
+
+    def __init__(self, processos=PROCESSOS_MINIATURAS):
+        self.processos = processos
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _obter_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.processos, mp_context=contexto_pool())
+            return self._executor
+
+    def agendar(self, chave, sha256, tipo, concluido):
+        """Pedir as miniaturas de um objeto; concluido(sha256, (miniaturas, hash perceptual) ou exceção)
+
+        Não faz nada sem Pillow ou para tipos sem miniatura (vídeos).
+        """
+        if not disponivel() or tipo not in TIPOS_COM_MINIATURA:
+            return None
+        futuro = self._obter_executor().submit(gerar_miniaturas, chave, sha256)
+        futuro.add_done_callback(lambda f: concluido(sha256, f.exception() or f.result()))
+        return futuro
+
+    def encerrar(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+gerador_miniaturas = GeradorMiniaturas()
@@ -0,0 +1,99 @@
+import os
+import sys
+import tempfile
+
+# Pastas de provas e carregamentos parciais temporárias; lidas quando os módulos são importados
+PASTA_TESTES = tempfile.mkdtemp(prefix='testes-avaliacoes-')
+os.environ.setdefault('PASTA_PROVAS', os.path.join(PASTA_TESTES, 'provas'))
+os.environ.setdefault('PASTA_CARREGAMENTOS_PARCIAIS', os.path.join(PASTA_TESTES, 'parciais'))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from flask import Flask
+from flask_restx import Api
+
+from src.models.user import db, Usuario, TipoUtilizador
+from src.models.assessment import AvaliacaoDesastre
+from src.models.migracoes import aplicar_migracoes
+from src.routes.assessment_swagger import api as api_avaliacoes
+from src.routes.auth import gerar_token
+from src.services.analytics import instantaneo_avaliacoes
+from src.services.compression import LIMITE_PEDIDO_BYTES, DescompressaoPedidos
+
+# Avaliação mínima válida; os testes alteram os campos de que precisam
+AVALIACAO = {
+    'nome_responsavel': 'Maria Santos',
+    'numero_documento': '987654321',
+    'contacto_telefonico': '+351923456789',
+    'membros_agregado': 3,
+    'grupos_vulneraveis': ['idoso'],
+    'endereco_completo': 'Avenida da Liberdade, 456, Porto',
+    'latitude_gps': 41.1579,
+    'longitude_gps': -8.6291,
+    'tipo_estrutura': 'habitacao',
+    'nivel_danos': 'parcial',
+    'perdas': ['moveis'],
+    'necessidade_urgente': 'medicamentos',
+}
+
+
+@pytest.fixture(scope='session')
+def app():
+    """Aplicação com a API de avaliações sobre uma base de dados SQLite temporária"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(PASTA_TESTES, 'testes.db')}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['MAX_CONTENT_LENGTH'] = LIMITE_PEDIDO_BYTES
+    app.config['TESTING'] = True
+    app.wsgi_app = DescompressaoPedidos(app.wsgi_app)
+
+    api = Api(app, prefix='/api', doc=False)
+    api.add_namespace(api_avaliacoes, path='/avaliacoes')
+    db.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        aplicar_migracoes()
+    return app
+
+
+@pytest.fixture
+def bd(app):
+    """Contexto da aplicação com as tabelas vazias e o instantâneo colunar recarregado"""
+    with app.app_context():
+        for tabela in reversed(db.metadata.sorted_tables):
+            db.session.execute(tabela.delete())
+        db.session.commit()
+        instantaneo_avaliacoes.carregar()
+        yield db
+        db.session.rollback()
+
+
+@pytest.fixture
+def cliente(app, bd):
+    return app.test_client()
+
+
+@pytest.fixture
+def cabecalhos(bd):
+    """Cabeçalho Authorization de um administrador"""
+    utilizador = Usuario(nome='Administrador', email='admin@testes.pt', papel=TipoUtilizador.ADMIN)
+    utilizador.definir_senha('admin123')
+    bd.session.add(utilizador)
+    bd.session.commit()
+    return {'Authorization': f'Bearer {gerar_token(utilizador)}'}
+
+
+@pytest.fixture
+def criar_avaliacao(bd):
+    """Inserir uma avaliação com os campos de AVALIACAO substituídos pelos indicados"""
+    def criar(**campos):
+        data_criacao = campos.pop('data_criacao', None)
+        avaliacao = AvaliacaoDesastre.from_dict(dict(AVALIACAO, **campos))
+        if data_criacao is not None:
+            avaliacao.data_criacao = data_criacao
+        bd.session.add(avaliacao)
+        bd.session.commit()
+        return avaliacao
+    return criar
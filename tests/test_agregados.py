@@ -0,0 +1,170 @@
+"""Cubo e rollups comparados com um GROUP BY direto na tabela de avaliações"""
+from datetime import datetime, timedelta
+from itertools import product
+
+import numpy as np
+import pytest
+
+from src.models.user import db
+from src.models.assessment import AvaliacaoDesastre, NIVEIS_DANOS, TIPOS_ESTRUTURA, NECESSIDADES_URGENTES
+from src.models.rollup import RollupArea, RollupHorario, reconstruir_rollup_areas, reconstruir_rollup_horario
+from src.services.analytics import InstantaneoColunar
+from src.services.areas import NIVEIS_AREA
+from src.services.statistics import calcular_areas, calcular_cubo, calcular_estatisticas
+
+from conftest import AVALIACAO
+
+# Códigos de área (paróquia) de duas regiões e três municípios
+CODIGOS_AREA = ['110601', '110602', '110701', '130301', '130302']
+INICIO = datetime(2024, 3, 1, 8, 0)
+
+
+def _gerar(gerador, n):
+    avaliacoes = []
+    for _ in range(n):
+        avaliacao = AvaliacaoDesastre.from_dict(dict(
+            AVALIACAO,
+            nivel_danos=str(gerador.choice(NIVEIS_DANOS)),
+            tipo_estrutura=str(gerador.choice(TIPOS_ESTRUTURA)),
+            necessidade_urgente=str(gerador.choice(NECESSIDADES_URGENTES)),
+            membros_agregado=int(gerador.integers(1, 9)),
+            codigo_area=str(gerador.choice(CODIGOS_AREA)) if gerador.random() < 0.8 else None
+        ))
+        avaliacao.data_criacao = INICIO + timedelta(minutes=int(gerador.integers(0, 48 * 60)))
+        avaliacoes.append(avaliacao)
+    return avaliacoes
+
+
+@pytest.fixture
+def avaliacoes(bd):
+    """300 avaliações, depois alteradas pelo ORM (os rollups são mantidos pelos eventos)"""
+    gerador = np.random.default_rng(31)
+    bd.session.add_all(_gerar(gerador, 300))
+    bd.session.commit()
+
+    existentes = AvaliacaoDesastre.query.order_by(AvaliacaoDesastre.id).all()
+    escolhidas = gerador.choice(len(existentes), 60, replace=False)
+    for i in escolhidas[:40]:
+        avaliacao = existentes[i]
+        avaliacao.nivel_danos = str(gerador.choice(NIVEIS_DANOS))
+        avaliacao.membros_agregado = int(gerador.integers(1, 9))
+        avaliacao.data_criacao += timedelta(hours=int(gerador.integers(-5, 5)))
+        avaliacao.codigo_area = str(gerador.choice(CODIGOS_AREA))
+    for i in escolhidas[40:]:
+        bd.session.delete(existentes[i])
+    bd.session.add_all(_gerar(gerador, 20))
+    bd.session.commit()
+    return bd
+
+
+def _agrupar(*colunas):
+    """{valores das colunas: (contagem, pessoas)} por GROUP BY"""
+    linhas = db.session.query(
+        *colunas,
+        db.func.count(AvaliacaoDesastre.id),
+        db.func.coalesce(db.func.sum(AvaliacaoDesastre.membros_agregado), 0)
+    ).group_by(*colunas).all()
+    return {tuple(linha[:-2]): (linha[-2], linha[-1]) for linha in linhas}
+
+
+def _celulas_cubo(cubo):
+    """{valores dos eixos: (contagem, pessoas)} das células não vazias de um cubo"""
+    celulas = {}
+    eixos = [cubo['eixos'][d] for d in cubo['dimensoes']]
+    for indice, valores in enumerate(product(*eixos)):
+        contagem, pessoas = cubo['medidas']['count'][indice], cubo['medidas']['people'][indice]
+        if contagem:
+            celulas[valores] = (contagem, pessoas)
+    return celulas
+
+
+@pytest.mark.parametrize('dimensoes', [
+    ['nivel_danos'],
+    ['nivel_danos', 'tipo_estrutura'],
+    ['nivel_danos', 'tipo_estrutura', 'necessidade_urgente'],
+])
+def test_cubo_igual_a_group_by(avaliacoes, dimensoes):
+    esperado = _agrupar(*[getattr(AvaliacaoDesastre, d) for d in dimensoes])
+
+    cubo = calcular_cubo({}, dimensoes, ['count', 'people'])
+    assert _celulas_cubo(cubo) == esperado
+
+    instantaneo = InstantaneoColunar()
+    instantaneo.carregar()
+    assert _celulas_cubo(instantaneo.cubo({}, dimensoes, ['count', 'people'])) == esperado
+
+
+def test_cubo_com_filtros_igual_a_group_by(avaliacoes):
+    filtros = {'nivel_danos': ['total', 'grave'], 'data_inicio': INICIO + timedelta(hours=12)}
+    esperado = {}
+    for avaliacao in AvaliacaoDesastre.query.filter(
+        AvaliacaoDesastre.nivel_danos.in_(filtros['nivel_danos']),
+        AvaliacaoDesastre.data_criacao >= filtros['data_inicio']
+    ):
+        contagem, pessoas = esperado.get((avaliacao.tipo_estrutura,), (0, 0))
+        esperado[(avaliacao.tipo_estrutura,)] = (contagem + 1, pessoas + avaliacao.membros_agregado)
+
+    assert _celulas_cubo(calcular_cubo(filtros, ['tipo_estrutura'], ['count', 'people'])) == esperado
+    instantaneo = InstantaneoColunar()
+    instantaneo.carregar()
+    assert _celulas_cubo(instantaneo.cubo(filtros, ['tipo_estrutura'], ['count', 'people'])) == esperado
+
+
+def test_estatisticas_somam_as_margens(avaliacoes):
+    estatisticas = calcular_estatisticas({})
+    assert estatisticas['total_avaliacoes'] == AvaliacaoDesastre.query.count()
+    assert estatisticas['estatisticas_nivel_danos'] == {
+        nivel: contagem for (nivel,), (contagem, _) in _agrupar(AvaliacaoDesastre.nivel_danos).items()
+    }
+
+
+
+def test_lista_com_filtro_invalido_devolve_400(cliente, cabecalhos):
+    resposta = cliente.get('/api/avaliacoes?bbox=1,2,3', headers=cabecalhos)
+    assert resposta.status_code == 400
+    assert 'bbox' in resposta.get_json()['message']
+
+def test_rollup_horario_igual_a_group_by(avaliacoes):
+    esperado = {}
+    for avaliacao in AvaliacaoDesastre.query:
+        chave = (avaliacao.data_criacao.replace(minute=0, second=0, microsecond=0), avaliacao.nivel_danos,
+                 avaliacao.tipo_estrutura, avaliacao.necessidade_urgente)
+        contagem, pessoas = esperado.get(chave, (0, 0))
+        esperado[chave] = (contagem + 1, pessoas + avaliacao.membros_agregado)
+
+    def rollup():
+        return {
+            (r.hora, r.nivel_danos, r.tipo_estrutura, r.necessidade_urgente): (r.contagem, r.pessoas)
+            for r in RollupHorario.query.filter(RollupHorario.contagem != 0)
+        }
+
+    # Mantido incrementalmente pelos eventos, e depois reconstruído de raiz
+    assert rollup() == esperado
+    reconstruir_rollup_horario()
+    assert rollup() == esperado
+
+
+def test_rollup_areas_igual_a_group_by(avaliacoes):
+    def rollup(nivel):
+        return {
+            (r.codigo, r.necessidade_urgente): (r.contagem, r.pessoas)
+            for r in RollupArea.query.filter(RollupArea.nivel == nivel, RollupArea.contagem != 0)
+        }
+
+    for reconstruir in (False, True):
+        if reconstruir:
+            reconstruir_rollup_areas()
+        for nivel, coluna in NIVEIS_AREA.items():
+            codigo = getattr(AvaliacaoDesastre, coluna)
+            esperado = {
+                chave: valores for chave, valores in _agrupar(codigo, AvaliacaoDesastre.necessidade_urgente).items()
+                if chave[0] is not None
+            }
+            assert rollup(nivel) == esperado
+
+    # Drill-down: os municípios de uma região somam o total da região
+    regioes = {area['codigo']: area for area in calcular_areas('region')['areas']}
+    for codigo, regiao in regioes.items():
+        municipios = calcular_areas('municipality', codigo)['areas']
+        assert sum(m['contagem'] for m in municipios) == regiao['contagem']
+        assert sum(m['pessoas'] for m in municipios) == regiao['pessoas']
@@ -0,0 +1,226 @@
+"""Carregamentos de provas: multipart por blocos e retomáveis (tus), com limites, offsets e checksum"""
+import base64
+import hashlib
+import io
+import json
+import os
+
+import pytest
+
+from src.models.evidence import ObjetoProva, ProvaAvaliacao
+from src.routes import assessment_swagger
+from src.routes.assessment_swagger import garantir_pasta_parciais
+from src.services import evidence
+from src.services.evidence import MAX_FICHEIROS_PEDIDO, CarregamentoRetomavel, ErroProva
+
+# Cabeçalho MP4 ('ftyp'): reconhecido pelo conteúdo e sem miniaturas nem recompressão
+CABECALHO_MP4 = b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00'
+
+
+def _video(tamanho, semente=0):
+    corpo = hashlib.sha256(str(semente).encode()).digest() * (tamanho // 32 + 1)
+    return (CABECALHO_MP4 + corpo)[:tamanho]
+
+
+def _checksum(dados):
+    return 'sha256 ' + base64.b64encode(hashlib.sha256(dados).digest()).decode()
+
+
+@pytest.fixture
+def avaliacao_id(criar_avaliacao):
+    return criar_avaliacao().id
+
+
+def _carregar(cliente, cabecalhos, avaliacao_id, ficheiros):
+    return cliente.post(
+        f'/api/avaliacoes/{avaliacao_id}/evidence',
+        data={'files': [(io.BytesIO(dados), nome) for nome, dados in ficheiros]},
+        headers=cabecalhos, content_type='multipart/form-data'
+    )
+
+
+def _criar_tus(cliente, cabecalhos, avaliacao_id, tamanho, nome='video.mp4'):
+    resposta = cliente.post(f'/api/avaliacoes/{avaliacao_id}/evidence/uploads', headers=dict(
+        cabecalhos, **{
+            'Tus-Resumable': '1.0.0',
+            'Upload-Length': str(tamanho),
+            'Upload-Metadata': 'filename ' + base64.b64encode(nome.encode()).decode()
+        }
+    ))
+    assert resposta.status_code == 201
+    return f"/api/avaliacoes/{avaliacao_id}/evidence/uploads/{resposta.get_json()['id']}"
+
+
+def _patch(cliente, cabecalhos, url, offset, dados, checksum=None):
+    extra = {
+        'Tus-Resumable': '1.0.0',
+        'Upload-Offset': str(offset),
+        'Content-Type': 'application/offset+octet-stream'
+    }
+    if checksum:
+        extra['Upload-Checksum'] = checksum
+    return cliente.patch(url, data=dados, headers=dict(cabecalhos, **extra))
+
+
+def _offset(cliente, cabecalhos, url):
+    resposta = cliente.head(url, headers=dict(cabecalhos, **{'Tus-Resumable': '1.0.0'}))
+    assert resposta.status_code == 200
+    return int(resposta.headers['Upload-Offset'])
+
+
+# --- multipart ---
+
+def test_multipart_guarda_por_conteudo_e_deduplica(cliente, cabecalhos, avaliacao_id, criar_avaliacao):
+    dados = _video(200 * 1024)
+    resposta = _carregar(cliente, cabecalhos, avaliacao_id, [('a.mp4', dados)])
+    assert resposta.status_code == 201
+    assert resposta.get_json()['detalhes'][0]['duplicado'] is False
+
+    # O mesmo conteúdo noutra avaliação reutiliza o objeto guardado
+    outra_id = criar_avaliacao().id
+    resposta = _carregar(cliente, cabecalhos, outra_id, [('b.mp4', dados)])
+    assert resposta.status_code == 201
+    assert resposta.get_json()['detalhes'][0]['duplicado'] is True
+
+    objeto = ObjetoProva.query.one()
+    assert objeto.sha256 == hashlib.sha256(dados).hexdigest()
+    assert objeto.tamanho == len(dados)
+    assert objeto.referencias == 2
+    assert ProvaAvaliacao.query.count() == 2
+
+
+def test_multipart_acima_do_limite_global_de_pedidos(app, cliente, cabecalhos, avaliacao_id, monkeypatch):
+    # O limite global só se aplica aos outros pedidos; a rota de provas sobe-o
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 64 * 1024)
+    assert _carregar(cliente, cabecalhos, avaliacao_id, [('a.mp4', _video(200 * 1024))]).status_code == 201
+
+    corpo = json.dumps({'nome_responsavel': 'x' * 100 * 1024})
+    resposta = cliente.put(f'/api/avaliacoes/{avaliacao_id}', data=corpo,
+                           headers=dict(cabecalhos, **{'Content-Type': 'application/json'}))
+    assert resposta.status_code == 413
+
+
+def test_multipart_limite_por_ficheiro(cliente, cabecalhos, avaliacao_id, monkeypatch):
+    monkeypatch.setattr(evidence, 'LIMITE_FICHEIRO_PROVA_BYTES', 100 * 1024)
+    resposta = _carregar(cliente, cabecalhos, avaliacao_id, [('a.mp4', _video(150 * 1024))])
+    assert resposta.status_code == 413
+    assert ProvaAvaliacao.query.count() == 0
+
+
+def test_multipart_limite_por_pedido(cliente, cabecalhos, avaliacao_id, monkeypatch):
+    monkeypatch.setattr(evidence, 'LIMITE_PEDIDO_PROVAS_BYTES', 250 * 1024)
+    monkeypatch.setattr(assessment_swagger, 'LIMITE_PEDIDO_PROVAS_BYTES', 250 * 1024)
+    ficheiros = [(f'{i}.mp4', _video(100 * 1024, i)) for i in range(3)]
+    assert _carregar(cliente, cabecalhos, avaliacao_id, ficheiros).status_code == 413
+    assert ProvaAvaliacao.query.count() == 0
+
+
+def test_multipart_maximo_de_ficheiros(cliente, cabecalhos, avaliacao_id):
+    ficheiros = [(f'{i}.mp4', _video(1024, i)) for i in range(MAX_FICHEIROS_PEDIDO + 1)]
+    assert _carregar(cliente, cabecalhos, avaliacao_id, ficheiros).status_code == 400
+    assert ProvaAvaliacao.query.count() == 0
+
+
+def test_multipart_conteudo_que_nao_corresponde_a_extensao(cliente, cabecalhos, avaliacao_id):
+    resposta = _carregar(cliente, cabecalhos, avaliacao_id, [('foto.png', _video(1024))])
+    assert resposta.status_code == 415
+    assert ObjetoProva.query.count() == 0
+
+
+# --- retomáveis (tus) ---
+
+def test_tus_blocos_offsets_e_checksum(cliente, cabecalhos, avaliacao_id):
+    dados = _video(300 * 1024)
+    url = _criar_tus(cliente, cabecalhos, avaliacao_id, len(dados))
+    assert _offset(cliente, cabecalhos, url) == 0
+
+    primeiro = dados[:128 * 1024]
+    resposta = _patch(cliente, cabecalhos, url, 0, primeiro, _checksum(primeiro))
+    assert resposta.status_code == 204
+    assert resposta.headers['Upload-Offset'] == str(len(primeiro))
+
+    # Offset errado: 409 sem alterar o carregamento
+    assert _patch(cliente, cabecalhos, url, 0, primeiro).status_code == 409
+    # Checksum errado: 460 e o bloco é descartado
+    segundo = dados[len(primeiro):200 * 1024]
+    assert _patch(cliente, cabecalhos, url, len(primeiro), segundo, _checksum(b'outro')).status_code == 460
+    assert _offset(cliente, cabecalhos, url) == len(primeiro)
+    # Bloco para além do Upload-Length: 413 e o bloco é descartado
+    assert _patch(cliente, cabecalhos, url, len(primeiro), dados[len(primeiro):] + b'extra').status_code == 413
+    assert _offset(cliente, cabecalhos, url) == len(primeiro)
+
+    resposta = _patch(cliente, cabecalhos, url, len(primeiro), dados[len(primeiro):])
+    assert resposta.status_code == 204
+    assert resposta.headers['Upload-Offset'] == str(len(dados))
+
+    prova = ProvaAvaliacao.query.filter_by(avaliacao_id=avaliacao_id).one()
+    assert prova.sha256 == hashlib.sha256(dados).hexdigest()
+    # O carregamento concluído desaparece: um PATCH final repetido não regista outra prova
+    assert _patch(cliente, cabecalhos, url, len(dados), b'').status_code == 404
+    assert _patch(cliente, cabecalhos, url, len(primeiro), dados[len(primeiro):]).status_code == 404
+    assert ProvaAvaliacao.query.count() == 1
+
+
+def test_tus_acima_do_limite_por_ficheiro(cliente, cabecalhos, avaliacao_id, monkeypatch):
+    monkeypatch.setattr(evidence, 'LIMITE_FICHEIRO_PROVA_BYTES', 100 * 1024)
+    resposta = cliente.post(f'/api/avaliacoes/{avaliacao_id}/evidence/uploads', headers=dict(
+        cabecalhos, **{
+            'Tus-Resumable': '1.0.0',
+            'Upload-Length': str(200 * 1024),
+            'Upload-Metadata': 'filename ' + base64.b64encode(b'video.mp4').decode()
+        }
+    ))
+    assert resposta.status_code == 413
+
+
+def test_tus_bloco_acima_do_limite_global_de_pedidos(app, cliente, cabecalhos, avaliacao_id, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 64 * 1024)
+    dados = _video(200 * 1024)
+    url = _criar_tus(cliente, cabecalhos, avaliacao_id, len(dados))
+    assert _patch(cliente, cabecalhos, url, 0, dados).status_code == 204
+    assert ProvaAvaliacao.query.count() == 1
+
+
+class _LigacaoInterrompida(io.RawIOBase):
+    """Stream que entrega alguns bytes e depois falha, como uma ligação que cai"""
+
+    def __init__(self, dados):
+        self._dados = io.BytesIO(dados)
+
+    def read(self, tamanho=-1):
+        bloco = self._dados.read(tamanho)
+        if not bloco:
+            raise ConnectionResetError('ligação interrompida')
+        return bloco
+
+
+@pytest.mark.parametrize('com_checksum', [False, True])
+def test_tus_bloco_interrompido(bd, com_checksum):
+    dados = _video(300 * 1024)
+    carregamento = CarregamentoRetomavel.criar(garantir_pasta_parciais(), 1, 'video.mp4', len(dados))
+    carregamento.anexar(io.BytesIO(dados[:100 * 1024]), 0)
+
+    bloco = dados[100 * 1024:]
+    with pytest.raises(ConnectionResetError):
+        carregamento.anexar(_LigacaoInterrompida(bloco[:150 * 1024]), 100 * 1024,
+                            _checksum(bloco) if com_checksum else None)
+
+    # Sem checksum os bytes recebidos ficam; com checksum não foram verificados e são descartados
+    esperado = 100 * 1024 if com_checksum else 250 * 1024
+    assert carregamento.offset == esperado
+    with open(carregamento.caminho, 'rb') as ficheiro:
+        assert ficheiro.read() == dados[:esperado]
+    carregamento.descartar()
+
+
+def test_tus_concluido_por_outro_pedido(bd):
+    dados = _video(1024)
+    pasta = garantir_pasta_parciais()
+    carregamento = CarregamentoRetomavel.criar(pasta, 1, 'video.mp4', len(dados))
+    repetido = CarregamentoRetomavel.abrir(pasta, carregamento.identificador)
+    carregamento.anexar(io.BytesIO(dados), 0, ao_concluir=lambda c: c.descartar())
+
+    with pytest.raises(ErroProva) as erro:
+        repetido.anexar(io.BytesIO(dados), 0, ao_concluir=lambda c: pytest.fail('concluído duas vezes'))
+    assert erro.value.codigo == 404
+    assert not os.path.exists(carregamento.caminho)
@@ -0,0 +1,41 @@
+"""Agrupamento de pedidos iguais e concorrentes (SingleFlight)"""
+import threading
+
+from src.services.coalescing import SingleFlight
+
+
+def _lider(pedidos, liberar, iniciado, resultados):
+    def calcular():
+        iniciado.set()
+        liberar.wait(5)
+        return 'lider'
+
+    thread = threading.Thread(target=lambda: resultados.append(pedidos.executar('chave', calcular)))
+    thread.start()
+    assert iniciado.wait(5)
+    return thread
+
+
+def test_pedido_concorrente_partilha_o_resultado():
+    # Com a janela, um seguidor que chegue depois do fim recebe o mesmo resultado
+    pedidos = SingleFlight(janela=60, espera=5)
+    liberar, iniciado, resultados = threading.Event(), threading.Event(), []
+    lider = _lider(pedidos, liberar, iniciado, resultados)
+
+    seguidor = threading.Thread(target=lambda: resultados.append(pedidos.executar('chave', lambda: 'seguidor')))
+    seguidor.start()
+    liberar.set()
+    lider.join()
+    seguidor.join()
+    assert resultados == ['lider', 'lider']
+
+
+def test_pedido_concorrente_calcula_o_seu_se_o_lider_demorar():
+    pedidos = SingleFlight(janela=0, espera=0.05)
+    liberar, iniciado, resultados = threading.Event(), threading.Event(), []
+    lider = _lider(pedidos, liberar, iniciado, resultados)
+
+    assert pedidos.executar('chave', lambda: 'seguidor') == 'seguidor'
+    liberar.set()
+    lider.join()
+    assert resultados == ['lider']
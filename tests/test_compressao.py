@@ -0,0 +1,41 @@
+"""Corpos de pedido comprimidos (Content-Encoding) descomprimidos pelo middleware"""
+import gzip
+import json
+import zlib
+
+import pytest
+import zstandard
+
+from conftest import AVALIACAO
+
+
+def _deflate_cru(dados):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(dados) + compressor.flush()
+
+
+@pytest.mark.parametrize('codificacao, comprimir', [
+    ('gzip', gzip.compress),
+    ('deflate', zlib.compress),
+    ('deflate', _deflate_cru),
+    ('zstd', lambda dados: zstandard.ZstdCompressor().compress(dados)),
+], ids=['gzip', 'deflate-zlib', 'deflate-cru', 'zstd'])
+def test_corpo_comprimido(cliente, cabecalhos, codificacao, comprimir):
+    corpo = comprimir(json.dumps(AVALIACAO).encode())
+    resposta = cliente.post('/api/avaliacoes', data=corpo, content_type='application/json',
+                            headers=dict(cabecalhos, **{'Content-Encoding': codificacao}))
+    assert resposta.status_code == 201
+    assert resposta.get_json()['nome_responsavel'] == AVALIACAO['nome_responsavel']
+
+
+def test_corpo_comprimido_invalido(cliente, cabecalhos):
+    resposta = cliente.post('/api/avaliacoes', data=b'isto nao e deflate', content_type='application/json',
+                            headers=dict(cabecalhos, **{'Content-Encoding': 'gzip'}))
+    assert resposta.status_code == 400
+
+
+def test_corpo_descomprimido_acima_do_limite(cliente, cabecalhos):
+    corpo = gzip.compress(b' ' * (64 * 1024 * 1024))
+    resposta = cliente.post('/api/avaliacoes', data=corpo, content_type='application/json',
+                            headers=dict(cabecalhos, **{'Content-Encoding': 'gzip'}))
+    assert resposta.status_code == 413
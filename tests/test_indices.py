@@ -0,0 +1,203 @@
+"""Índices em memória (árvore KD, clusters e instantâneo colunar) comparados com o cálculo direto"""
+import math
+
+import numpy as np
+import pytest
+
+from src.models.assessment import AvaliacaoDesastre, NIVEIS_DANOS, TIPOS_ESTRUTURA, NECESSIDADES_URGENTES
+from src.services import spatial
+from src.services.analytics import InstantaneoColunar, TIPOS_COLUNAS
+from src.services.spatial import ArvoreKD, IndiceClusters, IndiceVizinhos, RAIO_TERRA_METROS, vetores_unitarios
+
+from conftest import AVALIACAO
+
+# Área dos dados gerados (à volta de Lisboa) e a bbox usada nas consultas
+LATITUDES = (38.5, 39.0)
+LONGITUDES = (-9.5, -8.9)
+BBOX = (-9.6, 38.4, -8.8, 39.1)
+
+
+def _gerar(gerador, n):
+    """n avaliações aleatórias (algumas sem coordenadas)"""
+    avaliacoes = []
+    for _ in range(n):
+        campos = {
+            'latitude_gps': float(gerador.uniform(*LATITUDES)),
+            'longitude_gps': float(gerador.uniform(*LONGITUDES)),
+            'nivel_danos': str(gerador.choice(NIVEIS_DANOS)),
+            'tipo_estrutura': str(gerador.choice(TIPOS_ESTRUTURA)),
+            'necessidade_urgente': str(gerador.choice(NECESSIDADES_URGENTES)),
+            'membros_agregado': int(gerador.integers(1, 9)),
+        }
+        if gerador.random() < 0.05:
+            campos['latitude_gps'] = campos['longitude_gps'] = None
+        avaliacoes.append(AvaliacaoDesastre.from_dict(dict(AVALIACAO, **campos)))
+    return avaliacoes
+
+
+def _alterar(bd, gerador, n_atualizar=20, n_eliminar=10, n_inserir=15):
+    """Atualizar, eliminar e inserir avaliações depois de os índices estarem construídos"""
+    avaliacoes = AvaliacaoDesastre.query.order_by(AvaliacaoDesastre.id).all()
+    escolhidas = gerador.choice(len(avaliacoes), n_atualizar + n_eliminar, replace=False)
+    for i in escolhidas[:n_atualizar]:
+        avaliacao = avaliacoes[i]
+        avaliacao.latitude_gps = float(gerador.uniform(*LATITUDES))
+        avaliacao.longitude_gps = float(gerador.uniform(*LONGITUDES))
+        avaliacao.nivel_danos = str(gerador.choice(NIVEIS_DANOS))
+    for i in escolhidas[n_atualizar:]:
+        bd.session.delete(avaliacoes[i])
+    bd.session.add_all(_gerar(gerador, n_inserir))
+    bd.session.commit()
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RAIO_TERRA_METROS * math.asin(math.sqrt(a))
+
+
+def _vizinhos_forca_bruta(lat, lon, k, nivel_danos=None):
+    """(id, metros) das k avaliações mais próximas, lidas diretamente da base de dados"""
+    query = AvaliacaoDesastre.query.filter(AvaliacaoDesastre.latitude_gps.isnot(None))
+    if nivel_danos:
+        query = query.filter(AvaliacaoDesastre.nivel_danos.in_(nivel_danos))
+    distancias = sorted(
+        (_haversine(lat, lon, a.latitude_gps, a.longitude_gps), a.id) for a in query
+    )
+    return [(avaliacao_id, metros) for metros, avaliacao_id in distancias[:k]]
+
+
+def _linhas_ativas(instantaneo):
+    """Linhas ativas do instantâneo por id, com as colunas categóricas descodificadas"""
+    colunas = instantaneo.colunas()
+    ativas = np.flatnonzero(colunas['ativo'])
+    linhas = {}
+    for posicao in ativas.tolist():
+        linha = {}
+        for coluna in TIPOS_COLUNAS:
+            valor = colunas[coluna][posicao].item()
+            if coluna in instantaneo.vocabularios:
+                valor = instantaneo.vocabularios[coluna][valor]
+            elif isinstance(valor, float) and math.isnan(valor):
+                valor = None
+            linha[coluna] = valor
+        linhas[linha['id']] = linha
+    return linhas
+
+
+def _clusters(indice, zoom):
+    return sorted(
+        (c['contagem'], c['latitude'], c['longitude'], c['nivel_danos_dominante'])
+        for c in indice.clusters(BBOX, zoom)
+    )
+
+
+def test_arvore_kd_igual_a_forca_bruta():
+    gerador = np.random.default_rng(38)
+    pontos = vetores_unitarios(gerador.uniform(-85, 85, 3000), gerador.uniform(-180, 180, 3000))
+    arvore = ArvoreKD(pontos.copy(), np.arange(len(pontos)))
+
+    for lat, lon in [(0, 0), (38.7, -9.1), (-60, 179.9), (84, -179.9)]:
+        q = vetores_unitarios([lat], [lon])[0]
+        distancias = ((pontos - q) ** 2).sum(axis=1)
+
+        resultado = sorted(arvore.vizinhos(q, 10, lambda inicio, fim: np.ones(fim - inicio, dtype=np.bool_)))
+        assert [posicao for _, posicao in resultado] == np.argsort(distancias)[:10].tolist()
+        assert [d for d, _ in resultado] == pytest.approx(np.sort(distancias)[:10].tolist())
+
+        # Só as posições pares (equivalente a um filtro)
+        pares = sorted(arvore.vizinhos(q, 10, lambda inicio, fim: arvore.posicoes[inicio:fim] % 2 == 0))
+        esperado = [p for p in np.argsort(distancias).tolist() if p % 2 == 0][:10]
+        assert [posicao for _, posicao in pares] == esperado
+
+
+def test_arvore_kd_com_menos_pontos_do_que_k():
+    pontos = vetores_unitarios([38.7, 41.1], [-9.1, -8.6])
+    arvore = ArvoreKD(pontos.copy(), np.arange(2))
+    q = vetores_unitarios([40.0], [-9.0])[0]
+    assert len(arvore.vizinhos(q, 5, lambda inicio, fim: np.ones(fim - inicio, dtype=np.bool_))) == 2
+    assert ArvoreKD(np.empty((0, 3)), np.empty(0, dtype=np.int64)).vizinhos(q, 5, None) == []
+
+
+@pytest.mark.parametrize('limiar', [0.05, 0.0], ids=['pendentes', 'reconstrucao'])
+def test_vizinhos_depois_de_alteracoes_igual_a_forca_bruta(bd, monkeypatch, limiar):
+    monkeypatch.setattr(spatial, 'LIMIAR_RECONSTRUCAO_ARVORE', limiar)
+    gerador = np.random.default_rng(7)
+    bd.session.add_all(_gerar(gerador, 400))
+    bd.session.commit()
+
+    instantaneo = InstantaneoColunar()
+    indice = IndiceVizinhos(instantaneo)
+    consultas = [(38.7, -9.1, 8), (38.95, -8.95, 1), (38.5, -9.5, 25)]
+    for lat, lon, k in consultas:
+        indice.vizinhos(lat, lon, k, {})
+
+    # O vizinho mais próximo da primeira consulta muda-se para o canto oposto
+    mais_proximo = bd.session.get(AvaliacaoDesastre, _vizinhos_forca_bruta(38.7, -9.1, 1)[0][0])
+    mais_proximo.latitude_gps, mais_proximo.longitude_gps = 38.5001, -9.4999
+    _alterar(bd, gerador)
+    instantaneo.sincronizar(forcar=True)
+
+    for lat, lon, k in consultas:
+        for filtros in ({}, {'nivel_danos': ['total', 'grave']}):
+            resultado = indice.vizinhos(lat, lon, k, filtros)
+            esperado = _vizinhos_forca_bruta(lat, lon, k, filtros.get('nivel_danos'))
+            assert [avaliacao_id for avaliacao_id, _ in resultado] == [avaliacao_id for avaliacao_id, _ in esperado]
+            # O instantâneo guarda as coordenadas em float32 (erro de poucos centímetros)
+            assert [m for _, m in resultado] == pytest.approx([m for _, m in esperado], abs=1.0)
+
+
+def test_clusters_incrementais_iguais_a_reconstrucao(bd, monkeypatch):
+    # Delta pequeno para exercitar também a fusão nos vetores ordenados
+    monkeypatch.setattr(spatial, 'LIMITE_DELTA', 8)
+    gerador = np.random.default_rng(36)
+    bd.session.add_all(_gerar(gerador, 500))
+    bd.session.commit()
+
+    zooms = [0, 6, 10, 14]
+    instantaneo = InstantaneoColunar()
+    incremental = IndiceClusters(instantaneo)
+    for zoom in zooms:
+        incremental.clusters(BBOX, zoom)
+
+    _alterar(bd, gerador, n_atualizar=60, n_eliminar=40, n_inserir=50)
+    instantaneo.sincronizar(forcar=True)
+
+    reconstruido = IndiceClusters(InstantaneoColunar())
+    for zoom in zooms:
+        obtidos = _clusters(incremental, zoom)
+        esperados = _clusters(reconstruido, zoom)
+        assert [c[0] for c in obtidos] == [c[0] for c in esperados]
+        assert [c[3] for c in obtidos] == [c[3] for c in esperados]
+        assert [c[1:3] for c in obtidos] == pytest.approx([c[1:3] for c in esperados], abs=1e-5)
+
+    # Zoom 0: um só cluster com todas as avaliações com coordenadas
+    com_coordenadas = AvaliacaoDesastre.query.filter(AvaliacaoDesastre.latitude_gps.isnot(None)).count()
+    assert [c[0] for c in _clusters(incremental, 0)] == [com_coordenadas]
+
+
+def test_instantaneo_incremental_igual_a_recarga(bd):
+    gerador = np.random.default_rng(34)
+    bd.session.add_all(_gerar(gerador, 300))
+    bd.session.commit()
+    # Um id livre abaixo do último: voltar a usá-lo obriga a reordenar o instantâneo
+    livre = bd.session.get(AvaliacaoDesastre, 150)
+    bd.session.delete(livre)
+    bd.session.commit()
+
+    instantaneo = InstantaneoColunar()
+    instantaneo.carregar()
+    _alterar(bd, gerador)
+    fora_de_ordem = _gerar(gerador, 1)[0]
+    fora_de_ordem.id = 150
+    bd.session.add(fora_de_ordem)
+    bd.session.commit()
+    instantaneo.sincronizar(forcar=True)
+
+    recarregado = InstantaneoColunar()
+    recarregado.carregar()
+    assert _linhas_ativas(instantaneo) == _linhas_ativas(recarregado)
+    assert set(_linhas_ativas(instantaneo)) == {a.id for a in AvaliacaoDesastre.query}
+
+    dimensoes = ['nivel_danos', 'necessidade_urgente']
+    assert instantaneo.cubo({}, dimensoes, ['count', 'people']) == recarregado.cubo({}, dimensoes, ['count', 'people'])
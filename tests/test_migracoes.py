@@ -0,0 +1,49 @@
+"""Migração das provas da coluna antiga ficheiros_prova para o armazém por conteúdo"""
+import json
+import os
+
+import pytest
+from sqlalchemy import inspect, text
+
+from src.models.evidence import ObjetoProva, ProvaAvaliacao
+from src.models.migracoes import aplicar_migracoes
+from src.services.evidence import PASTA_UPLOAD
+
+from test_carregamentos import _video
+
+
+@pytest.fixture
+def coluna_antiga(bd):
+    """Base de dados anterior ao armazém, com a coluna ficheiros_prova"""
+    if 'ficheiros_prova' not in {c['name'] for c in inspect(bd.engine).get_columns('avaliacoes_desastre')}:
+        bd.session.execute(text('ALTER TABLE avaliacoes_desastre ADD COLUMN ficheiros_prova TEXT'))
+        bd.session.commit()
+    return bd
+
+
+def _definir(bd, avaliacao_id, valor):
+    bd.session.execute(text('UPDATE avaliacoes_desastre SET ficheiros_prova = :valor WHERE id = :id'),
+                       {'valor': valor, 'id': avaliacao_id})
+    bd.session.commit()
+
+
+def test_arranque_migra_provas_antigas(coluna_antiga, criar_avaliacao, tmp_path):
+    pasta = tmp_path / PASTA_UPLOAD
+    pasta.mkdir(parents=True)
+    dados = _video(4096)
+    primeira, segunda, ilegivel = criar_avaliacao(), criar_avaliacao(), criar_avaliacao()
+    for avaliacao in (primeira, segunda):
+        (pasta / f'{avaliacao.id}_video.mp4').write_bytes(dados)
+        _definir(coluna_antiga, avaliacao.id, json.dumps([f'{PASTA_UPLOAD}/{avaliacao.id}_video.mp4',
+                                                          f'{PASTA_UPLOAD}/{avaliacao.id}_perdido.mp4']))
+    _definir(coluna_antiga, ilegivel.id, '["uploads/evidence/')
+
+    aplicar_migracoes(str(tmp_path))
+
+    assert sorted(p.avaliacao_id for p in ProvaAvaliacao.query) == [primeira.id, segunda.id]
+    assert ProvaAvaliacao.query.first().nome_original == 'video.mp4'
+    assert ObjetoProva.query.one().referencias == 2
+    assert not os.listdir(pasta)
+    assert coluna_antiga.session.execute(
+        text('SELECT COUNT(*) FROM avaliacoes_desastre WHERE ficheiros_prova IS NOT NULL')
+    ).scalar() == 0
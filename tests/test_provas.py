@@ -0,0 +1,48 @@
+"""Funcionalidades de provas que dependem do Pillow: miniaturas, imagens semelhantes e recompressão"""
+import pytest
+
+from src.models.evidence import ProvaAvaliacao
+from src.routes import assessment_swagger
+from src.services import recompressao
+
+from test_carregamentos import _carregar, _video
+
+
+@pytest.fixture
+def prova(cliente, cabecalhos, criar_avaliacao):
+    avaliacao_id = criar_avaliacao().id
+    assert _carregar(cliente, cabecalhos, avaliacao_id, [('a.mp4', _video(1024))]).status_code == 201
+    return ProvaAvaliacao.query.one()
+
+
+def test_miniatura_em_falta_devolve_404(cliente, cabecalhos, prova):
+    url = f'/api/avaliacoes/{prova.avaliacao_id}/evidence/{prova.id}/preview'
+    assert cliente.get(url, headers=cabecalhos).status_code == 404
+
+
+def test_miniatura_sem_pillow_devolve_501(cliente, cabecalhos, prova, monkeypatch):
+    monkeypatch.setattr(assessment_swagger, 'miniaturas_disponiveis', lambda: False)
+    url = f'/api/avaliacoes/{prova.avaliacao_id}/evidence/{prova.id}/preview'
+    resposta = cliente.get(url, headers=cabecalhos)
+    assert resposta.status_code == 501
+    assert 'Pillow' in resposta.get_json()['message']
+
+
+def test_semelhantes_sem_hash_devolve_404(cliente, cabecalhos, prova):
+    url = f'/api/avaliacoes/{prova.avaliacao_id}/evidence/{prova.id}/similar'
+    assert cliente.get(url, headers=cabecalhos).status_code == 404
+
+
+def test_semelhantes_sem_pillow_devolve_501(cliente, cabecalhos, prova, monkeypatch):
+    monkeypatch.setattr(assessment_swagger, 'semelhanca_disponivel', lambda: False)
+    url = f'/api/avaliacoes/{prova.avaliacao_id}/evidence/{prova.id}/similar'
+    resposta = cliente.get(url, headers=cabecalhos)
+    assert resposta.status_code == 501
+    assert 'Pillow' in resposta.get_json()['message']
+
+
+def test_recompressao_sem_pillow_avisa_no_arranque(app, monkeypatch, caplog):
+    monkeypatch.setattr(recompressao, 'RECOMPRIMIR_PROVAS', True)
+    monkeypatch.setattr(recompressao, 'Image', None)
+    recompressao.avisar_se_indisponivel(app)
+    assert 'RECOMPRIMIR_PROVAS' in caplog.text
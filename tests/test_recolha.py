@@ -0,0 +1,107 @@
+"""Recolha das provas sem referências: carência, corrida com novos carregamentos e ficheiros órfãos"""
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.models.evidence import ObjetoProva
+from src.services.armazenamento import ArmazenamentoLocal, armazenamento_provas
+from src.services.recolha import VALIDADE_CARREGAMENTOS_PARCIAIS, RecolhaProvas
+
+from test_carregamentos import _carregar, _video
+
+HASH = 'ab' * 32
+
+
+def _envelhecer(caminho, segundos):
+    antes = time.time() - segundos
+    os.utime(caminho, (antes, antes))
+
+
+@pytest.fixture
+def objeto_sem_referencias(bd, cliente, cabecalhos, criar_avaliacao):
+    """Objeto de uma avaliação já eliminada, criado há duas horas"""
+    avaliacao_id = criar_avaliacao().id
+    assert _carregar(cliente, cabecalhos, avaliacao_id, [('a.mp4', _video(4096))]).status_code == 201
+    assert cliente.delete(f'/api/avaliacoes/{avaliacao_id}', headers=cabecalhos).status_code == 200
+    objeto = ObjetoProva.query.one()
+    assert objeto.referencias == 0
+    objeto.data_criacao = datetime.utcnow() - timedelta(hours=2)
+    bd.session.commit()
+    _envelhecer(armazenamento_provas().caminho(objeto.caminho), 2 * 3600)
+    return objeto.caminho
+
+
+def test_objeto_dentro_da_carencia_fica(objeto_sem_referencias):
+    contadores = RecolhaProvas(carencia=3 * 3600, taxa=0).executar()
+    assert contadores['objetos'] == 0
+    assert ObjetoProva.query.count() == 1
+    assert armazenamento_provas().tamanho(objeto_sem_referencias) == 4096
+
+
+def test_objeto_depois_da_carencia_e_apagado(objeto_sem_referencias):
+    contadores = RecolhaProvas(carencia=3600, taxa=0).executar()
+    assert contadores['objetos'] == 1
+    assert ObjetoProva.query.count() == 0
+    assert armazenamento_provas().tamanho(objeto_sem_referencias) is None
+
+
+def test_carregamento_durante_a_recolha_e_recusado(objeto_sem_referencias, cliente, cabecalhos, criar_avaliacao):
+    recolha = RecolhaProvas(carencia=3600, taxa=0)
+    avaliacao_id = criar_avaliacao().id
+    respostas = []
+    remover = recolha._remover
+
+    def remover_com_carregamento(chaves):
+        # O mesmo conteúdo chega depois de a linha ser marcada e antes de os ficheiros saírem
+        if chaves and not respostas:
+            respostas.append(_carregar(cliente, cabecalhos, avaliacao_id, [('b.mp4', _video(4096))]).status_code)
+        remover(chaves)
+
+    recolha._remover = remover_com_carregamento
+    recolha.executar()
+    assert respostas == [409]
+    assert ObjetoProva.query.count() == 0
+    assert armazenamento_provas().tamanho(objeto_sem_referencias) is None
+
+    # Enviado de novo depois da recolha, o objeto volta a ser guardado
+    assert _carregar(cliente, cabecalhos, avaliacao_id, [('b.mp4', _video(4096))]).status_code == 201
+    assert ObjetoProva.query.one().referencias == 1
+    assert armazenamento_provas().tamanho(objeto_sem_referencias) == 4096
+
+
+def test_ficheiros_orfaos_e_parciais_abandonados(bd, tmp_path):
+    armazenamento = ArmazenamentoLocal(str(tmp_path / 'armazem'))
+    parciais = tmp_path / 'parciais'
+    parciais.mkdir()
+
+    def criar(caminho, idade):
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        with open(caminho, 'wb') as ficheiro:
+            ficheiro.write(b'x' * 10)
+        _envelhecer(caminho, idade)
+        return caminho
+
+    antigo = 2 * 3600
+    miniatura = criar(armazenamento.caminho(f'ab/{HASH}_160.webp'), antigo)
+    objeto = criar(armazenamento.caminho(f'ab/{HASH}.mp4'), antigo)
+    temporario = criar(armazenamento.caminho(f'.{uuid.uuid4().hex}.parcial'), antigo)
+    recente = criar(armazenamento.caminho(f'ab/{HASH}_480.webp'), 60)
+    desconhecido = criar(armazenamento.caminho('leia-me.txt'), antigo)
+    abandonado = uuid.uuid4().hex
+    abandonados = [criar(str(parciais / f'{abandonado}.{ext}'), VALIDADE_CARREGAMENTOS_PARCIAIS + 60)
+                   for ext in ('parcial', 'json')]
+    ativo = uuid.uuid4().hex
+    ativos = [criar(str(parciais / f'{ativo}.{ext}'), antigo) for ext in ('parcial', 'json')]
+
+    contadores = RecolhaProvas(armazenamento, str(parciais), carencia=3600, lote=2, taxa=0).executar()
+
+    for caminho in [miniatura, objeto, temporario, *abandonados]:
+        assert not os.path.exists(caminho)
+    for caminho in [recente, desconhecido, *ativos]:
+        assert os.path.exists(caminho)
+    assert contadores['ficheiros'] == 3
+    assert contadores['parciais'] == 1
+    assert contadores['desconhecidos'] == 1
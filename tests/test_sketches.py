@@ -0,0 +1,40 @@
+"""Sketches das avaliações mantidos a partir da sequência de alterações"""
+import pytest
+
+from src.models.assessment import AvaliacaoDesastre
+from src.services import sketches
+from src.services.sketches import SketchesAvaliacoes, _EstadoSketches
+
+
+@pytest.fixture
+def sketches_construidos(bd, criar_avaliacao, monkeypatch):
+    monkeypatch.setattr(sketches, 'INTERVALO_SINCRONIZACAO_SEGUNDOS', 0)
+    for i in range(10):
+        criar_avaliacao(numero_documento=f'DOC{i}', membros_agregado=i + 1)
+    servico = SketchesAvaliacoes()
+    servico._estado = _EstadoSketches.construir()
+    return servico
+
+
+def test_atualizacao_sem_mudar_textos_nao_desatualiza(bd, sketches_construidos):
+    for avaliacao in AvaliacaoDesastre.query.limit(3):
+        avaliacao.membros_agregado += 10
+        # Só muda a normalização: conta como o mesmo documento
+        avaliacao.numero_documento = f'  {avaliacao.numero_documento.lower()} '
+    bd.session.commit()
+
+    estado = sketches_construidos.sincronizar()
+    assert estado.nao_refletidas == 0
+    assert estado.linhas == 10
+    assert estado.membros.quantil(1.0) == pytest.approx(13, rel=0.02)
+
+
+def test_eliminacao_e_mudanca_de_textos_desatualizam(bd, sketches_construidos):
+    primeira, segunda = AvaliacaoDesastre.query.limit(2).all()
+    primeira.endereco_completo = 'Rua Nova, 1, Braga'
+    bd.session.delete(segunda)
+    bd.session.commit()
+
+    estado = sketches_construidos.sincronizar()
+    assert estado.nao_refletidas == 2
+    assert estado.linhas == 9